@@ -0,0 +1,195 @@
+#!python3
+
+import argparse
+import contextlib
+import copy
+import fnmatch
+import glob
+import json
+import sys
+
+import Settings
+
+# Exit status
+EXIT_OK = 0  # Every file was fitted
+EXIT_FAILED = 1  # Some files could not be fitted or plotted
+EXIT_USAGE = 2  # Invalid arguments, settings or job file
+EXIT_NO_FILES = 3  # Nothing matched the patterns
+
+JOB_EXAMPLE = '''job file example:
+  {"settings": {"NL_FITTING_METHOD": "Cross"},
+   "files": ["a.txt", "run2/*.txt", {"file": "b.txt", "settings": {"DO_LIN": false}}]}
+
+Settings start from settings.dat in the working folder. Then come the job settings, the --set options and
+the settings of each file, in this order.
+Exit status: 0 every file was fitted, 1 some failed, 2 invalid arguments, settings or job file, 3 no files.'''
+
+
+def parse_args(argv):
+    parser = argparse.ArgumentParser(description='Fits flow curves in batch, without asking anything.',
+                                     epilog=JOB_EXAMPLE, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('patterns', nargs='*', help='files or glob patterns to fit')
+    parser.add_argument('--job', help='JSON job file with the files to fit and their settings')
+    parser.add_argument('--set', action='append', default=[], metavar='SETTING=VALUE',
+                        help='overrides a setting of settings.dat, for every file. Can be repeated')
+    parser.add_argument('--model', help='nonlinear model, same as --set NL_FITTING_METHOD=MODEL')
+    parser.add_argument('--workers', type=int, help='processes fitting in parallel, 0 for one per core')
+    parser.add_argument('--backend', choices=['csv', 'sqlite', 'both', 'none'],
+                        help='where the results go besides the usual files: the results table (csv), the '
+                             'results database (sqlite), both or none. Default: the results table, fits.csv unless '
+                             'RESULTS_TABLE says otherwise, and the results database if RESULTS_DB is set')
+    parser.add_argument('--table', help='path of the results table, for the csv backend')
+    parser.add_argument('--db', help='path of the results database, for the sqlite backend')
+    parser.add_argument('--plot', choices=['none', 'save'], default='none',
+                        help='save a .png of each fit, without showing it. Default: none')
+    parser.add_argument('--report', help='PDF with every fit of the batch, and contact sheets next to it')
+    parser.add_argument('--stats', help='file the timing and solver statistics of every fit are written to, as '
+                                        'JSON lines, or as Prometheus metrics if it ends in .prom')
+    parser.add_argument('--plot-workers', type=int,
+                        help='processes saving the plots while the next files are fitted, 0 for one per core, '
+                             '1 to save them in the main process')
+    return parser.parse_args(argv)
+
+
+def load_job(path):
+    """Settings and list of (pattern, settings) of the job file path"""
+    with open(path, 'r', encoding='utf-8') as job_file:
+        job = json.load(job_file)
+    entries = []
+    for entry in job['files']:
+        if isinstance(entry, str):
+            entries.append((entry, {}))
+        else:
+            entries.append((entry['file'], entry.get('settings', {})))
+    return job.get('settings', {}), entries
+
+
+def expand(pattern, store=None):
+    """Files matching pattern, and the curves of the CurveStore store that do. A pattern that matches nothing
+    and has no wildcards is kept, so that the file is reported as missing."""
+    matches = sorted(glob.glob(pattern))
+    if store is not None:
+        matches += fnmatch.filter(store.names(kind='CF'), pattern)
+    if not matches and not glob.has_magic(pattern):
+        matches = [pattern]
+    return matches
+
+
+def apply_settings(settings, overrides):
+    for param, value in overrides.items():
+        settings.set_setting(param, value)
+
+
+def apply_copy(settings, overrides):
+    """Copy of settings with overrides applied"""
+    settings = copy.deepcopy(settings)
+    apply_settings(settings, overrides)
+    return settings
+
+
+def main(argv=None):
+    args = parse_args(argv)
+    settings = Settings.Settings()
+    try:
+        job_settings, entries = load_job(args.job) if args.job else ({}, [])
+        apply_settings(settings, job_settings)
+        for assignment in args.set:
+            param, _, value = assignment.partition('=')
+            settings.set_setting(param.strip(), value.strip())
+        if args.model:
+            settings.set_setting('NL_FITTING_METHOD', args.model)
+        if args.workers is not None:
+            settings.set_setting('WORKERS', args.workers)
+        if args.plot_workers is not None:
+            settings.set_setting('PLOT_WORKERS', args.plot_workers)
+        for param in settings.numeric_settings:  # Those of settings.dat are only checked here
+            settings.set_setting(param, getattr(settings, param))
+        workers = settings.WORKERS
+        plot_workers = settings.PLOT_WORKERS
+        for _, overrides in entries:  # Checked before anything is fitted
+            apply_copy(settings, overrides)
+    except (OSError, ValueError, KeyError, TypeError) as error:
+        print(f'Invalid job or settings: {type(error).__name__}: {error}', file=sys.stderr)
+        return EXIT_USAGE
+    if not args.patterns and not entries:
+        print('No files or job given. See --help.', file=sys.stderr)
+        return EXIT_USAGE
+
+    if args.backend is not None:
+        settings.RESULTS_TABLE = (args.table or settings.RESULTS_TABLE or 'fits.csv') \
+            if args.backend in ('csv', 'both') else ''
+        settings.RESULTS_DB = (args.db or settings.RESULTS_DB or 'results.db') \
+            if args.backend in ('sqlite', 'both') else ''
+    else:
+        settings.RESULTS_TABLE = args.table or settings.RESULTS_TABLE or 'fits.csv'  # Opt-out in batch
+        settings.RESULTS_DB = args.db if args.db is not None else settings.RESULTS_DB
+    settings.PLOT_GRAPHS = False  # Nothing is ever shown
+    settings.SAVE_GRAPHS = args.plot == 'save'
+    settings.WAIT = 0
+    settings.REPORT = args.report if args.report is not None else settings.REPORT
+    settings.STATS = args.stats if args.stats is not None else settings.STATS
+
+    import BatchRunner  # After the settings are checked, as it imports the whole fitting stack
+
+    # Files with the same settings are fitted together. Later entries of a file replace earlier ones.
+    file_settings = {}
+    store = BatchRunner.open_store(settings)
+    for pattern, overrides in [(pattern, {}) for pattern in args.patterns] + entries:
+        for file in expand(pattern, store):
+            file_settings.pop(file, None)
+            file_settings[file] = overrides
+    if not file_settings:
+        print('No files matched.', file=sys.stderr)
+        return EXIT_NO_FILES
+    groups = {}
+    for file, overrides in file_settings.items():
+        groups.setdefault(json.dumps(overrides, sort_keys=True), []).append(file)
+
+    n_failed = 0
+    fitted = set()
+    skipped = []
+    renderer = report = None
+    if settings.SAVE_GRAPHS:  # matplotlib is only imported if something is drawn
+        import PlotRenderer
+        renderer = PlotRenderer.RenderPool(plot_workers)
+    if settings.REPORT:
+        import Report
+        report = Report.Report(settings.REPORT, plot_workers)
+    with renderer or contextlib.nullcontext(), report or contextlib.nullcontext():
+        for i, (overrides, files) in enumerate(groups.items()):
+            group_settings = apply_copy(settings, json.loads(overrides))
+            if settings.JOURNAL and len(groups) > 1:  # Each group resumes on its own
+                group_settings.JOURNAL = f'{settings.JOURNAL}.{i}'
+            group_skipped = []
+            for file, fit, error in BatchRunner.run_batch(files, group_settings, workers, skipped=group_skipped):
+                if error is not None:
+                    print(f'Failed {file}: {error}', file=sys.stderr)
+                    n_failed += 1
+                    continue
+                fitted.add(file)
+                if renderer is not None:
+                    renderer.submit(fit)
+                if report is not None:
+                    report.add(fit)
+            if report is not None:  # The report shows the whole batch, including the files fitted before
+                for file, fit, error in BatchRunner.load_fits(group_skipped, group_settings, workers):
+                    if fit is not None:
+                        report.add(fit)
+            skipped += group_skipped
+        if renderer is not None:
+            for path, error in renderer.close():
+                print(f'Could not save {path}: {error}', file=sys.stderr)
+                n_failed += 1
+        if report is not None:
+            for file, error in report.close():
+                print(f'Could not add {file} to the report: {error}', file=sys.stderr)
+                n_failed += 1
+            print(f'Report: {settings.REPORT}, {report.n_pages} pages, {len(report.sheets)} contact sheets')
+
+    print(f'Done: {len(file_settings)} files, {len(fitted)} fitted, {len(skipped)} skipped as unchanged or already '
+          f'done, {n_failed} failures')
+    return EXIT_FAILED if n_failed else EXIT_OK
+
+
+if __name__ == '__main__':
+    sys.exit(main())
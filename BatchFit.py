@@ -0,0 +1,135 @@
+import numpy as np
+import Models
+
+
+def pad_curves(curves):
+    """Stacks a list of (GP, Eta) pairs of different lengths into two (n_curves, max_length) arrays. Returns GP, Eta
+    and a boolean mask that is False on the padding. Padding is filled with GP=1, Eta=1 so that the models stay
+    finite there."""
+    max_length = max(len(GP) for GP, Eta in curves)
+    GP = np.ones((len(curves), max_length))
+    Eta = np.ones((len(curves), max_length))
+    mask = np.zeros((len(curves), max_length), dtype=bool)
+    for i, (GP_i, Eta_i) in enumerate(curves):
+        GP[i, :len(GP_i)] = GP_i
+        Eta[i, :len(Eta_i)] = Eta_i
+        mask[i, :len(GP_i)] = True
+    return GP, Eta, mask
+
+
+def batch_fit(GP, Eta, model='Carreau', mask=None, p0=None, max_iter=200, ftol=1.5e-8, xtol=1.5e-8):
+    """Fits model, one of the names in Models.models, to every row of GP and Eta at once with a vectorized
+    Levenberg-Marquardt.
+    GP and Eta are (n_curves, n_points) arrays, mask marks the points that belong to each curve (see pad_curves)
+    and p0 is either one set of initial values for all curves or an (n_curves, n_params) array. By default
+    each curve starts from the values estimated from its own data (see Models.flow_curve_features). Like
+    lm_curvefit, all parameters are bounded below by 0.
+
+    Every iteration evaluates the residuals and Jacobians of all curves together and solves the damped normal
+    equations (J^T J + lambda diag(J^T J)) delta = -J^T r of each curve with one batched solve. Each curve keeps
+    its own damping and stops on its own once converged.
+
+    Returns params, param_errs, R2 and success. params and param_errs are (n_curves, n_params) arrays in the order
+    of Fitter.params, R2 is computed as in lm_curvefit and success is False for curves that did not converge or
+    whose covariance is singular, so that no curve flagged as a success has nan errors. As in lmfit, param_errs
+    are scaled by the reduced chi-square."""
+    flow_model = Models.get_model(model)
+    func, jac = flow_model.func, flow_model.jac
+
+    GP = np.atleast_2d(np.asarray(GP, dtype=float))
+    Eta = np.atleast_2d(np.asarray(Eta, dtype=float))
+    if mask is None:
+        mask = np.ones(GP.shape, dtype=bool)
+    weight = mask.astype(float)
+    n_curves = GP.shape[0]
+    n_params = len(flow_model.param_names)
+    n_points = weight.sum(axis=1)
+
+    x = np.empty((n_curves, n_params))
+    if p0 is None:
+        p0 = [flow_model.initial_guess(Models.flow_curve_features(GP_i[mask_i], Eta_i[mask_i]))
+              for GP_i, Eta_i, mask_i in zip(GP, Eta, mask)]
+    x[:] = p0
+    # Like lmfit, the lower bound is enforced by fitting u, with x = sqrt(u**2 + 1) - 1
+    u = np.sqrt((np.maximum(x, 0) + 1) ** 2 - 1)
+
+    def to_external(u):
+        return np.sqrt(u ** 2 + 1) - 1
+
+    def residuals(u, rows):
+        with np.errstate(all='ignore'):
+            x = to_external(u)
+            return (Eta[rows] - func(GP[rows], *[x[:, [j]] for j in range(n_params)])) * weight[rows]
+
+    def jacobian(u, rows):
+        """Jacobian of the residuals with respect to u"""
+        with np.errstate(all='ignore'):
+            x = to_external(u)
+            J = -jac(GP[rows], *[x[:, [j]] for j in range(n_params)]) * weight[rows][:, :, None]
+            J *= (u / np.sqrt(u ** 2 + 1))[:, None, :]
+        J[~np.isfinite(J)] = 0
+        return J
+
+    def cost(r):
+        c = np.sum(r ** 2, axis=1)
+        return np.where(np.isfinite(c), c, np.inf)
+
+    all_rows = np.arange(n_curves)
+    r = residuals(u, all_rows)
+    chisqr = cost(r)
+    lam = np.full(n_curves, 1e-3)
+    active = np.isfinite(chisqr)
+    success = np.zeros(n_curves, dtype=bool)
+    eye = np.eye(n_params)
+
+    for iteration in range(max_iter):
+        rows = all_rows[active]  # Only the curves still iterating are evaluated
+        if len(rows) == 0:
+            break
+        J = jacobian(u[rows], rows)
+        A = np.einsum('bni,bnj->bij', J, J)
+        g = np.einsum('bni,bn->bi', J, r[rows])
+        diag = np.einsum('bii->bi', A)
+        damped = A + (lam[rows, None] * np.maximum(diag, 1e-12))[:, :, None] * eye
+        try:
+            delta = np.linalg.solve(damped, -g[:, :, None])[:, :, 0]
+        except np.linalg.LinAlgError:  # At least one curve is singular, so solve them all in the least squares sense
+            delta = np.einsum('bij,bj->bi', np.linalg.pinv(damped), -g)
+        u_new = u[rows] + delta
+
+        r_new = residuals(u_new, rows)
+        chisqr_new = cost(r_new)
+        old = chisqr[rows]
+        predicted = -(2 * np.einsum('bi,bi->b', g, delta) + np.einsum('bi,bij,bj->b', delta, A, delta))
+        accepted = chisqr_new < old
+        # MINPACK's tests: both reductions below ftol on a successful step, or a relative step below xtol
+        converged = accepted & (predicted <= ftol * old) & (old - chisqr_new <= ftol * old)
+        converged |= accepted & (np.max(np.abs(delta) / (np.abs(u[rows]) + xtol), axis=1) <= xtol)
+
+        u[rows] = np.where(accepted[:, None], u_new, u[rows])
+        r[rows] = np.where(accepted[:, None], r_new, r[rows])
+        chisqr[rows] = np.where(accepted, chisqr_new, old)
+        lam[rows] = np.where(accepted, lam[rows] / 10, lam[rows] * 10)
+
+        success[rows] |= converged
+        active[rows] = ~converged & (lam[rows] < 1e16)
+
+    x = to_external(u)
+
+    # Covariance as lmfit reports it: inv(J^T J) of the external parameters, scaled by the reduced chi-square
+    with np.errstate(all='ignore'):
+        J = -jac(GP, *[x[:, [j]] for j in range(n_params)]) * weight[:, :, None]
+    J[~np.isfinite(J)] = 0
+    A = np.einsum('bni,bnj->bij', J, J)
+    param_errs = np.full((n_curves, n_params), np.nan)
+    invertible = np.linalg.cond(A) < 1 / np.finfo(float).eps
+    if invertible.any():
+        covar = np.linalg.inv(A[invertible])
+        red_chisqr = chisqr[invertible] / np.maximum(n_points[invertible] - n_params, 1)
+        param_errs[invertible] = np.sqrt(np.abs(np.einsum('bii->bi', covar)) * red_chisqr[:, None])
+
+    Eta_mean = np.sum(Eta * weight, axis=1) / n_points
+    SStot = np.sum(((Eta - Eta_mean[:, None]) * weight) ** 2, axis=1)
+    R2 = 1 - chisqr / SStot
+    success &= np.isfinite(param_errs).all(axis=1)
+    return x, param_errs, R2, success
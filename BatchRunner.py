@@ -0,0 +1,271 @@
+import contextlib
+import os
+import time
+import traceback
+from multiprocessing import Pool
+from RheoFCClass import Fitter, FileManip, BufferedFileManip, BatchFileManip
+from FitCache import FitCache
+from CurveStore import CurveStore
+from ResultsSink import ResultsSink
+from ResultsDB import ResultsDB
+from Manifest import Manifest
+from Journal import Journal, Progress
+from FitStats import StatsWriter
+import ExportReader
+import Models
+
+# Settings, cache and curve store of the worker processes, set up once when each worker starts.
+_worker_settings = None
+_worker_cache = None
+_worker_store = None
+
+
+def open_cache(settings):
+    """The FitCache described by settings, or None if CACHE_DIR is empty."""
+    if not settings.CACHE_DIR:
+        return None
+    return FitCache(settings.CACHE_DIR, settings.CACHE_MAX_MB)
+
+
+def open_store(settings):
+    """The CurveStore the previously extracted curves are read from, or None if they are read from CSV files."""
+    if not settings.PREV_EXTRACTED or not settings.CURVE_STORE or not CurveStore.exists(settings.CURVE_STORE):
+        return None
+    return CurveStore(settings.CURVE_STORE)
+
+
+def open_sinks(settings):
+    """The results backends settings asks for: a ResultsSink for RESULTS_TABLE and a ResultsDB, with a new run
+    started, for RESULTS_DB."""
+    sinks = []
+    if settings.RESULTS_TABLE:
+        sinks.append(ResultsSink(settings.RESULTS_TABLE))
+    if settings.RESULTS_DB:
+        database = ResultsDB(settings.RESULTS_DB)
+        database.start_run(settings)
+        sinks.append(database)
+    return sinks
+
+
+def prune_stale(manifest, settings):
+    """Removes what was recorded for the files in manifest that no longer exist: their plots, their rows in the
+    results table and in <model>.csv, and their fits in the results database. Returns the files removed from the
+    manifest. The linear fits in results.csv are recorded as 'linear', not under the file name, so they stay."""
+    stale = manifest.stale()
+    outputs = manifest.remove(stale)
+    if not outputs:
+        return stale
+    for output in outputs:
+        plot = output[:-4] + '.png'  # As plot_error_graphs names it
+        if os.path.isfile(plot):
+            os.remove(plot)
+    for table in [settings.RESULTS_TABLE] + [model + '.csv' for model in Models.models]:
+        if table and os.path.isfile(table):  # Every row starts with the name of the fit
+            ResultsSink.remove_files(table, outputs)
+    if settings.RESULTS_DB and os.path.isfile(settings.RESULTS_DB):
+        with ResultsDB(settings.RESULTS_DB) as database:
+            database.remove_files(outputs)
+    return stale
+
+
+def _init_worker(settings):
+    global _worker_settings, _worker_cache, _worker_store
+    _worker_settings = settings
+    _worker_cache = open_cache(settings)
+    _worker_store = open_store(settings)
+
+
+def _fit_curve(file, settings, cache, data=None, segment=None):
+    """Fits one curve without writing anything. Returns the file name, the Fitter (None if it failed), the error
+    message (None if it succeeded) and the buffered record_fit/logger calls."""
+    manip = BufferedFileManip()
+    try:
+        fit = Fitter(file, settings, do_fit=True, manip=manip, cache=cache, data=data, segment=segment)
+    except (ValueError, KeyError) as error:
+        return file, None, f'{type(error).__name__}: {error}', manip.records
+    except Exception as error:  # One bad file must not stop the whole batch
+        manip.logger(file, 'Generic', traceback.format_exc())
+        return file, None, f'{type(error).__name__}: {error}', manip.records
+    fit.manip = FileManip()  # Nothing left to buffer, and the records travel separately
+    fit.cache = None
+    return file, fit, None, manip.records
+
+
+def _fit_file(file, settings=None, cache=None, store=None):
+    """Reads and fits one file. Returns a list of _fit_curve results: one for the whole file or, with
+    SPLIT_SEGMENTS, one per flow curve segment, all read from a single pass over the file. Curves in store are
+    loaded from it."""
+    if settings is None:
+        settings = _worker_settings
+        cache = _worker_cache
+        store = _worker_store
+    if store is not None and file in store:
+        return [_fit_curve(file, settings, cache, data=store.flow_curve(file))]
+    if not settings.SPLIT_SEGMENTS or settings.PREV_EXTRACTED:
+        return [_fit_curve(file, settings, cache)]
+    try:
+        curves = ExportReader.flow_curves(file)
+    except OSError as error:
+        return [(file, None, f'{type(error).__name__}: {error}', [])]
+    if len(curves) == 0:  # Fails with the usual message
+        return [_fit_curve(file, settings, cache)]
+    if len(curves) == 1:  # Nothing to split, so it is recorded under its own name as before
+        return [_fit_curve(file, settings, cache, data=curves[0][1:])]
+    return [_fit_curve(file, settings, cache, data=(GP, Eta), segment=segment_id)
+            for segment_id, GP, Eta in curves]
+
+
+def _fit_files(files, settings, workers):
+    """The _fit_file results of files, in order, and the Pool they are fitted in (None if they are fitted in this
+    process). workers is as in run_batch."""
+    if workers == 0:
+        workers = os.cpu_count()
+    workers = min(workers, len(files))
+    if workers <= 1:
+        cache = open_cache(settings)
+        store = open_store(settings)
+        return (_fit_file(file, settings, cache, store) for file in files), None
+    chunksize = max(1, len(files) // (workers * 4))
+    pool = Pool(workers, initializer=_init_worker, initargs=(settings,))
+    return pool.imap(_fit_file, files, chunksize), pool
+
+
+def load_fits(files, settings, workers=1):
+    """Fits files without recording anything anywhere, to draw the fits of files run_batch skipped because an
+    earlier run recorded them. With CACHE_DIR set, those are read back from the cache instead of fitted again.
+    Yields (file, fit, error) as run_batch does."""
+    if len(files) == 0:
+        return
+    results, pool = _fit_files(files, settings, workers)
+    try:
+        for file_results in results:
+            for file, fit, error, _ in file_results:
+                yield file, fit, error
+    finally:
+        if pool is not None:
+            pool.terminate()
+
+
+def run_batch(files, settings, workers=1, checkpoint_every=50, skipped=None):
+    """Fits every file in files, in a pool of workers processes (0 for one per core, 1 to fit in this process).
+    Yields (file, fit, error) in the order of files, once per file or, with SPLIT_SEGMENTS, once per flow curve
+    segment. fit is the Fitter, or None if the file could not be fitted, in which case error says why.
+    The workers never write: what they would have written with record_fit and logger is sent back and replayed
+    here, one file at a time, into a BatchFileManip, so the results files and the log are never interleaved and
+    each of them is opened once per checkpoint.
+    Every fit, or failure, is also added to the results backends of open_sinks. The progress, throughput and
+    time left are printed as the files are done.
+    If CACHE_DIR is set, files whose data and settings were already fitted are read from the cache, and the
+    number of hits and misses is printed at the end.
+    If MANIFEST is set, only files that are new or changed since they were fitted with the same settings are
+    fitted, the others are left out, and with PRUNE_STALE, the results of files that no longer exist are removed.
+    The files left out, as unchanged or as already done by the journal, are appended to skipped, if it is a list.
+    Nothing is yielded for them; load_fits gives their fits back.
+    Every checkpoint_every files (or 30 s), and at the end, what is kept in memory is written: the results files,
+    the results backends, the manifest, the stats and, last, the journal.
+    If JOURNAL is set, the files done are recorded in that Journal at every checkpoint, after the rest is written,
+    so a batch that was killed resumes with the files it had not finished. Only a batch with the same files and
+    settings resumes, and files changed since are fitted again. A file is done once the caller is done with what
+    was yielded for it.
+    If STATS is set, the FitStats of every fit, taken once the caller is done with it so that its plots are
+    counted, are written to that StatsWriter, as JSON lines or, for a .prom file, as Prometheus metrics, which
+    are rewritten at every checkpoint so that a running batch can be monitored."""
+    settings_hash = FitCache.settings_hash(settings)
+    batch_id = Journal.batch_id(settings_hash, files)  # Of all the files given, before any is left out
+    manifest = None
+    if settings.MANIFEST:
+        manifest = Manifest(settings.MANIFEST)
+        if settings.PRUNE_STALE:
+            stale = prune_stale(manifest, settings)
+            if stale:
+                print(f'Removed the results of {len(stale)} files that no longer exist')
+        n_files = len(files)
+        unchanged = {file for file in files if os.path.isfile(file) and manifest.is_current(file, settings_hash)}
+        if skipped is not None:
+            skipped += [file for file in files if file in unchanged]
+        files = [file for file in files if file not in unchanged]
+        print(f'{n_files - len(files)} of {n_files} files are unchanged and were not fitted again')
+        manifest.save()
+
+    journal = None
+    if settings.JOURNAL:
+        journal = Journal(settings.JOURNAL, batch_id)
+        if journal.completed:
+            n_files = len(files)
+            done = {file for file in files if journal.is_done(file)}
+            if skipped is not None:
+                skipped += [file for file in files if file in done]
+            files = [file for file in files if file not in done]
+            print(f'Resuming the interrupted batch: {n_files - len(files)} files were already done')
+
+    if len(files) == 0:
+        if journal is not None:
+            journal.finish()
+        return
+
+    hits = misses = 0
+    sinks = open_sinks(settings)
+    legacy = BatchFileManip()
+    stats_writer = StatsWriter(settings.STATS) if settings.STATS else None
+    progress = Progress(len(files))
+    last_checkpoint = time.perf_counter()
+    since_checkpoint = 0  # Files done
+
+    def checkpoint():
+        legacy.flush()
+        for sink in sinks:
+            sink.flush()
+        if manifest is not None:
+            manifest.save()
+        if stats_writer is not None:
+            stats_writer.flush()
+        if journal is not None:
+            journal.commit()
+
+    results, pool = _fit_files(files, settings, workers)
+
+    finished = False
+    try:
+        for file_results in results:
+            for file, fit, error, records in file_results:
+                with fit.stats.stage('record') if fit is not None else contextlib.nullcontext():
+                    BufferedFileManip.flush(records, legacy)
+                    for sink in sinks:
+                        sink.add_fit(file, fit, error)
+                if fit is not None:
+                    hits += fit.cache_hit
+                    misses += not fit.cache_hit
+                yield file, fit, error
+                if stats_writer is not None:
+                    if fit is not None:
+                        stats_writer.add(fit.stats)
+                    else:
+                        stats_writer.add_failure(file, error)
+            # Failed files are fitted again next time
+            if manifest is not None and os.path.isfile(file) and all(fit is not None for _, fit, _, _ in file_results):
+                manifest.record(file, settings_hash, [fit.filename for _, fit, _, _ in file_results])
+            progress.update()
+            if journal is not None:
+                journal.complete(file)
+            since_checkpoint += 1
+            if since_checkpoint >= checkpoint_every or time.perf_counter() - last_checkpoint > 30:
+                checkpoint()
+                since_checkpoint = 0
+                last_checkpoint = time.perf_counter()
+        finished = True
+    finally:
+        checkpoint()
+        for sink in sinks:
+            sink.close()
+        if stats_writer is not None:
+            stats_writer.close()
+        if journal is not None:
+            if finished:
+                journal.finish()
+            else:
+                journal.close()
+        if pool is not None:
+            pool.terminate()
+
+    if settings.CACHE_DIR:
+        print(f'Cache: {hits} hits, {misses} misses')
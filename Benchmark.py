@@ -0,0 +1,233 @@
+import argparse
+import contextlib
+import copy
+import io
+import json
+import os
+import platform
+import sys
+import tempfile
+import time
+import numpy as np
+import Settings
+import Models
+from RheoFCClass import Fitter, BufferedFileManip
+import PlotRenderer
+from ResultsSink import ResultsSink
+import FitStats
+
+STAGES = [stage for stage in FitStats.STAGES if stage not in ('cache', 'report')]  # Neither is used here
+CASES = ['outliers', 'no_plateau', 'newtonian', 'short', 'noisy']  # Pathological curves
+
+
+# ---------------SYNTHETIC CURVES------
+
+def synthetic_curve(rng, model='Carreau', n_points=40, noise=0.02, plateau=0.3, case=None):
+    """A flow curve of model with random parameters, drawn from the numpy Generator rng, as (GP, Eta, params).
+    GP spans 3 to 6 decades in n_points, and the first plateau fraction of them (in log scale) are before the
+    shear thinning starts. Eta has a relative noise of noise. case makes it one of the pathological CASES:
+    a few points off by a factor of 3 to 10, the shear thinning starting before the first point, almost no shear
+    thinning, 6 points only, or 15 times the noise."""
+    if case == 'short':
+        n_points = 6
+    elif case == 'noisy':
+        noise *= 15
+    elif case == 'no_plateau':
+        plateau = -0.3
+    GP = np.logspace(rng.uniform(-3, -1), rng.uniform(2, 3), n_points)
+    GP_b = GP[0] * (GP[-1] / GP[0]) ** plateau  # Shear rate where the shear thinning starts
+    eta_0 = 10 ** rng.uniform(-2, 5)
+    eta_inf = eta_0 * 10 ** rng.uniform(-5, -2)
+    if model == 'Carreau':
+        params = [eta_0, eta_inf, GP_b, rng.uniform(0.3, 1.2)]
+    elif model == 'Cross':
+        params = [eta_0, eta_inf, GP_b, rng.uniform(0.4, 1)]
+    elif model == 'Carreau-Yasuda':
+        # As fit_CarreauYasuda is written, n > 1 is shear thinning (see Models.guess_CarreauYasuda)
+        params = [eta_0, eta_inf, 1 / GP_b, rng.uniform(0.5, 2), rng.uniform(1.2, 2.0)]
+    elif model == 'PowerLaw':
+        params = [eta_0, rng.uniform(0.2, 0.9)]
+    else:
+        raise NameError(f'Did not understand model {model}')
+    if case == 'newtonian':  # Shear thinning index close to that of a Newtonian fluid
+        params[-1] = {'Carreau-Yasuda': 1 + 0.01, 'PowerLaw': 1 - 0.01}.get(model, 0.01)
+    Eta = Models.get_model(model).func(GP, *params) * (1 + noise * rng.standard_normal(n_points))
+    if case == 'outliers':
+        points = rng.choice(n_points, size=3, replace=False)
+        Eta[points] *= rng.uniform(3, 10, size=3) ** rng.choice([-1, 1], size=3)
+    return GP, np.abs(Eta), params
+
+
+def write_export(fname, GP, Eta):
+    """Writes GP and Eta as a RheoWin text export with a single flow curve, as ExportReader reads them"""
+    lines = [';Meas. Pts.;GP;Tau;Eta', ';;[1/s];[Pa];[Pa·s]']
+    for i, (gp, eta) in enumerate(zip(GP, Eta)):
+        lines.append(f'{i + 1};{i + 1};{gp:.6g};{gp * eta:.6g};{eta:.6g}'.replace('.', ','))
+    with open(fname, 'w', encoding='latin1') as export:
+        export.write('\n'.join(lines) + '\n')
+
+
+def generate(directory, n_curves, seed=0, models=None, points=(20, 60), noise=0.02, plateau=(0.1, 0.5),
+             pathological=0.1):
+    """Writes n_curves synthetic exports to directory, the same for the same arguments. Each curve has a model
+    from models, between points[0] and points[1] points and a plateau fraction in plateau, and a fraction
+    pathological of them is one of the CASES. Returns a list of (file, model, case, params)."""
+    rng = np.random.default_rng(seed)
+    models = models or list(Models.models)
+    curves = []
+    for i in range(n_curves):
+        model = models[i % len(models)]
+        case = CASES[rng.integers(len(CASES))] if rng.random() < pathological else None
+        GP, Eta, params = synthetic_curve(rng, model, int(rng.integers(points[0], points[1] + 1)), noise,
+                                          rng.uniform(*plateau), case)
+        fname = os.path.join(directory, f'synthetic_{i:05d}.txt')
+        write_export(fname, GP, Eta)
+        curves.append((fname, model, case, params))
+    return curves
+
+
+# ---------------BENCHMARK------
+
+def run_curve(fname, settings, renderer, sink):
+    """Fits fname as the batch does and returns the Fitter and the time of each of the STAGES it went through, in
+    s, as its FitStats recorded them: parse reads the export, the scans are the automatic fits asked for by DO_LIN
+    and DO_NL, uncertainty is the data of the plot (the propagated uncertainty of the curve), plot saves it if
+    renderer is not None and record writes the fit."""
+    manip = BufferedFileManip()
+    fit = Fitter(fname, settings, do_fit=True, manip=manip)
+    data = PlotRenderer.plot_data(fit)
+    if renderer is not None:
+        with fit.stats.stage('plot'):
+            renderer.render(data)
+    with fit.stats.stage('record'), contextlib.redirect_stdout(io.StringIO()):  # record_fit prints every fit
+        BufferedFileManip.flush(manip.records)
+        sink.add_fit(fname, fit)
+    return fit, {stage: seconds for stage, seconds in fit.stats.stages.items() if stage in STAGES}
+
+
+def percentiles(values):
+    """Mean, median, 90th and 99th percentiles and maximum of values, in ms"""
+    values = np.asarray(values) * 1000
+    return {'mean': float(np.mean(values)), 'p50': float(np.percentile(values, 50)),
+            'p90': float(np.percentile(values, 90)), 'p99': float(np.percentile(values, 99)),
+            'max': float(np.max(values))}
+
+
+def benchmark(settings, n_curves=200, seed=0, models=None, points=(20, 60), noise=0.02, plateau=(0.1, 0.5),
+              pathological=0.1, plot=True):
+    """Generates n_curves synthetic curves (see generate) in a temporary folder and fits each with the model it
+    was made with, timing each stage. Returns the results as a dict: the configuration, curves/s over all the
+    stages, the latency percentiles of each stage in ms, the failures and the median relative error of eta_0
+    (or k) on the curves that are not pathological."""
+    config = {'n_curves': n_curves, 'seed': seed, 'models': models or list(Models.models), 'points': list(points),
+              'noise': noise, 'plateau': list(plateau), 'pathological': pathological, 'plot': plot,
+              'DO_LIN': settings.DO_LIN, 'DO_NL': settings.DO_NL, 'NL_SCAN_MODE': settings.NL_SCAN_MODE,
+              'ANALYTIC_JAC': settings.ANALYTIC_JAC, 'LOG_FIT': settings.LOG_FIT, 'DATA_GUESS': settings.DATA_GUESS}
+    model_settings = {}
+    for model in config['models']:
+        model_settings[model] = copy.deepcopy(settings)
+        model_settings[model].set_setting('NL_FITTING_METHOD', model)
+        model_settings[model].PREV_EXTRACTED = False  # The curves are written as RheoWin exports
+        model_settings[model].AUTO_LIN = model_settings[model].AUTO_NL = True
+    stage_times = {stage: [] for stage in STAGES}
+    failed = {}
+    errors = []
+    cwd = os.getcwd()
+    with tempfile.TemporaryDirectory() as directory:
+        os.chdir(directory)  # The fits are recorded in the working folder
+        try:
+            curves = generate(directory, n_curves, seed, config['models'], points, noise, plateau, pathological)
+            renderer = PlotRenderer.PlotRenderer() if plot else None
+            start = time.perf_counter()
+            with ResultsSink('fits.csv') as sink:
+                for fname, model, case, params in curves:
+                    try:
+                        fit, times = run_curve(fname, model_settings[model], renderer, sink)
+                    except Exception as error:  # Pathological curves may not be fitted at all
+                        failed[os.path.basename(fname)] = f'{case}: {type(error).__name__}: {error}'
+                        continue
+                    for stage, seconds in times.items():
+                        stage_times[stage].append(seconds)
+                    if case is None and fit.nl_done:
+                        errors.append(abs(fit.params[0] - params[0]) / params[0])
+            total = time.perf_counter() - start
+        finally:
+            os.chdir(cwd)
+    return {'date': time.strftime('%Y-%m-%d %H:%M:%S'), 'python': sys.version.split()[0],
+            'platform': platform.platform(), 'config': config, 'total_s': total,
+            'curves_per_s': n_curves / total if total > 0 else 0.,
+            'stages': {stage: percentiles(times) for stage, times in stage_times.items() if times},
+            'failed': failed, 'eta_0_median_rel_error': float(np.median(errors)) if errors else None}
+
+
+def compare(result, baseline, tolerance=0.2, min_ms=1.):
+    """Regressions of result against baseline, as a list of messages: curves/s lower, or a median or 90th
+    percentile latency of a stage higher, by more than tolerance (a fraction of the baseline). Latencies up by
+    less than min_ms are timer noise, not regressions."""
+    regressions = []
+    if result['curves_per_s'] < baseline['curves_per_s'] * (1 - tolerance):
+        regressions.append(f"curves/s: {result['curves_per_s']:.2f} against {baseline['curves_per_s']:.2f}")
+    for stage, latencies in result['stages'].items():
+        for statistic in ('p50', 'p90'):
+            old = baseline['stages'].get(stage, {}).get(statistic)
+            if old is not None and latencies[statistic] > max(old * (1 + tolerance), old + min_ms):
+                regressions.append(f'{stage} {statistic}: {latencies[statistic]:.2f} ms against {old:.2f} ms')
+    return regressions
+
+
+def print_result(result):
+    print(f"{result['config']['n_curves']} curves in {result['total_s']:.2f} s, {result['curves_per_s']:.2f} "
+          f"curves/s, {len(result['failed'])} failed. Median relative error of eta_0: "
+          f"{result['eta_0_median_rel_error']}")
+    print(f'{"stage":<16}' + ''.join(f'{statistic + " (ms)":>12}' for statistic in ('mean', 'p50', 'p90', 'p99')))
+    for stage, latencies in result['stages'].items():
+        print(f'{stage:<16}' + ''.join(f'{latencies[statistic]:>12.2f}' for statistic in ('mean', 'p50', 'p90', 'p99')))
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Fits reproducible synthetic flow curves with the settings of '
+                                                 'settings.dat and times each stage of the fit.')
+    parser.add_argument('--curves', type=int, default=200, help='number of curves. Default: 200')
+    parser.add_argument('--seed', type=int, default=0, help='seed of the generator. Default: 0')
+    parser.add_argument('--models', nargs='+', choices=list(Models.models), help='models the curves are made '
+                        'with, in turns, and fitted with. Default: all of them')
+    parser.add_argument('--points', type=int, nargs=2, default=[20, 60], metavar=('MIN', 'MAX'),
+                        help='points per curve. Default: 20 60')
+    parser.add_argument('--noise', type=float, default=0.02, help='relative noise of Eta. Default: 0.02')
+    parser.add_argument('--plateau', type=float, nargs=2, default=[0.1, 0.5], metavar=('MIN', 'MAX'),
+                        help='fraction of the curve before the shear thinning. Default: 0.1 0.5')
+    parser.add_argument('--pathological', type=float, default=0.1,
+                        help=f'fraction of the curves made pathological ({", ".join(CASES)}). Default: 0.1')
+    parser.add_argument('--no-plot', action='store_true', help='do not time saving the plots')
+    parser.add_argument('--output', help='JSON file the results are written to')
+    parser.add_argument('--baseline', help='JSON results of an earlier run. Regressions are listed, and the '
+                                           'exit status is 1 if there are any')
+    parser.add_argument('--tolerance', type=float, default=0.2,
+                        help='slowdown against the baseline taken as a regression, as a fraction. Default: 0.2')
+    args = parser.parse_args(argv)
+
+    settings = Settings.Settings()
+    settings.DEBUG = False
+    settings.PREV_EXTRACTED = False
+    result = benchmark(settings, args.curves, args.seed, args.models, tuple(args.points), args.noise,
+                       tuple(args.plateau), args.pathological, plot=not args.no_plot)
+    print_result(result)
+    if args.output:
+        with open(args.output, 'w', encoding='utf-8') as output:
+            json.dump(result, output, indent=1)
+    if args.baseline:
+        with open(args.baseline, 'r', encoding='utf-8') as baseline_file:
+            baseline = json.load(baseline_file)
+        if baseline['config'] != result['config']:
+            print('Warning: the baseline was run with another configuration, the results may not compare')
+        regressions = compare(result, baseline, args.tolerance)
+        for regression in regressions:
+            print(f'Regression: {regression}')
+        if regressions:
+            return 1
+        print(f'No regressions against {args.baseline}')
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,112 @@
+import glob
+import json
+import os
+import numpy as np
+
+
+class CurveStore:
+    """Append-only store of the curves extracted by DataExtraction, kept as float arrays so that they are loaded
+    without parsing any text.
+    Each call to add_batch writes one compressed NPZ file, batch_<n>.npz, with the curves of that batch, and then
+    appends one line per curve to index.jsonl: its name, sample, kind ('CF' flow curve, 'OT' stress sweep, 'OF'
+    frequency sweep), replicate number, columns, number of rows, and the batch file and key it is stored under.
+    A curve is named after the CSV file DataExtraction used to write for it, <kind>_<sample>--<replicate>.csv, so
+    fits of stored curves are recorded and plotted under the same names as before."""
+    INDEX = 'index.jsonl'
+
+    def __init__(self, directory='curves'):
+        self.directory = directory
+        self.entries = []
+        self._by_name = {}
+        self._batches = {}  # Batch files already opened by load
+        try:
+            with open(os.path.join(directory, self.INDEX), 'r', encoding='utf-8') as index:
+                for line in index:
+                    try:
+                        self._add_entry(json.loads(line))
+                    except ValueError:  # Cut short by a killed run. Its batch file is complete, but unused.
+                        continue
+        except FileNotFoundError:
+            pass
+
+    @classmethod
+    def exists(cls, directory):
+        return os.path.isfile(os.path.join(directory, cls.INDEX))
+
+    def _add_entry(self, entry):
+        self.entries.append(entry)
+        self._by_name[entry['name']] = entry
+
+    def _next_batch(self):
+        numbers = [int(os.path.basename(path)[6:-4]) for path in glob.glob(os.path.join(self.directory, 'batch_*.npz'))
+                   if os.path.basename(path)[6:-4].isdigit()]
+        return f'batch_{max(numbers, default=-1) + 1}.npz'
+
+    def add_batch(self, curves):
+        """Stores curves, a list of (sample, kind, columns, values), values being a 2D float array with a column
+        for each name in columns. Each curve is given the next replicate number of its sample and kind.
+        Returns the names of the stored curves."""
+        if len(curves) == 0:
+            return []
+        os.makedirs(self.directory, exist_ok=True)
+        batch = self._next_batch()
+        replicates = {}
+        for entry in self.entries:
+            key = (entry['sample'], entry['kind'])
+            replicates[key] = max(replicates.get(key, 0), entry['replicate'] + 1)
+
+        arrays = {}
+        new_entries = []
+        for i, (sample, kind, columns, values) in enumerate(curves):
+            replicate = replicates.get((sample, kind), 0)
+            replicates[(sample, kind)] = replicate + 1
+            arrays[f'curve_{i}'] = np.asarray(values, dtype=float)
+            new_entries.append({'name': f'{kind}_{sample}--{replicate}.csv', 'sample': sample, 'kind': kind,
+                                'replicate': replicate, 'columns': list(columns), 'rows': len(values),
+                                'batch': batch, 'key': f'curve_{i}'})
+
+        # The batch is complete before the index points to it
+        temp_path = os.path.join(self.directory, f'{batch}.{os.getpid()}.tmp')
+        with open(temp_path, 'wb') as batch_file:
+            np.savez_compressed(batch_file, **arrays)
+        os.replace(temp_path, os.path.join(self.directory, batch))
+        with open(os.path.join(self.directory, self.INDEX), 'a', encoding='utf-8') as index:
+            for entry in new_entries:
+                index.write(json.dumps(entry) + '\n')
+                self._add_entry(entry)
+        return [entry['name'] for entry in new_entries]
+
+    def select(self, sample=None, kind=None, replicate=None):
+        """Entries of the stored curves, in the order they were added, filtered by whatever is not None"""
+        return [entry for entry in self.entries
+                if (sample is None or entry['sample'] == sample) and (kind is None or entry['kind'] == kind)
+                and (replicate is None or entry['replicate'] == replicate)]
+
+    def names(self, kind=None):
+        return [entry['name'] for entry in self.select(kind=kind)]
+
+    def __contains__(self, name):
+        return name in self._by_name
+
+    def load(self, name):
+        """Columns and values of the curve name. Raises KeyError if there is no such curve."""
+        entry = self._by_name[name]
+        if entry['batch'] not in self._batches:
+            self._batches[entry['batch']] = np.load(os.path.join(self.directory, entry['batch']))
+        return entry['columns'], self._batches[entry['batch']][entry['key']]
+
+    def flow_curve(self, name):
+        """GP and Eta of the curve name, from the rows where every column is positive, as ExtractData_pd reads
+        them from a CSV file."""
+        columns, values = self.load(name)
+        col_GP = max(i for i, column in enumerate(columns) if 'GP' in column)
+        col_Eta = max(i for i, column in enumerate(columns) if 'Eta' in column)
+        values = values[(values > 0).all(axis=1)]
+        return values[:, col_GP], values[:, col_Eta]
+
+    def to_csv(self, name, fname=None):
+        """Writes the curve name to a CSV file in the format DataExtraction used, to fname or to its name."""
+        import pandas as pd
+        columns, values = self.load(name)
+        pd.DataFrame(values, columns=columns).to_csv(fname or name, sep=';', encoding='utf8', index=False,
+                                                      decimal=',')
@@ -3,7 +3,27 @@
 import pandas as pd
 import glob
 import numpy as np
-import os
+import sys
+import ExportReader
+from CurveStore import CurveStore
+
+def classify_oscillatory(w, labels, w_OT):
+    """Splits the oscillatory rows, with frequencies w and (sorted, integer) row labels, into the stress sweep,
+    done at the single frequency w_OT, and the frequency sweep, which is everything else. A frequency sweep that
+    passes through w_OT leaves an isolated point behind, which is given back to it when the rows right before and
+    after it are frequency sweep too. As the loop this replaces did, only labels below len(w) are looked at.
+    Returns the two boolean masks."""
+    mask_OT = np.asarray(w == w_OT)
+    mask_OF = ~mask_OT
+    if len(w) < 3 or not np.issubdtype(labels.dtype, np.integer):
+        return mask_OT, mask_OF
+    middle = labels[1:-1]
+    isolated = (mask_OF[:-2] & mask_OF[2:] & ~mask_OF[1:-1]  # Runs of one point...
+                & (labels[:-2] == middle - 1) & (labels[2:] == middle + 1)  # ...between adjacent rows
+                & (middle < len(w)))
+    mask_OF[1:-1] |= isolated
+    return mask_OT, mask_OF
+
 
 # todo: Have the program detect the parameters that are in the file before anything.
 #       This will remove the problems associated with files not having a 
@@ -24,51 +44,31 @@ def extraction(df, nome=''):
     if df_osc.size != 0:  # Checa se tem dado de oscilatório
         ## Oscilatório Tensão
         contagem_w_OT = df_osc['w'].value_counts() # Conta quantas vezes um valor de freq se repetiu
-        if contagem_w_OT.size == 0: # Matriz vazia
-            w_mais_freq_OT = pd.Series([])
-            df_OT = None # Sem qualquer dado oscilatório
-        elif contagem_w_OT.max() == 1:  # Não repete nenhum valor
-            df_OT = None  # Sem dado de Osc Tens
+        if contagem_w_OT.max() == 1:  # Não repete nenhum valor
             w_mais_freq_OT = 0  # Coloca um valor para comparar
         else:
             w_mais_freq_OT = contagem_w_OT.idxmax() # Valor de freq que mais repete (1 Hz): indica Osc Tens
-            indice_w_mais_freq = contagem_w_OT.max()
+        df_OT_m, df_OF_m = classify_oscillatory(df_osc['w'].to_numpy(), df_osc.index.to_numpy(), w_mais_freq_OT)
 
-            df_OT_m = df_osc['w'] == w_mais_freq_OT  # Criar máscara para o Osc Tens
-            df_OT = df_osc[df_OT_m]  # Aplicar a máscara.  #### Problema aqui!
+        if contagem_w_OT.max() == 1:
+            df_OT = None  # Sem dado de Osc Tens
+        else:
+            df_OT = df_osc[df_OT_m]  # Aplicar a máscara.
             df_OT = df_OT[['Tau', 'G1', 'G2', 'T']]  # Separa só os valores de interesse
 
             if df_OT.index[-1] - 1 != df_OT.index[-2]: # É possível que haja uma coincidencia e repita um valor de Freq.
-                #df_OT = df_OT.drop(index = df_OT.index[-1]) # Remove último ponto se ele não for contínuo com o anterior
                 df_OT = df_OT.drop(df_OT.index[-1])
 
             df_OT = df_OT.add_prefix(nome)  # Coloca o nome para exportação
 
         ## Frequencia
-        
-        
-        if contagem_w_OT.size != 0: # Revisar aqui
-            df_OF_m = df_osc['w'] != w_mais_freq_OT # complementar ao Osc Tens
-        else:
-            df_OF_m = [] # Matriz vazia
-
-        for i, item in enumerate(df_OF_m):
-            try:
-                if df_OF_m[i-1] == True and df_OF_m[i+1] == True and df_OF_m[i] == False:
-                    df_OF_m[i] = True
-            except KeyError:
-                pass
-            except IndexError:
-                pass
-                
         df_OF = df_osc[df_OF_m]
         df_OF = df_OF[['w', 'G1', 'G2', 'T']]
         df_OF = df_OF.add_prefix(nome)
 
         if df_OF.size == 0:
             df_OF = None
-        elif (df_OF.index[0] + 1) != df_OF.index[1]: # É possível que haja uma coincidencia e repita um valor de Freq.
-            #df_OF = df_OF.drop(index = df_OF.index[-1]) # Remove primeiro ponto se ele não for contínuo com o próximo
+        elif len(df_OF) > 1 and (df_OF.index[0] + 1) != df_OF.index[1]: # É possível que haja uma coincidencia e repita um valor de Freq.
             df_OF = df_OF.drop(df_OF.index[-1])
     else:
         df_OT = None
@@ -76,41 +76,47 @@ def extraction(df, nome=''):
     
     return df_CF, df_OT, df_OF
 
-    
-def main():
+
+def read_export(arq, names):
+    """Reads a RheoWin export with ExportReader.iter_blocks, which keeps memory bounded and parses the numbers as
+    floats, into a DataFrame with the columns named by position, as pd.read_csv(names=names) would. The first name
+    is the row number, which is not kept. Blank fields are NaN.
+    The array is sized from the number of lines of the file and filled one block at a time, so only the frame and
+    one block are ever in memory."""
+    width = len(names) - 1
+    values = np.full((ExportReader.count_lines(arq), width), np.nan)
+    row = 0
+    for block in ExportReader.iter_blocks(arq):
+        n_columns = min(block.values.shape[1], width)
+        values[row:row + len(block.values), :n_columns] = block.values[:, :n_columns]
+        row += len(block.values)
+    return pd.DataFrame(values[:row], columns=names[1:])  # Headers and comments are counted, but have no rows
+
+
+def main(store_dir='curves', export_csv=False):
+    """Extracts the curves of every .txt export in the folder into the CurveStore in store_dir, all in one batch.
+    With export_csv (--csv on the command line), each curve is also written to its own CF_/OT_/OF_ CSV file."""
     nomes = [arq.split(' ')[0] for arq in glob.glob('*.txt')]
     arquivos = glob.glob('*.txt')
+    curvas = []
 
     for nome, arq in zip(nomes, arquivos):
         print('Tratando {0}'.format(arq))
-        try:
-            pd_temp = pd.read_csv(arq, delimiter=';', header=4, 
-                        names=["serie", "GP", "Eta", "w", "G1", "G2", "T", "Tau", 'lixo'], encoding='latin1', decimal=',')
-        except:
-            pd_temp = pd.read_csv(arq, delimiter=';', header=4, 
-                        names=["serie", "GP", "Tau", "GP", "Eta", "t", "t_seg", "lixo"], encoding='latin1', decimal=',')
-        
-        
+        pd_temp = read_export(arq, names=["serie", "GP", "Eta", "w", "G1", "G2", "T", "Tau", 'lixo'])
+
         temp_CF, temp_OT, temp_OF = extraction(pd_temp, nome=nome + ' ')
 
-        if type(temp_CF) != type(None):
-            counter = 0
-            while os.path.isfile('CF_{0}--{1}.csv'.format(nome, counter)):
-                counter += 1
-            temp_CF.to_csv('CF_{0}--{1}.csv'.format(nome, counter), sep=';', encoding='utf8', index=False, decimal=',')
-            
-        if type(temp_OT) != type(None):
-            counter = 0 
-            while os.path.isfile('OT_{0}--{1}.csv'.format(nome, counter)):
-                counter += 1
-            temp_OT.to_csv('OT_{0}--{1}.csv'.format(nome, counter), sep=';', encoding='utf8', index=False, decimal=',')
-            
-        if type(temp_OF) != type(None):
-            counter = 0 
-            while os.path.isfile('OF_{0}--{1}.csv'.format(nome, counter)):
-                counter += 1
-            temp_OF.to_csv('OF_{0}--{1}.csv'.format(nome, counter), sep=';', encoding='utf8', index=False, decimal=',')
-
-        
+        for tipo, temp in (('CF', temp_CF), ('OT', temp_OT), ('OF', temp_OF)):
+            if temp is not None:
+                curvas.append((nome, tipo, list(temp.columns), temp.to_numpy(dtype=float)))
+
+    # Um único arquivo para todas as curvas, sem procurar um contador livre para cada uma
+    store = CurveStore(store_dir)
+    for name in store.add_batch(curvas):
+        print('Salvo {0}'.format(name))
+        if export_csv:
+            store.to_csv(name)
+
+
 if __name__ == '__main__':
-    main()
\ No newline at end of file
+    main(export_csv='--csv' in sys.argv)
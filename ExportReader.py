@@ -0,0 +1,321 @@
+from operator import itemgetter
+import mmap
+import os
+import numpy as np
+
+# Size of the pieces iter_blocks reads at a time, and the file size above which the whole file is no longer read
+# into memory by read_flow_curve and flow_curves.
+CHUNK_SIZE = 8 * 1024 ** 2
+STREAM_SIZE = 64 * 1024 ** 2
+
+
+def find_headers(text):
+    """(start, end) positions of the header lines of text, the lines starting with ';', which name the columns of
+    the lines below them. str.find goes through the text much faster than a multiline regex."""
+    starts = [0] if text.startswith(';') else []
+    position = text.find('\n;')
+    while position >= 0:
+        starts.append(position + 1)
+        position = text.find('\n;', position + 1)
+    headers = []
+    for start in starts:
+        end = text.find('\n', start)
+        headers.append((start, end if end >= 0 else len(text)))
+    return headers
+
+
+def find_columns(header, column_gp=0, column_eta=0):
+    """Indices of the GP and Eta columns of a ';' separated header line. As ExtractData always did, these are the
+    last column with 'GP' in its name and the last one with 'Eta' but not 'Eta*' (the complex viscosity). Columns
+    that are not named in header (e.g. a line of units) keep the given indices."""
+    for i, column in enumerate(header.rstrip().split(';')):
+        if 'Eta' in column and 'Eta*' not in column:
+            column_eta = i
+        if 'GP' in column:
+            column_gp = i
+    return column_gp, column_eta
+
+
+def read_columns(lines, columns):
+    """Parses the given columns of the ';' separated lines into an (n, len(columns)) float array. Lines where any
+    of them is missing, blank or not a number are skipped."""
+    if not any(lines):
+        return np.empty((0, len(columns)))
+    try:  # If every line is complete, numpy's parser takes them all at once
+        return np.loadtxt(lines, delimiter=';', usecols=columns, comments=None, ndmin=2)
+    except ValueError:
+        pass
+    last = max(columns)
+    get_columns = itemgetter(*columns)
+    kept = []
+    for line in lines:
+        fields = line.split(';', last + 1)
+        if len(fields) > last and all(map(str.strip, get_columns(fields))):
+            kept.append(line)
+    if not kept:
+        return np.empty((0, len(columns)))
+    try:
+        return np.loadtxt(kept, delimiter=';', usecols=columns, comments=None, ndmin=2)
+    except ValueError:  # Text where a number should be
+        return read_text_columns(kept, columns)
+
+
+def read_text_columns(lines, columns):
+    """read_columns, one line at a time, for lines that numpy cannot parse together."""
+    values = np.empty((len(lines), len(columns)))
+    n = 0
+    for line in lines:
+        fields = line.split(';')
+        try:
+            values[n] = [float(fields[column]) for column in columns]
+        except (ValueError, IndexError):
+            continue
+        n += 1
+    return values[:n]
+
+
+def segment_starts(text, start, end):
+    """Positions of the first rows of the segments between start and end. A segment is one step of the job, with
+    rows numbered 'segment|point', so every segment starts at a row beginning with '<segment>|1;'. Rows that are
+    not numbered this way all go into one segment."""
+    starts = [start]
+    position = text.find('|1;', start, end)
+    while position >= 0:
+        line_start = text.rfind('\n', start, position) + 1
+        if line_start > start and text[line_start:position].strip().isdigit():
+            starts.append(line_start)
+        position = text.find('|1;', position + 3, end)
+    return starts
+
+
+class Segment:
+    """One segment of an export: its id ('3' for the rows '3|1', '3|2'...), the byte range [start, end) of its
+    rows in the file, the header line naming its columns, the (GP, Eta) column indices found in that header and
+    the indices of the columns that have data in it."""
+    def __init__(self, segment_id, start, end, header, columns, present):
+        self.id = segment_id
+        self.start = start
+        self.end = end
+        self.header = header
+        self.columns = columns
+        self.present = present
+
+    def is_flow_curve(self):
+        return all(column in self.present for column in self.columns)
+
+    def __repr__(self):
+        return f'Segment({self.id!r}, {self.start}, {self.end}, present={self.present})'
+
+
+class ExportIndex:
+    """Index of the segments of a RheoWin text export, built in one pass over the file, so that any of them can
+    be read without going through the file again.
+    The file is read as latin-1, so every character is one byte and the positions in text are byte offsets, and
+    its decimal commas are replaced in one go. The headers (lines starting with ';') are found with a single scan
+    and split into segments at the first row of each step. Which columns have data is decided from the first,
+    middle and last rows of each segment, as a step either measures a quantity or leaves it blank all along."""
+    def __init__(self, fname):
+        self.fname = fname
+        with open(fname, 'rb') as fhand:
+            self.text = fhand.read().decode('latin1').replace(',', '.')
+        self.segments = []
+
+        text = self.text
+        column_gp = column_eta = 0
+        headers = find_headers(text)
+        for (start, end), (next_start, _) in zip(headers, headers[1:] + [(len(text), None)]):
+            header = text[start:end]
+            column_gp, column_eta = find_columns(header, column_gp, column_eta)
+            starts = segment_starts(text, end + 1, next_start)
+            for segment_start, segment_end in zip(starts, starts[1:] + [next_start]):
+                rows = self.sample_rows(segment_start, segment_end)
+                number = rows[0].split(';', 1)[0] if rows else ''
+                segment_id = number.split('|', 1)[0].strip() if '|' in number else ''
+                present = sorted({i for row in rows for i, field in enumerate(row.split(';')) if field.strip()})
+                self.segments.append(Segment(segment_id, segment_start, segment_end, header,
+                                             (column_gp, column_eta), present))
+
+    def sample_rows(self, start, end):
+        """The first, middle and last rows between start and end, without copying the rest."""
+        text = self.text
+        while start < end and text[start] in '\r\n':
+            start += 1
+        while end > start and text[end - 1] in '\r\n':
+            end -= 1
+        if start == end:
+            return []
+        rows = []
+        for position in (start, (start + end) // 2, end - 1):
+            row_start = max(text.rfind('\n', start, position) + 1, start)
+            row_end = text.find('\n', position, end)
+            rows.append(text[row_start:row_end if row_end >= 0 else end])
+        return rows
+
+    def read(self, segment, columns=None):
+        """The given columns of segment (its GP and Eta columns by default) as an (n, len(columns)) float array.
+        Rows where any of them is blank or not a number are skipped."""
+        if columns is None:
+            columns = segment.columns
+        return read_columns(self.text[segment.start:segment.end].split('\n'), tuple(columns))
+
+    def flow_curve_segments(self):
+        return [segment for segment in self.segments if segment.is_flow_curve()]
+
+    def flow_curves(self):
+        """(segment id, GP, Eta) of every flow curve segment, in the order of the file"""
+        curves = []
+        for segment in self.flow_curve_segments():
+            data = self.read(segment)
+            if len(data):
+                curves.append((segment.id, data[:, 0].copy(), data[:, 1].copy()))
+        return curves
+
+
+def parse_block(lines, n_columns):
+    """Parses the n_columns columns after the row number of the ';' separated lines into an (n, n_columns) float
+    array, with NaN for blank fields or fields that are not numbers. Blank lines are skipped."""
+    lines = [line for line in lines if line.strip()]
+    if not lines:
+        return np.empty((0, n_columns))
+    try:  # Blank fields are ' ' or empty, and the replacement is done twice for runs of them
+        filled = [line.replace('; ;', ';nan;').replace('; ;', ';nan;').replace(';;', ';nan;').replace(';;', ';nan;')
+                  for line in lines]
+        return np.loadtxt(filled, delimiter=';', usecols=range(1, n_columns + 1), comments=None, ndmin=2)
+    except ValueError:
+        pass
+    values = np.full((len(lines), n_columns), np.nan)
+    for i, line in enumerate(lines):
+        for j, field in enumerate(line.split(';')[1:n_columns + 1]):
+            try:
+                values[i, j] = float(field)
+            except ValueError:
+                pass
+    return values
+
+
+class Block:
+    """Consecutive rows of one segment, as yielded by iter_blocks: the segment id, the column names of its header
+    (without the row number), the (GP, Eta) indices in names, or None if the header has no such columns, and
+    values, an (n, len(names)) float array with NaN where a field was blank."""
+    def __init__(self, segment_id, names, columns, values):
+        self.id = segment_id
+        self.names = names
+        self.columns = columns
+        self.values = values
+
+    def flow_curve(self):
+        """GP and Eta of the rows where both are numbers"""
+        if self.columns is None:
+            return np.empty(0), np.empty(0)
+        data = self.values[:, self.columns]
+        data = data[np.isfinite(data).all(axis=1)]
+        return data[:, 0].copy(), data[:, 1].copy()
+
+    def __repr__(self):
+        return f'Block({self.id!r}, {len(self.values)} rows, names={self.names})'
+
+
+def iter_blocks(fname, chunk_size=CHUNK_SIZE):
+    """Reads a RheoWin text export in pieces of about chunk_size bytes and yields its rows as Blocks, so that the
+    memory used does not grow with the file. The file is memory mapped and each piece ends at a line break.
+    A segment longer than a piece is yielded as several Blocks with the same id, one after the other.
+    Lines before the first header are comments. A header directly after another one (a line of units) keeps the
+    names of the first."""
+    if os.path.getsize(fname) == 0:  # mmap cannot map an empty file
+        return
+    names = None
+    columns = (0, 0)
+    after_header = False
+    with open(fname, 'rb') as fhand, mmap.mmap(fhand.fileno(), 0, access=mmap.ACCESS_READ) as mapped:
+        size = len(mapped)
+        position = 0
+        while position < size:
+            end = min(position + chunk_size, size)
+            if end < size:
+                line_end = mapped.rfind(b'\n', position, end)
+                if line_end < 0:  # A single line longer than chunk_size
+                    line_end = mapped.find(b'\n', end)
+                end = size if line_end < 0 else line_end + 1
+            text = mapped[position:end].decode('latin1').replace(',', '.')
+            position = end
+
+            pieces = []  # (start, end) of the rows between headers
+            piece_start = 0
+            for header_start, header_end in find_headers(text):
+                pieces.append((piece_start, header_start))
+                piece_start = header_end + 1
+                pieces.append((header_start, header_end))
+            pieces.append((piece_start, len(text)))
+
+            for piece_start, piece_end in pieces:
+                if text.startswith(';', piece_start) and piece_end > piece_start:  # Header
+                    header = text[piece_start:piece_end]
+                    if not after_header:
+                        names = [name.strip() for name in header.rstrip().split(';')[1:]]
+                        while names and not names[-1]:
+                            names.pop()
+                    columns = find_columns(header, *columns)
+                    names += [''] * (max(columns) - len(names))  # Columns found in an earlier header
+                    after_header = True
+                    continue
+                if names is None:  # Comments before the first header
+                    continue
+                starts = segment_starts(text, piece_start, piece_end)
+                for segment_start, segment_end in zip(starts, starts[1:] + [piece_end]):
+                    lines = text[segment_start:segment_end].split('\n')
+                    values = parse_block(lines, len(names))
+                    if len(values) == 0:
+                        continue
+                    after_header = False
+                    number = next(line for line in lines if line.strip()).split(';', 1)[0]
+                    segment_id = number.split('|', 1)[0].strip() if '|' in number else ''
+                    block_columns = (columns[0] - 1, columns[1] - 1) if min(columns) > 0 else None
+                    yield Block(segment_id, names, block_columns, values)
+
+
+def count_lines(fname, chunk_size=CHUNK_SIZE):
+    """Number of lines of fname, counted chunk_size bytes at a time through a memory map. It is at least the number
+    of rows iter_blocks yields, so an array of that many rows can be filled with them without growing."""
+    if os.path.getsize(fname) == 0:
+        return 0
+    with open(fname, 'rb') as fhand, mmap.mmap(fhand.fileno(), 0, access=mmap.ACCESS_READ) as mapped:
+        size = len(mapped)
+        n_lines = sum(mapped[position:position + chunk_size].count(b'\n') for position in range(0, size, chunk_size))
+        return n_lines + (mapped[size - 1:] != b'\n')  # A last line without a line break
+
+
+def stream_flow_curves(fname, chunk_size=CHUNK_SIZE):
+    """ExportIndex.flow_curves, read with iter_blocks, so only GP and Eta are ever kept for the whole file."""
+    curves = []
+    for block in iter_blocks(fname, chunk_size):
+        GP, Eta = block.flow_curve()
+        if len(GP) == 0:
+            continue
+        if curves and curves[-1][0] == block.id:  # The rest of a segment that did not fit in one piece
+            curves[-1][1].append(GP)
+            curves[-1][2].append(Eta)
+        else:
+            curves.append((block.id, [GP], [Eta]))
+    return [(segment_id, np.concatenate(GP), np.concatenate(Eta)) for segment_id, GP, Eta in curves]
+
+
+def flow_curves(fname):
+    """(segment id, GP, Eta) of every flow curve segment of fname. Files larger than STREAM_SIZE are streamed
+    instead of being indexed in memory."""
+    if os.path.getsize(fname) > STREAM_SIZE:
+        return stream_flow_curves(fname)
+    return ExportIndex(fname).flow_curves()
+
+
+def read_flow_curve(fname, segment=None):
+    """Reads the GP and Eta columns of a RheoWin text export into two float arrays, using flow_curves. segment
+    is the id of the segment to read ('3' for the rows '3|1', '3|2'...). If it is None, every segment with flow
+    curve data is read and, as ExtractData always did, they are put one after the other. Lines before the first
+    header are comments, and lines where GP or Eta is blank or not a number are skipped.
+    Raises ValueError if no data was found."""
+    curves = [(GP, Eta) for segment_id, GP, Eta in flow_curves(fname)
+              if segment is None or segment_id == str(segment)]
+    if len(curves) == 0:
+        raise ValueError(f'No flow curve data was found in {fname}' +
+                         (f' segment {segment}' if segment is not None else ''))
+    return np.concatenate([GP for GP, Eta in curves]), np.concatenate([Eta for GP, Eta in curves])
@@ -0,0 +1,117 @@
+import hashlib
+import json
+import os
+import numpy as np
+
+# Bump when the stored results change meaning, so old entries are not reused.
+CACHE_VERSION = 3
+
+# Settings that change the outcome of Fitter.fit(). Anything else (plotting, waiting...) does not enter the key.
+KEY_SETTINGS = ['NL_FITTING_METHOD', 'LIN_SORTING_METHOD', 'NL_SORTING_METHOD', 'MAX_FP_NL', 'FIXED_FP_NL',
+                'DO_LIN', 'DO_NL', 'NL_SCAN_MODE', 'ANALYTIC_JAC', 'LOG_FIT',
+                'DATA_GUESS']
+
+
+class FitCache:
+    """On-disk cache of the outcome of Fitter.fit(), one JSON file per entry in directory.
+    Entries are addressed by a hash of the curve data and of the settings that change the fit, so an unchanged
+    file fitted with the same settings is found no matter its name. Each hit touches its entry, and when the
+    directory grows beyond max_size_mb the least recently used entries are removed.
+    The size of the directory is scanned once and then kept up to date with the entries put here. It is only
+    scanned again to evict, or every scan_every puts, to count the entries other processes sharing the directory
+    put meanwhile."""
+
+    def __init__(self, directory='fit_cache', max_size_mb=100, scan_every=200):
+        self.directory = directory
+        self.max_size = float(max_size_mb) * 1024 ** 2
+        self.scan_every = scan_every
+        self.size = None  # Of the entries in directory, as far as this process knows, scanned on the first put
+        self.puts = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        os.makedirs(directory, exist_ok=True)
+
+    @staticmethod
+    def key(GP, Eta, settings):
+        """Hash of GP, Eta and the settings in KEY_SETTINGS"""
+        digest = hashlib.sha256()
+        digest.update(np.ascontiguousarray(GP, dtype=float).tobytes())
+        digest.update(b';')
+        digest.update(np.ascontiguousarray(Eta, dtype=float).tobytes())
+        used_settings = {param: str(getattr(settings, param, '')) for param in KEY_SETTINGS}
+        digest.update(json.dumps([CACHE_VERSION, used_settings], sort_keys=True).encode())
+        return digest.hexdigest()
+
+    @staticmethod
+    def settings_hash(settings):
+        """Short hash of the settings in KEY_SETTINGS, the same for every run whose fits are comparable"""
+        used_settings = {param: str(getattr(settings, param, '')) for param in KEY_SETTINGS}
+        return hashlib.sha256(json.dumps([CACHE_VERSION, used_settings], sort_keys=True).encode()).hexdigest()[:16]
+
+    def _path(self, key):
+        return os.path.join(self.directory, key + '.json')
+
+    def get(self, key):
+        """Returns the stored results of key, or None if there are none."""
+        path = self._path(key)
+        try:
+            with open(path, 'r', encoding='utf-8') as entry:
+                result = json.load(entry)
+            os.utime(path)  # Marks it as recently used
+        except (FileNotFoundError, ValueError):  # Missing, evicted meanwhile or half written by a killed run
+            self.misses += 1
+            return None
+        self.hits += 1
+        return result
+
+    def put(self, key, result):
+        """Stores the dict result under key. The entry is written to a temporary file and then renamed, so other
+        processes sharing the directory never read a partial entry."""
+        path = self._path(key)
+        temp_path = f'{path}.{os.getpid()}.tmp'
+        with open(temp_path, 'w', encoding='utf-8') as entry:
+            json.dump(result, entry)
+        size = os.path.getsize(temp_path)
+        os.replace(temp_path, path)
+        self.puts += 1
+        if self.size is None or self.puts % self.scan_every == 0:
+            self.evict()
+            return
+        self.size += size  # An entry written again is counted twice, which at worst evicts a little early
+        if self.size > self.max_size:
+            self.evict()
+
+    def evict(self):
+        """Scans the directory and, if the cache is larger than max_size_mb, removes the least recently used
+        entries until it is down to 90 % of it, so that a full cache is not scanned again at every put."""
+        entries = []
+        total_size = 0
+        for entry in os.scandir(self.directory):
+            if not entry.name.endswith('.json'):
+                continue
+            try:
+                stat = entry.stat()
+            except FileNotFoundError:
+                continue
+            entries.append((stat.st_mtime, stat.st_size, entry.path))
+            total_size += stat.st_size
+        self.size = total_size
+        if total_size <= self.max_size:
+            return
+        entries.sort()
+        for _, size, path in entries:
+            if total_size <= 0.9 * self.max_size:
+                break
+            try:
+                os.remove(path)
+                self.evictions += 1
+            except FileNotFoundError:  # Another process got to it first
+                pass
+            total_size -= size
+        self.size = total_size
+
+    def stats(self):
+        total = self.hits + self.misses
+        return {'hits': self.hits, 'misses': self.misses, 'evictions': self.evictions,
+                'hit_rate': self.hits / total if total else 0.}
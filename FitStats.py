@@ -0,0 +1,154 @@
+import json
+import os
+import time
+from contextlib import contextmanager
+
+STAGES = ['parse', 'cache', 'linear_scan', 'nonlinear_scan', 'uncertainty', 'plot', 'report', 'record']
+
+
+class FitStats:
+    """What one Fitter spent its time on: the wall time of each stage in s, the windows tried by each scan, the
+    nonlinear solver runs (lmfit minimize) and how many succeeded, their function evaluations, and the
+    exceptions raised and caught while fitting, counted by type. Only plain values, so it travels with the
+    Fitter from the worker processes. Timing a stage costs two perf_counter calls.
+    The stages are those in STAGES. uncertainty is the propagated uncertainty drawn by the plots, so its time is
+    also part of that of plot and report, which only count the time spent in the process that fitted or
+    collected the fit, not in the pools that render."""
+
+    def __init__(self, file=''):
+        self.file = file
+        self.stages = {}
+        self.windows = {'linear': 0, 'nonlinear': 0}
+        self.solver_runs = 0
+        self.solver_successes = 0
+        self.nfev = 0
+        self.exceptions = {}
+
+    @contextmanager
+    def stage(self, name):
+        """Adds the time spent in the with block to the stage name"""
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.stages[name] = self.stages.get(name, 0.) + time.perf_counter() - start
+
+    def solver_run(self, fit):
+        """Counts an lmfit minimize result"""
+        self.solver_runs += 1
+        self.solver_successes += bool(fit.success)
+        self.nfev += fit.nfev
+
+    def exception(self, error):
+        name = type(error).__name__
+        self.exceptions[name] = self.exceptions.get(name, 0) + 1
+
+    def to_dict(self):
+        return {'file': self.file, 'stages': self.stages, 'windows': self.windows, 'solver_runs': self.solver_runs,
+                'solver_successes': self.solver_successes, 'nfev': self.nfev, 'exceptions': self.exceptions}
+
+
+class BatchStats:
+    """Sum of the FitStats of a batch, with the number of fits and of files that could not be fitted, by the type
+    of their error."""
+
+    def __init__(self):
+        self.fits = 0
+        self.failed = 0
+        self.stages = {}
+        self.stage_calls = {}
+        self.windows = {'linear': 0, 'nonlinear': 0}
+        self.solver_runs = 0
+        self.solver_successes = 0
+        self.nfev = 0
+        self.exceptions = {}
+
+    def add(self, stats):
+        self.fits += 1
+        for stage, seconds in stats.stages.items():
+            self.stages[stage] = self.stages.get(stage, 0.) + seconds
+            self.stage_calls[stage] = self.stage_calls.get(stage, 0) + 1
+        for kind, windows in stats.windows.items():
+            self.windows[kind] = self.windows.get(kind, 0) + windows
+        self.solver_runs += stats.solver_runs
+        self.solver_successes += stats.solver_successes
+        self.nfev += stats.nfev
+        for name, count in stats.exceptions.items():
+            self.exceptions[name] = self.exceptions.get(name, 0) + count
+
+    def add_failure(self, error):
+        """Counts a file that could not be fitted. error is the message of run_batch, '<type>: <message>'."""
+        self.failed += 1
+        name = error.split(':', 1)[0] if error else 'Unknown'
+        self.exceptions[name] = self.exceptions.get(name, 0) + 1
+
+    def to_dict(self):
+        return {'fits': self.fits, 'failed': self.failed, 'stages': self.stages, 'stage_calls': self.stage_calls,
+                'windows': self.windows, 'solver_runs': self.solver_runs,
+                'solver_successes': self.solver_successes, 'nfev': self.nfev, 'exceptions': self.exceptions}
+
+    def to_prometheus(self, prefix='rheology_fit'):
+        """The totals in the Prometheus text exposition format"""
+        def metric(name, kind, description, samples):
+            lines = [f'# HELP {prefix}_{name} {description}', f'# TYPE {prefix}_{name} {kind}']
+            for labels, value in samples:
+                label_text = ','.join(f'{label}="{label_value}"' for label, label_value in labels.items())
+                lines.append(f'{prefix}_{name}{{{label_text}}} {value}' if label_text else
+                             f'{prefix}_{name} {value}')
+            return lines
+
+        lines = []
+        lines += metric('fits_total', 'counter', 'Curves fitted.', [({}, self.fits)])
+        lines += metric('failed_total', 'counter', 'Files or segments that could not be fitted.',
+                        [({}, self.failed)])
+        lines += metric('stage_seconds_total', 'counter', 'Wall time spent in each stage of the fits.',
+                        [({'stage': stage}, f'{seconds:.6f}') for stage, seconds in self.stages.items()])
+        lines += metric('stage_calls_total', 'counter', 'Fits that went through each stage.',
+                        [({'stage': stage}, calls) for stage, calls in self.stage_calls.items()])
+        lines += metric('windows_total', 'counter', 'Fitting windows tried by the scans.',
+                        [({'scan': kind}, windows) for kind, windows in self.windows.items()])
+        lines += metric('solver_runs_total', 'counter', 'Nonlinear solver runs, by outcome.',
+                        [({'result': 'success'}, self.solver_successes),
+                         ({'result': 'failure'}, self.solver_runs - self.solver_successes)])
+        lines += metric('nfev_total', 'counter', 'Function evaluations of the solver.', [({}, self.nfev)])
+        lines += metric('exceptions_total', 'counter', 'Exceptions raised while fitting, by type.',
+                        [({'type': name}, count) for name, count in sorted(self.exceptions.items())])
+        return '\n'.join(lines) + '\n'
+
+
+class StatsWriter:
+    """Writes the FitStats of a batch to path: one JSON line per fit, and one for the whole batch at the end, or,
+    if path ends in .prom, the totals of the batch as a Prometheus text file, rewritten at every flush by
+    renaming a temporary file so that a collector never reads half of it."""
+
+    def __init__(self, path):
+        self.path = path
+        self.prometheus = path.endswith('.prom')
+        self.batch = BatchStats()
+        self.lines = []
+
+    def add(self, stats):
+        self.batch.add(stats)
+        if not self.prometheus:
+            self.lines.append(json.dumps(stats.to_dict()))
+
+    def add_failure(self, file, error):
+        self.batch.add_failure(error)
+        if not self.prometheus:
+            self.lines.append(json.dumps({'file': file, 'error': error}))
+
+    def flush(self):
+        if self.prometheus:
+            temp_path = f'{self.path}.{os.getpid()}.tmp'
+            with open(temp_path, 'w', encoding='utf-8') as metrics:
+                metrics.write(self.batch.to_prometheus())
+            os.replace(temp_path, self.path)
+        elif self.lines:
+            with open(self.path, 'a', encoding='utf-8') as stats_file:
+                stats_file.write('\n'.join(self.lines) + '\n')
+            self.lines = []
+
+    def close(self):
+        if not self.prometheus:
+            self.lines.append(json.dumps({'batch': self.batch.to_dict()}))
+        self.flush()
@@ -40,7 +40,7 @@ if __name__ == '__main__':
     #ax2f1 = fig1.add_subplot(212)
     ax1.set_title(fit.model)
     x = np.logspace(np.log10(fit.GP[0]), np.log10(fit.GP[-1]))
-    y, yerr = fit.carr_uncertainty(x, *fit.params, *fit.param_errs)
+    y, yerr = fit.nl_uncertainty(x)
     ax1.plot(fit.GP, fit.Eta, linewidth=0, marker='o')
     ax1.errorbar(x, y, yerr=yerr)
     ax1.set_xscale('log')
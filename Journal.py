@@ -0,0 +1,109 @@
+import hashlib
+import json
+import os
+import time
+
+
+class Journal:
+    """Append-only record of the files a batch has completed, so that a batch that was killed can resume where it
+    stopped. The first line identifies the batch (see batch_id), and each following line is one completed file,
+    with its size and modification time then, so that a file changed since is not taken as done. Completions are
+    kept in memory until commit, which appends them and syncs the file to disk, so the caller commits only once
+    their results are written. A line cut short by a crash is ignored.
+    A journal of another batch is discarded, and finish removes the journal once the batch is done."""
+
+    def __init__(self, path, batch_id):
+        self.path = path
+        self.batch_id = batch_id
+        self.completed = {}  # File: its fingerprint when it was completed
+        self.pending = []
+        resumed = False
+        try:
+            with open(path, 'r', encoding='utf-8') as journal:
+                lines = journal.read().split('\n')
+            if json.loads(lines[0]).get('batch') == batch_id:
+                resumed = True
+                for line in lines[1:]:
+                    try:
+                        entry = json.loads(line)
+                        self.completed[entry['file']] = entry['stat']
+                    except (ValueError, KeyError, TypeError):
+                        continue
+        except (FileNotFoundError, ValueError, AttributeError):
+            pass
+        if not resumed:
+            with open(path, 'w', encoding='utf-8') as journal:
+                journal.write(json.dumps({'batch': batch_id}) + '\n')
+        self.handle = open(path, 'a', encoding='utf-8')
+
+    @staticmethod
+    def batch_id(settings_hash, files):
+        """Id of the batch that fits files with the settings of settings_hash. Another list of files is another
+        batch, even with the same settings."""
+        return hashlib.sha256(json.dumps([settings_hash, sorted(files)]).encode()).hexdigest()[:16]
+
+    @staticmethod
+    def fingerprint(file):
+        """[size, modification time] of file, or None if it does not exist"""
+        try:
+            stat = os.stat(file)
+        except OSError:
+            return None
+        return [stat.st_size, stat.st_mtime_ns]
+
+    def complete(self, file):
+        self.pending.append((file, self.fingerprint(file)))
+
+    def is_done(self, file):
+        """Whether file was completed by this batch and has not changed since"""
+        return file in self.completed and self.completed[file] == self.fingerprint(file)
+
+    def commit(self):
+        if not self.pending:
+            return
+        self.handle.write(''.join(json.dumps({'file': file, 'stat': stat}) + '\n' for file, stat in self.pending))
+        self.handle.flush()
+        os.fsync(self.handle.fileno())
+        self.completed.update(self.pending)
+        self.pending = []
+
+    def close(self):
+        self.commit()
+        self.handle.close()
+
+    def finish(self):
+        self.close()
+        os.remove(self.path)
+
+
+class Progress:
+    """Counts the files done out of total and reports, at most every interval seconds, how many are done, the
+    throughput in files/s and the estimated time left."""
+
+    def __init__(self, total, interval=10.):
+        self.total = total
+        self.interval = interval
+        self.done = 0
+        self.start = time.perf_counter()
+        self.last_report = self.start
+
+    def update(self, n=1):
+        self.done += n
+        now = time.perf_counter()
+        if now - self.last_report >= self.interval or self.done == self.total:
+            self.last_report = now
+            print(self.report(now))
+
+    def report(self, now=None):
+        elapsed = (now or time.perf_counter()) - self.start
+        rate = self.done / elapsed if elapsed > 0 else 0.
+        line = f'{self.done}/{self.total} files ({100 * self.done / max(self.total, 1):.1f}%), {rate:.2f} files/s'
+        if self.done < self.total and rate > 0:
+            line += f', ETA {self.format_time((self.total - self.done) / rate)}'
+        return line
+
+    @staticmethod
+    def format_time(seconds):
+        minutes, seconds = divmod(int(seconds), 60)
+        hours, minutes = divmod(minutes, 60)
+        return f'{hours}h{minutes:02d}m{seconds:02d}s' if hours else f'{minutes}m{seconds:02d}s'
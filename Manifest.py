@@ -0,0 +1,79 @@
+import hashlib
+import json
+import os
+
+MANIFEST_VERSION = 1
+
+
+def file_hash(path, block_size=1024 ** 2):
+    """sha256 of the contents of path"""
+    digest = hashlib.sha256()
+    with open(path, 'rb') as fhand:
+        for block in iter(lambda: fhand.read(block_size), b''):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+class Manifest:
+    """Record of the files already fitted, kept in the JSON file path, so that a batch can fit only what is new or
+    changed. Each file is recorded with its size, modification time and sha256, the FitCache.settings_hash of the
+    settings it was fitted with and the names its fits were recorded under (more than one with SPLIT_SEGMENTS).
+    A file is current if it was fitted with the same settings and has not changed since. An unchanged size and
+    modification time are taken as unchanged without reading the file. Otherwise its hash is compared, so a file
+    that was only touched or copied is not fitted again."""
+
+    def __init__(self, path='manifest.json'):
+        self.path = path
+        self.files = {}
+        try:
+            with open(path, 'r', encoding='utf-8') as manifest:
+                content = json.load(manifest)
+            if content.get('version') == MANIFEST_VERSION:
+                self.files = content['files']
+        except FileNotFoundError:
+            pass
+
+    @staticmethod
+    def key(file):
+        return os.path.normpath(file)
+
+    def is_current(self, file, settings_hash):
+        entry = self.files.get(self.key(file))
+        if entry is None or entry['settings_hash'] != settings_hash:
+            return False
+        try:
+            stat = os.stat(file)
+        except FileNotFoundError:
+            return False
+        if stat.st_size != entry['size']:
+            return False
+        if stat.st_mtime_ns == entry['mtime']:
+            return True
+        if file_hash(file) != entry['hash']:
+            return False
+        entry['mtime'] = stat.st_mtime_ns  # Saves hashing it again next time
+        return True
+
+    def record(self, file, settings_hash, outputs):
+        """Records file as fitted with settings_hash, its fits being recorded under the names in outputs"""
+        stat = os.stat(file)
+        self.files[self.key(file)] = {'size': stat.st_size, 'mtime': stat.st_mtime_ns, 'hash': file_hash(file),
+                                      'settings_hash': settings_hash, 'outputs': sorted(set(outputs))}
+
+    def stale(self):
+        """Recorded files that no longer exist"""
+        return [file for file in self.files if not os.path.exists(file)]
+
+    def remove(self, files):
+        """Forgets files. Returns the names their fits were recorded under."""
+        outputs = []
+        for file in files:
+            outputs += self.files.pop(self.key(file), {}).get('outputs', [])
+        return outputs
+
+    def save(self):
+        """Writes the manifest to a temporary file and renames it, so a killed run never leaves half of it"""
+        temp_path = f'{self.path}.{os.getpid()}.tmp'
+        with open(temp_path, 'w', encoding='utf-8') as manifest:
+            json.dump({'version': MANIFEST_VERSION, 'files': self.files}, manifest)
+        os.replace(temp_path, self.path)
@@ -0,0 +1,228 @@
+import numpy as np
+
+
+# -------------FITTING MODELS-------------------
+
+def fit_Carreau(GP, eta_0, eta_inf, GP_b, n):
+    """Eta = eta_inf + (eta_0 - eta_inf) / (1+(GP/GP_b)**2)**(n/2)
+    GP_b is a constant with the dimension of time and n is a dimensionless constant"""
+    return eta_inf + (eta_0 - eta_inf) / (1 + (GP / GP_b) ** 2) ** (n / 2)
+
+
+def fit_Cross(GP, eta_0, eta_inf, GP_b, n):
+    return eta_inf + (eta_0 - eta_inf) / (1 + (GP / GP_b) ** n)
+
+
+def fit_PowerLaw(GP, k, n):
+    """Power Law: eta = k * GP ** (n-1)"""
+    return k * GP ** (n - 1)
+
+
+def fit_CarreauYasuda(GP, eta_0, eta_inf, lbda, a, n):
+    """Carreau-Yasuda: eta(GP) = eta_inf + (eta_0 - eta_inf)(1+(lambda * GP)**a)**((n-1)/a)"""
+    return eta_inf + (eta_0 - eta_inf) / (1 + (lbda * GP) ** a) ** ((n - 1) / a)
+
+
+def fit_lin(x, a, b):
+    """Simple function for a linear fit, with a as the linear coefficient and b the angular coefficient."""
+    return a + b * x
+
+
+# -------------JACOBIANS-------------------
+
+def jac_Carreau(GP, eta_0, eta_inf, GP_b, n):
+    """Partial derivatives of fit_Carreau with respect to eta_0, eta_inf, GP_b and n, stacked on the last axis.
+    These are the derivatives printed by RheoFC.calculate_derivatives."""
+    u = 1 + (GP / GP_b) ** 2
+    shear = u ** (-n / 2)
+    d_eta_0 = shear
+    d_eta_inf = 1 - shear
+    d_GP_b = (eta_0 - eta_inf) * n * GP ** 2 / GP_b ** 3 * shear / u
+    d_n = -(eta_0 - eta_inf) * shear * np.log(u) / 2
+    return np.stack(np.broadcast_arrays(d_eta_0, d_eta_inf, d_GP_b, d_n), axis=-1)
+
+
+def jac_Cross(GP, eta_0, eta_inf, GP_b, n):
+    """Partial derivatives of fit_Cross with respect to eta_0, eta_inf, GP_b and n, stacked on the last axis."""
+    ratio_n = (GP / GP_b) ** n
+    v = 1 + ratio_n
+    d_eta_0 = 1 / v
+    d_eta_inf = 1 - 1 / v
+    d_GP_b = (eta_0 - eta_inf) * n * ratio_n / (GP_b * v ** 2)
+    d_n = -(eta_0 - eta_inf) * ratio_n * np.log(GP / GP_b) / v ** 2
+    return np.stack(np.broadcast_arrays(d_eta_0, d_eta_inf, d_GP_b, d_n), axis=-1)
+
+
+def jac_PowerLaw(GP, k, n):
+    """Partial derivatives of fit_PowerLaw with respect to k and n, stacked on the last axis."""
+    d_k = GP ** (n - 1)
+    d_n = k * d_k * np.log(GP)
+    return np.stack(np.broadcast_arrays(d_k, d_n), axis=-1)
+
+
+def jac_CarreauYasuda(GP, eta_0, eta_inf, lbda, a, n):
+    """Partial derivatives of fit_CarreauYasuda with respect to eta_0, eta_inf, lbda, a and n, stacked on the
+    last axis."""
+    s = (lbda * GP) ** a
+    w = 1 + s
+    shear = w ** (-(n - 1) / a)
+    d_eta_0 = shear
+    d_eta_inf = 1 - shear
+    d_lbda = -(eta_0 - eta_inf) * shear * (n - 1) * s / (lbda * w)
+    d_a = (eta_0 - eta_inf) * shear * (n - 1) / a * (np.log(w) / a - s * np.log(lbda * GP) / w)
+    d_n = -(eta_0 - eta_inf) * shear * np.log(w) / a
+    return np.stack(np.broadcast_arrays(d_eta_0, d_eta_inf, d_lbda, d_a, d_n), axis=-1)
+
+
+# ---------------UNCERTAINTY CALCULATIONS------
+
+def propagate_uncertainty(func, jac, GP, params, covar=None, param_errs=None):
+    """Values of the model func at every GP, and their errors propagated to first order from the parameter
+    covariance matrix: var(eta) = J covar J^T, with J the gradient of the model given by jac. This keeps the
+    correlations between parameters that the *_uncertainty functions ignore. Without a covariance matrix the
+    parameters are taken as uncorrelated, with standard deviations param_errs."""
+    GP = np.asarray(GP, dtype=float)
+    if covar is None:
+        covar = np.diag([0. if err is None else err ** 2 for err in param_errs])
+    y = func(GP, *params)
+    J = jac(GP, *params)
+    y_err = np.sqrt(np.abs(np.einsum('...i,ij,...j->...', J, covar, J)))
+    return y, y_err
+
+
+# ---------------INITIAL GUESSES------
+
+def flow_curve_features(GP, Eta, plateau_points=3):
+    """Rough features of a flow curve, estimated from the data to start the fits from. eta_0 is the median of the
+    first plateau_points points and eta_inf that of the last ones, lowered tenfold if Eta is still falling there.
+    GP_b is the shear rate where Eta gets halfway between them, interpolated in log-log, and slope is the log-log
+    slope of |Eta - eta_inf| from GP_b on, which is how the models approach eta_inf. k and power are a log-log
+    line through the whole curve, Eta = k * GP**power.
+    Returns a dict, or None if there are less than 2 * plateau_points positive points."""
+    GP = np.asarray(GP, dtype=float)
+    Eta = np.asarray(Eta, dtype=float)
+    positive = (GP > 0) & (Eta > 0) & np.isfinite(GP) & np.isfinite(Eta)
+    if np.count_nonzero(positive) < 2 * plateau_points:
+        return None
+    order = np.argsort(GP[positive])
+    GP = GP[positive][order]
+    Eta = Eta[positive][order]
+    log_GP = np.log(GP)
+    log_Eta = np.log(Eta)
+
+    eta_0 = np.median(Eta[:plateau_points])
+    eta_inf = np.median(Eta[-plateau_points:])
+    tail_slope = np.polyfit(log_GP[-plateau_points:], log_Eta[-plateau_points:], 1)[0]
+    if tail_slope < -0.1:  # Still shear thinning at the last points, so the plateau is further down
+        eta_inf /= 10
+
+    half = (eta_0 + eta_inf) / 2
+    past_half = np.flatnonzero((Eta - half) * np.sign(eta_0 - eta_inf) <= 0)  # Shear thickening goes upwards
+    if len(past_half) == 0:  # Eta never gets there, so the transition is past the last point
+        GP_b = GP[-1]
+    elif past_half[0] == 0:
+        GP_b = GP[0]
+    else:
+        i = past_half[0]
+        fraction = (np.log(half) - log_Eta[i - 1]) / (log_Eta[i] - log_Eta[i - 1])
+        GP_b = np.exp(log_GP[i - 1] + fraction * (log_GP[i] - log_GP[i - 1]))
+
+    # Close to eta_inf, |Eta - eta_inf| is mostly noise
+    excess = np.abs(Eta - eta_inf)
+    transition = (GP >= GP_b) & (excess > 0.05 * abs(eta_0 - eta_inf))
+    if np.count_nonzero(transition) >= 2:
+        slope = np.polyfit(log_GP[transition], np.log(excess[transition]), 1)[0]
+    else:
+        slope = np.polyfit(log_GP[-plateau_points:], log_Eta[-plateau_points:], 1)[0]
+    power, log_k = np.polyfit(log_GP, log_Eta, 1)
+
+    return {'eta_0': float(eta_0), 'eta_inf': float(eta_inf), 'GP_b': float(GP_b), 'slope': float(slope),
+            'k': float(np.exp(log_k)), 'power': float(power)}
+
+
+def guess_Carreau(features):
+    """At high shear rates Carreau and Cross go as (GP/GP_b)**-n"""
+    return features['eta_0'], features['eta_inf'], features['GP_b'], max(-features['slope'], 0.1)
+
+
+def guess_CarreauYasuda(features):
+    """As fit_CarreauYasuda is written, at high shear rates it goes as (lbda*GP)**(1-n). n is kept away from 1,
+    where the model is flat."""
+    return features['eta_0'], features['eta_inf'], 1 / features['GP_b'], 2, max(1 - features['slope'], 1.1)
+
+
+def guess_PowerLaw(features):
+    return features['k'], max(1 + features['power'], 0.01)
+
+
+# ---------------MODEL REGISTRY------
+
+class FlowModel:
+    """Everything the fitting routines need to know about a flow curve model.
+    func(GP, *params) evaluates it, jac(GP, *params) gives its partial derivatives stacked on the last axis,
+    param_names are the names of the parameters in lmfit, in the order func takes them, display_names is how they
+    are written in plots, p0 are the default initial values and bounds the (lower, upper) bounds of all
+    parameters. guess turns the flow_curve_features of a curve into initial values. The log_residual pair is
+    used to fit log(Eta) with the logarithms of the parameters, which requires the model and the parameters to be
+    positive."""
+
+    def __init__(self, name, func, jac, param_names, display_names, p0, bounds=(0, np.inf), guess=None):
+        self.name = name
+        self.func = func
+        self.jac = jac
+        self.param_names = param_names
+        self.display_names = display_names
+        self.p0 = p0
+        self.bounds = bounds
+        self.guess = guess
+
+    def initial_guess(self, features=None):
+        """Initial values for a curve with the given flow_curve_features. Falls back to p0 if there are no features
+        (too few points, or not wanted) or the model has no guess."""
+        if features is None or self.guess is None:
+            return self.p0
+        return self.guess(features)
+
+    def residual(self, params, x, dataset):
+        """Residual in the form lmfit expects, params being an lmfit Parameters in the order of param_names."""
+        return dataset - self.func(x, *[par.value for par in params.values()])
+
+    def residual_jac(self, params, x, dataset):
+        """Jacobian of residual, which is minus the Jacobian of the model."""
+        return -self.jac(x, *[par.value for par in params.values()])
+
+    def log_residual(self, params, x, dataset):
+        """Residual of log(Eta), with dataset being log(Eta) and params the logarithms of the model parameters."""
+        return dataset - np.log(self.func(x, *np.exp([par.value for par in params.values()])))
+
+    def log_residual_jac(self, params, x, dataset):
+        """Jacobian of log_residual: d log(f)/d log(p) = p/f df/dp"""
+        values = np.exp([par.value for par in params.values()])
+        return -self.jac(x, *values) * values / self.func(x, *values)[:, None]
+
+    def uncertainty(self, GP, params, covar=None, param_errs=None):
+        return propagate_uncertainty(self.func, self.jac, GP, params, covar, param_errs)
+
+
+models = {}
+
+
+def register(model):
+    """Makes model available to Fitter and batch_fit under model.name"""
+    models[model.name] = model
+
+
+def get_model(name):
+    try:
+        return models[name]
+    except KeyError:
+        raise NameError(f'Did not understand model {name}')
+
+
+register(FlowModel('Carreau', fit_Carreau, jac_Carreau, ['eta_0', 'eta_inf', 'GP_b', 'n'],
+                   'eta_0 eta_inf GP_b n', (100, 1, 5, 1), guess=guess_Carreau))
+register(FlowModel('Cross', fit_Cross, jac_Cross, ['eta_0', 'eta_inf', 'GP_b', 'n'],
+                   'eta_0 eta_inf GP_b n', (100, 1, 5, 1), guess=guess_Carreau))
+register(FlowModel('Carreau-Yasuda', fit_CarreauYasuda, jac_CarreauYasuda, ['eta_0', 'eta_inf', 'lbda', 'a', 'n'],
+                   'eta_0 eta_inf lambda a n', (100, 1, 5, 1, 1), guess=guess_CarreauYasuda))
+register(FlowModel('PowerLaw', fit_PowerLaw, jac_PowerLaw, ['k', 'n'], 'k n', (100, 0.5), guess=guess_PowerLaw))
@@ -0,0 +1,207 @@
+import os
+from multiprocessing import Pool
+import numpy as np
+from matplotlib.figure import Figure
+from matplotlib.backends.backend_agg import FigureCanvasAgg
+from matplotlib.collections import LineCollection
+from matplotlib.offsetbox import AnchoredText
+
+# Renderer of the worker processes, with its own figure templates, set up once when each worker starts.
+_worker_renderer = None
+
+
+def error_text(error, spec):
+    """error formatted with spec, or 'n/a' if lmfit could not estimate it and left it None"""
+    return 'n/a' if error is None else format(error, spec)
+
+
+def plot_data(fit):
+    """What plot_error_graphs draws for the Fitter fit, as plain arrays and strings that are cheap to send to
+    another process: the points, and one panel per fit done with its curve, error bars, first and last points,
+    text and a one line summary (eta_0, or the first parameter, and R2)."""
+    x = np.logspace(np.log10(fit.GP[0]), np.log10(fit.GP[-1]))
+    panels = []
+    if fit.nl_done:
+        with fit.stats.stage('uncertainty'):
+            y, yerr = fit.nl_uncertainty(x)
+        model_param_names = 'Model: ' + fit.model + ' Params: ' + fit.param_names
+        param_text = " ".join([str(round(par, 2)) + '+/-' + ('n/a' if err is None else str(round(err, 2)))
+                               for par, err in zip(fit.params, fit.param_errs)])
+        summary = (f'{fit.model} {fit.fit_model.param_names[0]}={fit.params[0]:.4g}+/-'
+                   f'{error_text(fit.param_errs[0], ".2g")} $R^2$={fit.nl_R2:.3f}')
+        panels.append({'x': x, 'y': np.asarray(y, dtype=float), 'yerr': np.asarray(yerr, dtype=float),
+                       'first_point': fit.nl_first_point, 'last_point': fit.nl_last_point,
+                       'text': f'{fit.filename}\n{model_param_names}\n{param_text}\n$R^2$={round(fit.nl_R2, 2)}',
+                       'summary': summary})
+    if fit.lin_done:
+        param_text = f"int = {fit.int}+/-{fit.int_err}"
+        panels.append({'x': x, 'y': np.ones(len(x)) * fit.int, 'yerr': np.ones(len(x)) * fit.int_err,
+                       'first_point': fit.l_first_point, 'last_point': fit.l_last_point,
+                       'text': f'{fit.filename}\nModel: Linear. Params: Intercept\n{param_text}\n'
+                               f'$R^2$={round(fit.l_R2, 2)}',
+                       'summary': f'Linear eta_0={fit.int:.4g}+/-{fit.int_err:.2g} $R^2$={fit.l_R2:.3f}'})
+    return {'path': fit.filename[:-4] + '.png', 'GP': np.asarray(fit.GP, dtype=float),
+            'Eta': np.asarray(fit.Eta, dtype=float), 'panels': panels}
+
+
+def point_labels(GP, panel):
+    """Labels of the first and last points of panel, numbered from 1. A last point of -1 is the last one."""
+    if panel['last_point'] == -1:
+        last_label = str(len(GP))
+    else:
+        last_label = str(panel['last_point'])  # todo: check this function
+    return str(panel['first_point'] + 1), last_label
+
+
+def error_segments(panel):
+    x, y, yerr = panel['x'], panel['y'], panel['yerr']
+    return np.stack([np.column_stack([x, y - yerr]), np.column_stack([x, y + yerr])], axis=1)
+
+
+def draw_panel(ax, GP, Eta, panel):
+    """Draws panel on ax. Returns its artists, which update_panel changes for another plot."""
+    ax.set_xscale('log')
+    ax.set_yscale('log')
+    points, = ax.plot(GP, Eta, linewidth=0, marker='o', markersize=5)
+    curve, = ax.plot(panel['x'], panel['y'], color='C1')
+    bars = LineCollection(error_segments(panel), colors='C1')
+    ax.add_collection(bars)
+    first_label, last_label = point_labels(GP, panel)
+    first = ax.annotate(first_label, (GP[panel['first_point']], Eta[panel['first_point']]), color='red')
+    last = ax.annotate(last_label, (GP[panel['last_point']], Eta[panel['last_point']]), color='red')
+    text = AnchoredText(panel['text'], loc=3, frameon=True, prop={'fontsize': 'small'})
+    ax.add_artist(text)
+    set_limits(ax, GP, Eta, panel)
+    return {'points': points, 'curve': curve, 'bars': bars, 'first': first, 'last': last, 'text': text}
+
+
+def update_panel(ax, artists, GP, Eta, panel):
+    artists['points'].set_data(GP, Eta)
+    artists['curve'].set_data(panel['x'], panel['y'])
+    artists['bars'].set_segments(error_segments(panel))
+    first_label, last_label = point_labels(GP, panel)
+    for name, label in (('first', first_label), ('last', last_label)):
+        point = (GP[panel[name + '_point']], Eta[panel[name + '_point']])
+        artists[name].set_text(label)
+        artists[name].xy = artists[name].xyann = point  # The text is placed at xyann, not at xy
+    artists['text'].txt.set_text(panel['text'])
+    set_limits(ax, GP, Eta, panel)
+
+
+def set_limits(ax, GP, Eta, panel):
+    """Fits the limits of ax to the points and error bars, with a margin, as autoscaling would. Set by hand as
+    autoscaling ignores updated artists."""
+    xs = np.concatenate([GP, panel['x']])
+    ys = np.concatenate([Eta, panel['y'] - panel['yerr'], panel['y'] + panel['yerr']])
+    for values, set_lim in ((xs, ax.set_xlim), (ys, ax.set_ylim)):
+        values = np.log10(values[np.isfinite(values) & (values > 0)])
+        if len(values) == 0:
+            continue
+        low, high = values.min(), values.max()
+        margin = 0.05 * (high - low) if high > low else 0.5
+        set_lim(10 ** (low - margin), 10 ** (high + margin))
+
+
+class PlotRenderer:
+    """Saves the plots of plot_data without a display, on the Agg backend. A figure is created once for each
+    layout (one or two panels), and later plots only update the data, labels and limits of its artists instead
+    of building a new figure. The layout is fitted with tight_layout on the first plot of each figure."""
+
+    def __init__(self):
+        self.templates = {}
+
+    def template(self, data):
+        n_panels = len(data['panels'])
+        if n_panels not in self.templates:
+            figure = Figure(figsize=(6 * n_panels, 4))
+            FigureCanvasAgg(figure)
+            axes = figure.subplots(ncols=n_panels, nrows=1, squeeze=False)[0]
+            artists = [draw_panel(ax, data['GP'], data['Eta'], panel) for ax, panel in zip(axes, data['panels'])]
+            figure.tight_layout()
+            self.templates[n_panels] = figure, axes, artists
+            return self.templates[n_panels]
+        figure, axes, artists = self.templates[n_panels]
+        for ax, panel_artists, panel in zip(axes, artists, data['panels']):
+            update_panel(ax, panel_artists, data['GP'], data['Eta'], panel)
+        return figure, axes, artists
+
+    def render(self, data):
+        """Saves the plot of data. Returns the path of the image, or None if there was no fit to plot."""
+        if not data['panels']:
+            return None
+        figure, _, _ = self.template(data)
+        figure.savefig(data['path'])
+        return data['path']
+
+
+def _init_worker():
+    global _worker_renderer
+    _worker_renderer = PlotRenderer()
+
+
+def _render(data):
+    try:
+        return data['path'], _worker_renderer.render(data), None
+    except Exception as error:  # One bad plot must not stop the others
+        return data['path'], None, f'{type(error).__name__}: {error}'
+
+
+class RenderPool:
+    """Saves the plots of Fitters in a pool of workers processes of their own (0 for one per core, 1 to plot in
+    this process), so that plotting goes on while the next files are fitted. Only plot_data is sent to the
+    workers. close waits for every plot and returns the (path, error) of those that failed."""
+
+    def __init__(self, workers=1):
+        if workers == 0:
+            workers = os.cpu_count()
+        self.workers = workers
+        self.pending = []
+        self.failed = []
+        self.done = 0
+        if workers <= 1:
+            _init_worker()
+            self.pool = None
+        else:
+            self.pool = Pool(workers, initializer=_init_worker)
+
+    def submit(self, fit):
+        with fit.stats.stage('plot'):  # Only what is done in this process
+            self._submit(fit)
+
+    def _submit(self, fit):
+        try:
+            data = plot_data(fit)
+        except Exception as error:  # The uncertainty can overflow
+            self.failed.append((fit.filename[:-4] + '.png', f'{type(error).__name__}: {error}'))
+            return
+        if self.pool is None:
+            self.collect(_render(data))
+        else:
+            self.pending.append(self.pool.apply_async(_render, (data,)))
+            while self.pending and self.pending[0].ready():  # Keeps the finished ones from piling up
+                self.collect(self.pending.pop(0).get())
+
+    def collect(self, result):
+        path, saved, error = result
+        if error is not None:
+            self.failed.append((path, error))
+        elif saved is not None:
+            self.done += 1
+
+    def close(self):
+        for result in self.pending:
+            self.collect(result.get())
+        self.pending = []
+        if self.pool is not None:
+            self.pool.close()
+            self.pool.join()
+            self.pool = None
+        return self.failed
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        if self.pool is not None:
+            self.pool.terminate()
+            self.pool = None
@@ -0,0 +1,163 @@
+import io
+import os
+from collections import deque
+from multiprocessing import Pool
+import numpy as np
+from matplotlib.figure import Figure
+from matplotlib.backends.backend_agg import FigureCanvasAgg
+from matplotlib.ticker import LogLocator
+from PIL import Image
+from PlotRenderer import plot_data
+
+PAGE_SIZE = (8.27, 11.69)  # A4, in inches
+PAGE_GRID = (4, 3)  # Rows and columns of fits on each page of the PDF
+PAGE_DPI = 100
+SHEET_GRID = (8, 6)  # Rows and columns of thumbnails on each contact sheet
+THUMBNAIL_SIZE = (2., 1.5)  # In inches
+SHEET_DPI = 80
+MAX_POINTS = 100  # Points drawn of each curve, at most
+
+
+def downsample(values, max_points=MAX_POINTS):
+    step = -(-len(values) // max_points)
+    return values[::step]
+
+
+def draw_fit(ax, data, thumbnail=False):
+    """Draws the fit of the plot_data data on ax: the points, the fitted curves and the window of the first fit,
+    shaded, with the file name and the summary of each fit as the title. Thumbnails have no ticks, and only the
+    summary of the first fit."""
+    GP, Eta = data['GP'], data['Eta']
+    ax.set_xscale('log')
+    ax.set_yscale('log')
+    ax.plot(downsample(GP), downsample(Eta), linewidth=0, marker='o', markersize=2 if thumbnail else 3)
+    for panel, color in zip(data['panels'], ('C1', 'C2')):
+        ax.plot(downsample(panel['x']), downsample(panel['y']), color=color, linewidth=1)
+    window = data['panels'][0]
+    ax.axvspan(GP[window['first_point']], GP[window['last_point']], color='0.9', zorder=0)
+    if np.any(Eta > 0):  # Otherwise the curves set them, far off the points
+        ax.set_ylim(np.min(Eta[Eta > 0]) / 2, np.max(Eta) * 2)
+    name = os.path.basename(data['path'])[:-4]
+    ax.minorticks_off()  # Most of the drawing time goes to the ticks
+    if thumbnail:
+        ax.set_xticks([])
+        ax.set_yticks([])
+        ax.set_title(f'{name}\n{window["summary"]}', fontsize=5)
+    else:
+        ax.xaxis.set_major_locator(LogLocator(numticks=5))
+        ax.yaxis.set_major_locator(LogLocator(numticks=4))
+        ax.tick_params(labelsize=6)
+        ax.set_title('\n'.join([name] + [panel['summary'] for panel in data['panels']]), fontsize=6)
+
+
+def render_grid(fits, grid, figsize, dpi, thumbnail):
+    """PNG, as bytes, of the fits laid out on a grid (rows, columns). The spacing is fixed, as fitting it with
+    tight_layout takes longer than drawing."""
+    figure = Figure(figsize=figsize)
+    FigureCanvasAgg(figure)
+    axes = figure.subplots(nrows=grid[0], ncols=grid[1], squeeze=False).flatten()
+    for ax, data in zip(axes, fits):
+        draw_fit(ax, data, thumbnail)
+    for ax in axes[len(fits):]:
+        ax.set_axis_off()
+    if thumbnail:
+        figure.subplots_adjust(left=0.01, right=0.99, bottom=0.01, top=0.96, wspace=0.05, hspace=0.3)
+    else:
+        figure.subplots_adjust(left=0.07, right=0.98, bottom=0.03, top=0.96, wspace=0.25, hspace=0.45)
+    image = io.BytesIO()
+    figure.savefig(image, format='png', dpi=dpi)
+    return image.getvalue()
+
+
+def _render(kind, fits, grid):
+    if kind == 'page':
+        return render_grid(fits, grid, PAGE_SIZE, PAGE_DPI, thumbnail=False)
+    return render_grid(fits, grid, (THUMBNAIL_SIZE[0] * grid[1], THUMBNAIL_SIZE[1] * grid[0]), SHEET_DPI,
+                       thumbnail=True)
+
+
+class Report:
+    """Report of a whole batch, to review the fits in a few files instead of one plot each: a PDF at path with
+    page_grid fits per page, and contact sheets, <path without extension>_sheet<n>.png, with sheet_grid
+    downsampled thumbnails each, showing eta_0 (or the first parameter), R2 and the fitting window.
+    Pages and sheets are rendered as soon as they are full, in a pool of workers processes (0 for one per core,
+    1 to render them in this process), and written in order as they are done. At most two per worker are kept
+    waiting, so the memory used does not grow with the batch. Call close to write what is left."""
+
+    def __init__(self, path='report.pdf', workers=1, page_grid=PAGE_GRID, sheet_grid=SHEET_GRID):
+        if workers == 0:
+            workers = os.cpu_count()
+        self.path = path
+        self.page_grid = page_grid
+        self.sheet_grid = sheet_grid
+        self.max_pending = 2 * workers
+        self.pool = Pool(workers) if workers > 1 else None
+        self.pending = deque()
+        self.fits = {'page': [], 'sheet': []}
+        self.n_pages = 0
+        self.sheets = []
+        self.failed = []
+        if os.path.isfile(path):
+            os.remove(path)  # Pages are appended to it
+
+    def add(self, fit):
+        with fit.stats.stage('report'):  # Only what is done in this process
+            self._add(fit)
+
+    def _add(self, fit):
+        try:
+            data = plot_data(fit)
+        except Exception as error:  # The uncertainty can overflow
+            self.failed.append((fit.filename, f'{type(error).__name__}: {error}'))
+            return
+        if not data['panels']:
+            return
+        for kind, grid in (('page', self.page_grid), ('sheet', self.sheet_grid)):
+            self.fits[kind].append(data)
+            if len(self.fits[kind]) == grid[0] * grid[1]:
+                self.submit(kind)
+
+    def submit(self, kind):
+        fits, self.fits[kind] = self.fits[kind], []
+        grid = self.page_grid if kind == 'page' else self.sheet_grid
+        if self.pool is None:
+            self.write(kind, _render(kind, fits, grid))
+            return
+        self.pending.append((kind, self.pool.apply_async(_render, (kind, fits, grid))))
+        while self.pending and (self.pending[0][1].ready() or len(self.pending) > self.max_pending):
+            kind, result = self.pending.popleft()
+            self.write(kind, result.get())
+
+    def write(self, kind, png):
+        if kind == 'page':
+            with Image.open(io.BytesIO(png)) as image:
+                image.convert('RGB').save(self.path, 'PDF', resolution=PAGE_DPI, append=self.n_pages > 0)
+            self.n_pages += 1
+        else:
+            sheet_path = f'{os.path.splitext(self.path)[0]}_sheet{len(self.sheets) + 1}.png'
+            with open(sheet_path, 'wb') as sheet:
+                sheet.write(png)
+            self.sheets.append(sheet_path)
+
+    def close(self):
+        """Writes the last pages and sheets and waits for all of them. Returns the (file, error) of the fits that
+        could not be added."""
+        for kind in ('page', 'sheet'):
+            if self.fits[kind]:
+                self.submit(kind)
+        while self.pending:
+            kind, result = self.pending.popleft()
+            self.write(kind, result.get())
+        if self.pool is not None:
+            self.pool.close()
+            self.pool.join()
+            self.pool = None
+        return self.failed
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        if self.pool is not None:
+            self.pool.terminate()
+            self.pool = None
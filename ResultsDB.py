@@ -0,0 +1,190 @@
+import argparse
+import json
+import os
+import re
+import sqlite3
+import time
+from FitCache import FitCache, KEY_SETTINGS
+from ResultsSink import COLUMNS, fit_rows
+
+# Columns of the fits table besides id: those of the results table, the sample, and the run and settings they
+# come from.
+FIT_COLUMNS = ['run_id', 'sample', 'settings_hash'] + COLUMNS
+TEXT_COLUMNS = {'file', 'model', 'status', 'sample', 'settings_hash'}
+INTEGER_COLUMNS = {'run_id', 'first_point', 'last_point', 'nfev'}
+
+
+def sample_name(file):
+    """Name of the sample measured in file: CF_<sample>--<n>.csv as written by DataExtraction, or the start of
+    the file name up to the first space, as DataExtraction takes it from the exports."""
+    base = os.path.splitext(os.path.basename(file))[0]
+    extracted = re.match(r'^(?:CF|OT|OF)_(.*)--\d+$', base)
+    if extracted:
+        return extracted.group(1)
+    return re.sub(r'_seg\w+$', '', base.split(' ')[0])
+
+
+class ResultsDB:
+    """Results backend keeping every fit in a SQLite database, for queries over many runs.
+    Every run_batch is a run, with its start time and settings, and each of its fits is a row of the fits table
+    with the columns of the results table, the sample name, the run id and the hash of the settings that change
+    the fit (FitCache.settings_hash). The fits are indexed by sample and model, model, settings hash and run,
+    the latter with file and model so that runs are compared through the index.
+    The database is in WAL mode, so it can be read while a batch writes to it, and rows are inserted
+    flush_every at a time, each batch in one transaction."""
+
+    def __init__(self, path='results.db', flush_every=500):
+        self.path = path
+        self.flush_every = flush_every
+        self.rows = []
+        self.run_id = None
+        self.settings_hash = ''
+        self.connection = sqlite3.connect(path)
+        self.connection.execute('PRAGMA journal_mode=WAL')
+        self.connection.execute('PRAGMA synchronous=NORMAL')  # Safe in WAL mode, and much faster
+        self.create_tables()
+
+    def create_tables(self):
+        def column_type(column):
+            if column in TEXT_COLUMNS:
+                return 'TEXT'
+            return 'INTEGER' if column in INTEGER_COLUMNS else 'REAL'
+
+        with self.connection:
+            self.connection.execute('CREATE TABLE IF NOT EXISTS runs (run_id INTEGER PRIMARY KEY, started TEXT, '
+                                    'settings_hash TEXT, settings TEXT)')
+            self.connection.execute('CREATE TABLE IF NOT EXISTS fits (id INTEGER PRIMARY KEY, ' +
+                                    ', '.join(f'"{column}" {column_type(column)}' for column in FIT_COLUMNS) + ')')
+            # Parameters of models registered after the database was created
+            existing = {row[1] for row in self.connection.execute('PRAGMA table_info(fits)')}
+            for column in FIT_COLUMNS:
+                if column not in existing:
+                    self.connection.execute(f'ALTER TABLE fits ADD COLUMN "{column}" {column_type(column)}')
+            self.connection.execute('CREATE INDEX IF NOT EXISTS fits_sample ON fits (sample, model, status)')
+            self.connection.execute('CREATE INDEX IF NOT EXISTS fits_model ON fits (model)')
+            self.connection.execute('CREATE INDEX IF NOT EXISTS fits_settings ON fits (settings_hash)')
+            self.connection.execute('CREATE INDEX IF NOT EXISTS fits_run ON fits (run_id, file, model)')
+
+    def start_run(self, settings):
+        """Starts a new run with settings, to which the fits added from now on belong. Returns its id."""
+        self.flush()
+        self.settings_hash = FitCache.settings_hash(settings)
+        used_settings = {param: str(getattr(settings, param, '')) for param in KEY_SETTINGS}
+        with self.connection:
+            cursor = self.connection.execute('INSERT INTO runs (started, settings_hash, settings) VALUES (?, ?, ?)',
+                                             (time.strftime('%Y-%m-%d %H:%M:%S'), self.settings_hash,
+                                              json.dumps(used_settings, sort_keys=True)))
+        self.run_id = cursor.lastrowid
+        return self.run_id
+
+    def add(self, row):
+        """Adds a row, a dict with some of the keys in COLUMNS, to the current run"""
+        row = dict(row, run_id=self.run_id, sample=sample_name(row['file']), settings_hash=self.settings_hash)
+        self.rows.append(tuple(None if row.get(column) is None else
+                               row[column] if column in TEXT_COLUMNS else
+                               int(row[column]) if column in INTEGER_COLUMNS else float(row[column])
+                               for column in FIT_COLUMNS))
+        if len(self.rows) >= self.flush_every:
+            self.flush()
+
+    def add_fit(self, file, fit, error=None):
+        for row in fit_rows(file, fit, error):
+            self.add(row)
+
+    def flush(self):
+        if not self.rows:
+            return
+        columns = ', '.join(f'"{column}"' for column in FIT_COLUMNS)
+        with self.connection:  # One transaction for all of them
+            self.connection.executemany(f'INSERT INTO fits ({columns}) VALUES ({", ".join("?" * len(FIT_COLUMNS))})',
+                                        self.rows)
+        self.rows = []
+
+    def close(self):
+        self.flush()
+        self.connection.close()
+
+    def remove_files(self, files):
+        """Deletes the fits of files, from every run. file is not indexed, so they are deleted 500 per scan."""
+        files = list(files)
+        with self.connection:
+            for start in range(0, len(files), 500):
+                chunk = files[start:start + 500]
+                self.connection.execute(f'DELETE FROM fits WHERE file IN ({", ".join("?" * len(chunk))})', chunk)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    # ---------------QUERIES------
+
+    def query(self, sql, parameters=()):
+        """Rows of sql as dicts"""
+        cursor = self.connection.execute(sql, parameters)
+        names = [description[0] for description in cursor.description]
+        return [dict(zip(names, row)) for row in cursor]
+
+    def runs(self):
+        return self.query('SELECT runs.*, COUNT(fits.id) AS fits FROM runs LEFT JOIN fits USING (run_id) '
+                          'GROUP BY runs.run_id ORDER BY runs.run_id')
+
+    def latest(self, model=None, sample=None):
+        """The last successful fit of each sample and model, optionally only of model and/or sample"""
+        conditions = ["status = 'ok'"]
+        parameters = []
+        if model is not None:
+            conditions.append('model = ?')
+            parameters.append(model)
+        if sample is not None:
+            conditions.append('sample = ?')
+            parameters.append(sample)
+        return self.query('SELECT fits.* FROM fits JOIN (SELECT MAX(id) AS id FROM fits WHERE ' +
+                          ' AND '.join(conditions) + ' GROUP BY sample, model) USING (id) ORDER BY sample, model',
+                          parameters)
+
+    def compare_runs(self, run_a, run_b, model=None):
+        """eta_0 of the files fitted in both runs, side by side, with its change from run_a to run_b"""
+        return self.query('SELECT a.file, a.model, a.eta_0 AS eta_0_a, b.eta_0 AS eta_0_b, '
+                          'b.eta_0 - a.eta_0 AS difference, a.status AS status_a, b.status AS status_b '
+                          'FROM fits a JOIN fits b ON a.file = b.file AND a.model = b.model '
+                          'WHERE a.run_id = ? AND b.run_id = ? AND (? IS NULL OR a.model = ?) '
+                          'ORDER BY a.file, a.model', (run_a, run_b, model, model))
+
+
+def print_rows(rows, columns):
+    print(';'.join(columns))
+    for row in rows:
+        print(';'.join('' if row[column] is None else str(row[column]) for column in columns))
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Queries a results database written by the batch (RESULTS_DB).')
+    parser.add_argument('database', help='path of the database')
+    commands = parser.add_subparsers(dest='command', required=True)
+    commands.add_parser('runs', help='list the runs')
+    latest = commands.add_parser('latest', help='last successful eta_0 of each sample and model')
+    latest.add_argument('--model')
+    latest.add_argument('--sample')
+    compare = commands.add_parser('compare', help='eta_0 of the files fitted in two runs')
+    compare.add_argument('run_a', type=int)
+    compare.add_argument('run_b', type=int)
+    compare.add_argument('--model')
+    args = parser.parse_args(argv)
+
+    if not os.path.isfile(args.database):
+        parser.error(f'{args.database} does not exist')
+    with ResultsDB(args.database) as database:
+        if args.command == 'runs':
+            print_rows(database.runs(), ['run_id', 'started', 'settings_hash', 'fits'])
+        elif args.command == 'latest':
+            print_rows(database.latest(args.model, args.sample),
+                       ['sample', 'model', 'eta_0', 'eta_0_err', 'R2', 'run_id', 'file'])
+        else:
+            print_rows(database.compare_runs(args.run_a, args.run_b, args.model),
+                       ['file', 'model', 'eta_0_a', 'eta_0_b', 'difference', 'status_a', 'status_b'])
+
+
+if __name__ == '__main__':
+    main()
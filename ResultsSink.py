@@ -0,0 +1,103 @@
+import os
+import Models
+
+# Columns of the results table. The parameters are those of every registered model, so that rows of all models
+# fit in the same table. The linear fit estimates eta_0 as the intercept of the plateau.
+PARAMETERS = list(dict.fromkeys(name for model in Models.models.values() for name in model.param_names))
+COLUMNS = (['file', 'model', 'first_point', 'last_point'] +
+           [column for name in PARAMETERS for column in (name, name + '_err')] + ['R2', 'nfev', 'status'])
+
+
+def fit_rows(file, fit, error=None):
+    """Rows of the results table for a Fitter, one for the linear fit and one for the nonlinear fit, as far as
+    they were asked for. If fit is None, a single row records error."""
+    if fit is None:
+        return [{'file': file, 'status': f'failed: {error}'}]
+    rows = []
+    n_points = len(fit.GP)
+    if fit.settings.DO_LIN:
+        row = {'file': fit.filename, 'model': 'linear'}
+        if fit.lin_done:
+            row.update(first_point=fit.l_first_point, last_point=fit.l_last_point % n_points,
+                       eta_0=fit.int, eta_0_err=fit.int_err, R2=fit.l_R2, status='ok')
+        else:
+            row['status'] = 'failed'
+        rows.append(row)
+    if fit.settings.DO_NL:
+        row = {'file': fit.filename, 'model': fit.model, 'nfev': fit.nfev}
+        if fit.nl_done:
+            row.update(first_point=fit.nl_first_point, last_point=fit.nl_last_point % n_points, R2=fit.nl_R2,
+                       status=fit.nl_error.strip(';') or 'ok')
+            for name, value, error in zip(fit.fit_model.param_names, fit.params, fit.param_errs):
+                row[name] = value
+                row[name + '_err'] = error
+        else:
+            row['status'] = 'failed'
+        rows.append(row)
+    return rows
+
+
+class ResultsSink:
+    """Single writer of the results table, a ';' separated file with the columns in COLUMNS and one row per fit.
+    Rows are kept in memory and appended to fname flush_every at a time, so the file is opened once per batch
+    of rows instead of once per record. Fitters running in other processes never write to it: their results
+    are added here, in the process that owns the sink.
+    Raises ValueError if fname already exists with other columns, as its rows would not line up."""
+
+    def __init__(self, fname='fits.csv', flush_every=100):
+        self.fname = fname
+        self.flush_every = flush_every
+        self.rows = []
+        if os.path.isfile(fname) and os.path.getsize(fname) > 0:
+            with open(fname, 'r', encoding='utf-8') as table:
+                header = table.readline().rstrip('\n').split(';')
+            if header != COLUMNS:
+                raise ValueError(f'{fname} has different columns than the results table. Move or rename it.')
+
+    def add(self, row):
+        """Adds a row, a dict with some of the keys in COLUMNS"""
+        self.rows.append(row)
+        if len(self.rows) >= self.flush_every:
+            self.flush()
+
+    def add_fit(self, file, fit, error=None):
+        for row in fit_rows(file, fit, error):
+            self.add(row)
+
+    @staticmethod
+    def field(value):
+        """value as written in the table. Messages must not break the row."""
+        if value is None:
+            return ''
+        return str(value).replace(';', ',').replace('\n', ' ')
+
+    def flush(self):
+        if not self.rows:
+            return
+        new_file = not os.path.isfile(self.fname) or os.path.getsize(self.fname) == 0
+        lines = [';'.join(COLUMNS) + '\n'] if new_file else []
+        for row in self.rows:
+            lines.append(';'.join(self.field(row.get(column)) for column in COLUMNS) + '\n')
+        with open(self.fname, 'a', encoding='utf-8') as table:
+            table.writelines(lines)
+        self.rows = []
+
+    def close(self):
+        self.flush()
+
+    @staticmethod
+    def remove_files(fname, files):
+        """Removes the rows of files from the table fname, which is rewritten and then renamed over the old one"""
+        files = set(files)
+        with open(fname, 'r', encoding='utf-8') as table:
+            lines = [line for line in table if line.split(';', 1)[0] not in files]
+        temp_path = f'{fname}.{os.getpid()}.tmp'
+        with open(temp_path, 'w', encoding='utf-8') as table:
+            table.writelines(lines)
+        os.replace(temp_path, fname)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
@@ -6,6 +6,7 @@ from scipy.optimize import curve_fit
 import logging
 import traceback
 import pandas
+import ExportReader
 
 # todo: add support to logging instead of having to write to a new file.
 # todo: change settings to a class, access it as settings.debug, for example
@@ -164,54 +165,7 @@ def ExtractData(fname, FC_segment=0):
     """Opens the file fname and extracts the data based on where it finds the word 'Eta' and 'GP', these being
     the Viscosity and the Shear Rate (gamma point). If the file has multiple segments, for example, when multiple
     experiments were done in succession, FC_segment indicates which of those experiments was a Flow Curve."""
-    fhand = open(fname, 'r')
-    GP = []
-    Eta = []
-    column_eta = 0
-    column_gp = 0
-    #FC_segment = '3'
-    
-    #while FC_segment == 0:
-    #    FC_segment = input("What is the segment that has the flow curves? (eg. [1], 2, 3) If you do not know, don't write anything. ")
-    #    if FC_segment == '':
-    #        print(fhand.read())
-    #    elif FC_segment.isnumeric():
-    #        break
-    #    else:
-    #        print('Not a valid number')
-    
-    for line in fhand:
-        if line.startswith(';'):
-            column_names = line.rstrip().split(';')
-            if settings['DEBUG']:
-                print('Debug: column names', column_names)
-            for i, column in enumerate(column_names):
-                if 'Eta' in column and 'Eta*' not in column:
-                    column_eta = i
-                    if settings['DEBUG']:
-                        print('Debug: Found Eta at', column_eta)
-                if 'GP' in column:
-                    column_gp = i
-                    if settings['DEBUG']:
-                        print('Debug: Found GP at', column_gp)
-        try:
-            GP.append(float(line.replace(',', '.').split(';')[column_gp]))
-            Eta.append(float(line.replace(',', '.').split(';')[column_eta]))
-        except:
-            pass
-        
-        #if line.startswith(FC_segment + '|'):
-        #    line = line.rstrip()
-        #    num, gp, tau, eta, *rest = line.replace(',','.').split(';')
-        #    GP.append(float(gp))
-        #    Eta.append(float(eta))
-        #    #print(line)
-    
-    fhand.close()
-    if len(GP) == 0:
-        #print('!!!!No Flow Curve data was found! Re-export the data on file', fname)
-        raise ValueError
-    #return pd.Series(GP), pd.Series(Eta)
+    GP, Eta = ExportReader.read_flow_curve(fname)
     if settings['DEBUG']:
         print('Debug: Extracted Data: GP:', GP, 'Eta:', Eta)
     return GP, Eta
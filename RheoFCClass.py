@@ -1,16 +1,16 @@
-import matplotlib as mpl
-mpl.use('TkAgg')
-import matplotlib.pyplot as plt
+import os
 import glob
 import numpy as np
-from scipy.optimize import curve_fit
 import traceback
-from lmfit import minimize, Parameters
-from uncertainties import ufloat
-import pandas as pd
 import Settings
+import Models
+import ExportReader
+from FitStats import FitStats
 import sys
 
+# matplotlib, scipy.optimize, lmfit and pandas take seconds to import, so they are imported by the code that
+# uses them. Workers whose fits come from the cache, and runs that never plot, never load them.
+
 # todo: check program with several different settings
 # todo: solve the problems with manual fitting
 
@@ -29,15 +29,37 @@ import sys
 
 # todo: remove the debugging setting. Just use the debugging tools.
 
+def pyplot():
+    """matplotlib.pyplot, on TkAgg unless MPLBACKEND says otherwise. Only needed to show plots."""
+    import matplotlib
+    if 'MPLBACKEND' not in os.environ:
+        matplotlib.use('TkAgg')
+    import matplotlib.pyplot as plt
+    return plt
+
+
 class Fitter:
-    def __init__(self, filename, settings, do_fit=True):
+    renderer = None  # PlotRenderer shared by the Fitters that save their plots without showing them
+
+    def __init__(self, filename, settings, do_fit=True, manip=None, cache=None, data=None, segment=None):
+        """Reads GP and Eta from filename and, if do_fit, fits them. data, if given, is a (GP, Eta) pair already
+        read from the file, which is then not opened. segment is the id of the segment of the export the curve
+        comes from. Each segment of a file is recorded and plotted under its own name, <file>_seg<id>.<ext>."""
         self.VISC_LIMIT = 10000000
         self.l_first_point = 0
         self.l_last_point = -1
         self.nl_first_point = 0
         self.nl_last_point = -1
-        self.manip = FileManip()
-        self.filename = filename
+        self.manip = manip if manip is not None else FileManip()  # BufferedFileManip defers all the writing
+        self.cache = cache  # FitCache, or None to always fit
+        self.cache_hit = False
+        self.segment = segment
+        if segment is not None:
+            root, ext = os.path.splitext(filename)
+            self.filename = f'{root}_seg{segment}{ext}'
+        else:
+            self.filename = filename
+        self.stats = FitStats(self.filename)  # Time per stage, windows, solver runs and exceptions
         self.settings = settings
         self.model = self.settings.NL_FITTING_METHOD
         self.l_R2 = 0
@@ -51,18 +73,13 @@ class Fitter:
 
         self.lin_done = False
         self.nl_done = False
+        self.nfev = 0  # Total function evaluations spent by lm_curvefit
+        self.nl_error = ''
+        self.covar = None  # Covariance matrix of the nonlinear parameters
+        self.last_covar = None  # Covariance of the last nonlinear fit done by lm_curvefit
 
-        if self.model == 'Cross':
-            #self.param_names = ['eta_0', 'eta_inf', 'GP_b', 'n']
-            self.param_names = 'eta_0 eta_inf GP_b n'
-        elif self.model == 'Carreau':
-            #self.param_names = ['eta_0', 'eta_inf', 'GP_b', 'n']
-            self.param_names = 'eta_0 eta_inf GP_b n'
-        elif self.model == 'Carreau-Yasuda':
-            #self.param_names = ['eta_0', 'eta_inf', 'lambda', 'a', 'n']
-            self.param_names = 'eta_0 eta_inf lambda a n'
-        else:
-            raise NameError(f'Did not understand model {self.model}')
+        self.fit_model = Models.get_model(self.model)  # Resolved once, so that nothing dispatches on the name later
+        self.param_names = self.fit_model.display_names
 
         self.param_names_lin = ['Int', 'Slp']  # todo: check if this is the correct order.
 
@@ -72,32 +89,37 @@ class Fitter:
             self.slp = 0
             self.slp_err = 0
         elif self.settings.DO_NL:
-            if self.model == 'Carreau' or self.model == 'Cross' or self.model == 'Carreau-Yasuda':
-                self.params = [0, 0, 0, 0]
-                self.param_errs = [0, 0, 0, 0]
-            else:
-                raise ValueError(f'Unknown model: {model}')
+            self.params = [0] * len(self.fit_model.param_names)
+            self.param_errs = [0] * len(self.fit_model.param_names)
 
-        try:
-            if self.settings.PREV_EXTRACTED:
-                self.GP, self.Eta = self.manip.ExtractData_pd(filename)
-                self.GP = np.array(self.GP)
-                self.Eta = np.array(self.Eta)
-            else:
-                self.GP, self.Eta = self.manip.ExtractData(filename)
-                self.GP = np.array(self.GP)
-                self.Eta = np.array(self.Eta)
-        except ValueError:
-            self.manip.logger(filename, 'Failed to open')
-            raise ValueError(f'!!!! No Flow Curve data was found! Re-export the data on file{filename}.')
-        except KeyError:
-            self.manip.logger(filename, 'Failed to open')
-            raise ValueError(f'!!!! No Flow Curve data was found! Re-export the data on file{filename}.')
-
-        if len(self.GP) != len(self.Eta):
-            self.manip.logger(self.filename, 'Failed to open')
-            raise ValueError(f'!!!! GP and Eta have different lengths. '
-                             f'Re-export {filename} or fix the problem manually.')
+        with self.stats.stage('parse'):
+            try:
+                if data is not None:
+                    self.GP = np.array(data[0])
+                    self.Eta = np.array(data[1])
+                elif self.settings.PREV_EXTRACTED:
+                    self.GP, self.Eta = self.manip.ExtractData_pd(filename)
+                    self.GP = np.array(self.GP)
+                    self.Eta = np.array(self.Eta)
+                else:
+                    self.GP, self.Eta = self.manip.ExtractData(filename, 0 if segment is None else segment)
+                    self.GP = np.array(self.GP)
+                    self.Eta = np.array(self.Eta)
+            except ValueError:
+                self.manip.logger(filename, 'Failed to open')
+                raise ValueError(f'!!!! No Flow Curve data was found! Re-export the data on file{filename}.')
+            except KeyError:
+                self.manip.logger(filename, 'Failed to open')
+                raise ValueError(f'!!!! No Flow Curve data was found! Re-export the data on file{filename}.')
+
+            if len(self.GP) != len(self.Eta):
+                self.manip.logger(self.filename, 'Failed to open')
+                raise ValueError(f'!!!! GP and Eta have different lengths. '
+                                 f'Re-export {filename} or fix the problem manually.')
+
+            # Estimated once per curve, and used as the initial values of every model and window
+            self.features = Models.flow_curve_features(self.GP, self.Eta) if self.settings.DATA_GUESS else None
+            self.initial_params = self.fit_model.initial_guess(self.features)
 
         if do_fit:
             self.fit()
@@ -115,47 +137,82 @@ class Fitter:
                 self.manual_fit(0, -1, self.settings.NL_FITTING_METHOD, True)
 
     def fit(self):
+        # Only the automatic fits are deterministic given the data and the settings, so only those are cached.
+        use_cache = (self.cache is not None and (self.settings.AUTO_LIN or not self.settings.DO_LIN) and
+                     (self.settings.AUTO_NL or not self.settings.DO_NL))
+        if use_cache:
+            with self.stats.stage('cache'):
+                key = self.cache.key(self.GP, self.Eta, self.settings)
+                state = self.cache.get(key)
+            if state is not None:
+                self.load_state(state)
+                self.cache_hit = True
+                if self.lin_done:
+                    self.manip.record_fit('linear', self.int, self.int_err, silent=False,
+                                          extra=f"{self.l_first_point};{self.l_last_point};")
+                if self.nl_done:
+                    self.record_nl_fit(self.nl_error)
+                return
+
         if self.settings.DO_LIN:
-            if self.settings.AUTO_LIN:
-                self.automatic_lin_fitting_lm(True)
-            else:  # todo: plot, save and ask for the required points
-                self.manual_fit(0, -1, 'Linear')
+            with self.stats.stage('linear_scan'):
+                if self.settings.AUTO_LIN:
+                    self.automatic_lin_fitting_cumsum(True)
+                else:  # todo: plot, save and ask for the required points
+                    self.manual_fit(0, -1, 'Linear')
         if self.settings.DO_NL:
-            if self.settings.AUTO_NL:
-                self.automatic_nl_fitting_lm(True)
-            else:
-                self.manual_fit(0, -1, self.settings.NL_FITTING_METHOD, True)
-
-    @staticmethod
-    def fit_Carreau(GP, eta_0, eta_inf, GP_b, n):
-        """Eta = eta_inf + (eta_0 - eta_inf) / (1+(GP/GP_b)**2)**(n/2)
-        GP_b is a constant with the dimension of time and n is a dimensionless constant"""
-        return eta_inf + (eta_0 - eta_inf) / (1 + (GP / GP_b) ** 2) ** (n / 2)
-
-    @staticmethod
-    def fit_Cross(GP, eta_0, eta_inf, GP_b, n):
-        return eta_inf + (eta_0 - eta_inf) / (1 + (GP / GP_b) ** n)
+            with self.stats.stage('nonlinear_scan'):
+                if self.settings.AUTO_NL:
+                    self.automatic_nl_fitting_lm(True)
+                else:
+                    self.manual_fit(0, -1, self.settings.NL_FITTING_METHOD, True)
 
-    @staticmethod
-    def fit_PowerLaw(GP, k, n):
-        """Power Law: eta = k * GP ** (n-1)"""
-        return k * GP ** (n - 1)
+        if use_cache:
+            with self.stats.stage('cache'):
+                self.cache.put(key, self.fit_state())
 
-    @staticmethod
-    def fit_CarreauYasuda(GP, eta_0, eta_inf, lbda, a, n):
-        """Carreau-Yasuda: eta(GP) = eta_inf + (eta_0 - eta_inf)(1+(lambda * GP)**a)**((n-1)/a)"""
-        return eta_inf + (eta_0 - eta_inf) / (1 + (lbda * GP) ** a) ** ((n - 1) / a)
+    def fit_state(self):
+        """The outcome of fit(), as a dict of plain Python values."""
+        def plain(value):
+            return None if value is None else float(value)
 
-    @staticmethod
-    def fit_lin(x, a, b):
-        """Simple function for a linear fit, with a as the linear coefficient and b the angular coefficient."""
-        return a + b * x
+        # nfev is what the stored fit cost, so that the results table reports it on a hit as well. self.stats is
+        # not stored: it counts the work of this run, which is none on a hit.
+        state = {'lin_done': self.lin_done, 'nl_done': self.nl_done, 'nfev': int(self.nfev)}
+        if self.lin_done:
+            state.update(l_first_point=int(self.l_first_point), l_last_point=int(self.l_last_point),
+                         int=plain(self.int), int_err=plain(self.int_err), l_R2=plain(self.l_R2))
+        if self.nl_done:
+            state.update(nl_first_point=int(self.nl_first_point), params=[plain(p) for p in self.params],
+                         param_errs=[plain(e) for e in self.param_errs], nl_R2=plain(self.nl_R2),
+                         nl_error=self.nl_error,
+                         covar=None if self.covar is None else np.asarray(self.covar, dtype=float).tolist())
+        return state
+
+    def load_state(self, state):
+        """Restores the outcome of fit() from a dict made by fit_state."""
+        for attribute, value in state.items():
+            setattr(self, attribute, value)
+        if self.covar is not None:
+            self.covar = np.array(self.covar)
+
+    # The models and their Jacobians are defined in Models.py
+    fit_Carreau = staticmethod(Models.fit_Carreau)
+    fit_Cross = staticmethod(Models.fit_Cross)
+    fit_PowerLaw = staticmethod(Models.fit_PowerLaw)
+    fit_CarreauYasuda = staticmethod(Models.fit_CarreauYasuda)
+    fit_lin = staticmethod(Models.fit_lin)
+    jac_Carreau = staticmethod(Models.jac_Carreau)
+    jac_Cross = staticmethod(Models.jac_Cross)
+    jac_PowerLaw = staticmethod(Models.jac_PowerLaw)
+    jac_CarreauYasuda = staticmethod(Models.jac_CarreauYasuda)
 
     @staticmethod
     def carr_uncertainty(GP, eta0, etainf, GPb, n, eta0_err, etainf_err, GPb_err, n_err):
         """Uses the uncertainty package to calculate the Carreau model values. GP
         can be a numpy array, which returns two lists of values and errors, a float64,
         float or int and returns a tuple (val, err)"""
+        from uncertainties import ufloat
         f_eta0 = ufloat(eta0, eta0_err)
         f_etainf = ufloat(etainf, etainf_err)
         f_GPb = ufloat(GPb, GPb_err)
@@ -176,6 +233,7 @@ class Fitter:
 
     @staticmethod
     def cross_uncertainty(GP, eta0, etainf, GPb, n, eta0_err, etainf_err, GPb_err, n_err):
+        from uncertainties import ufloat
         f_eta0 = ufloat(eta0, eta0_err)
         f_etainf = ufloat(etainf, etainf_err)
         f_GPb = ufloat(GPb, GPb_err)
@@ -196,6 +254,7 @@ class Fitter:
 
     @staticmethod
     def carryas_uncertainty(GP, eta0, etainf, lbda, a, n, eta0_err, etainf_err, lbda_err, a_err, n_err):
+        from uncertainties import ufloat
         f_eta0 = ufloat(eta0, eta0_err)
         f_etainf = ufloat(etainf, etainf_err)
         f_n = ufloat(n, n_err)
@@ -215,14 +274,27 @@ class Fitter:
 
         return CY_val, CY_err
 
+    propagate_uncertainty = staticmethod(Models.propagate_uncertainty)
+
+    def nl_uncertainty(self, GP):
+        """Values and errors of the fitted nonlinear model at GP. See Models.propagate_uncertainty."""
+        return self.fit_model.uncertainty(GP, self.params, self.covar, self.param_errs)
+
     # todo: alterar o termo int para outro valor para impedir que haja um clash.
-    def lm_curvefit(self, GP, Eta, do_lin=False):
+    def lm_curvefit(self, GP, Eta, do_lin=False, p0=None):
+        """Fits GP and Eta with lmfit. p0, if given, are the initial values of the nonlinear model parameters,
+        in the same order they are returned. Otherwise initial_params are used.
+        With LOG_FIT set, the nonlinear fit is done on log(Eta) with the logarithms of the parameters (see
+        lm_curvefit_log), unless Eta has values that are not positive or that fit fails."""
+        from lmfit import minimize, Parameters
         params = Parameters()
         SStot = sum((Eta - np.mean(Eta)) ** 2)
         if do_lin:  # todo: Check why R2 is very weird here.
             params.add('Int', 50, vary=True, min=0)
             params.add('Slp', 0, vary=False)
             fit = minimize(self.residual_lin, params, args=(GP, Eta))
+            self.nfev += fit.nfev
+            self.stats.solver_run(fit)
             slp = fit.params['Slp'].value
             int = fit.params['Int'].value
             slp_err = fit.params['Slp'].stderr
@@ -230,49 +302,82 @@ class Fitter:
             chisqr = fit.chisqr
             R2 = 1 - fit.chisqr / SStot
             return [slp, int], [slp_err, int_err], R2
-        elif self.model == 'Carreau':
-            params.add('eta_0', 100, vary=True, min=0)
-            params.add('eta_inf', 1, vary=True, min=0)
-            params.add('GP_b', 5, vary=True, min=0)
-            params.add('n', 1, vary=True, min=0)
-            fit = minimize(self.residual, params, args=(GP, Eta))
-            params = [fit.params[par].value for par in fit.params]
-            param_errs = [fit.params[par].stderr for par in fit.params]
-            R2 = 1 - fit.chisqr / SStot
-            return params, param_errs, R2
-        elif self.model == 'Cross':
-            params.add('eta_0', 100, vary=True, min=0)
-            params.add('eta_inf', 1, vary=True, min=0)
-            params.add('GP_b', 5, vary=True, min=0)
-            params.add('n', 1, vary=True, min=0)
-            fit = minimize(self.residual, params, args=(GP, Eta))
+        else:
+            if p0 is None:
+                p0 = self.initial_params
+            if self.settings.LOG_FIT and np.all(Eta > 0):
+                try:
+                    return self.lm_curvefit_log(GP, Eta, p0, SStot)
+                except ValueError as error:  # lmfit found NaN, from a parameter overflowing in exp
+                    self.stats.exception(error)
+                    if self.settings.DEBUG:
+                        print(f'Debug: log fit failed on {self.filename}, fitting Eta instead')
+            lower, upper = self.fit_model.bounds
+            for name, value in zip(self.fit_model.param_names, p0):
+                params.add(name, value, vary=True, min=lower, max=upper)
+            fit = self.minimize_nl(params, GP, Eta)
+            self.last_covar = fit.covar
             params = [fit.params[par].value for par in fit.params]
             param_errs = [fit.params[par].stderr for par in fit.params]
             R2 = 1 - fit.chisqr / SStot
             return params, param_errs, R2
-        elif self.model == 'Carreau-Yasuda':
-            params.add('eta_0', 100, vary=True, min=0)
-            params.add('eta_inf', 1, vary=True, min=0)
-            params.add('lbda', 5, vary=True, min=0)
-            params.add('a', 1, vary=True, min=0)
-            params.add('n', 1, vary=True, min=0)
-            fit = minimize(self.residual, params, args=(GP, Eta))
-            params = [fit.params[par].value for par in fit.params]
-            param_errs = [fit.params[par].stderr for par in fit.params]
-            SSres = fit.chisqr
-            R2 = 1 - SSres / SStot
-            return params, param_errs, R2
+
+    def lm_curvefit_log(self, GP, Eta, p0, SStot):
+        """Nonlinear part of lm_curvefit for LOG_FIT. Viscosity and shear rate span several decades, so log(Eta)
+        is fitted with the logarithms of the parameters, which keeps every residual and parameter on the same
+        scale and makes the lower bound of 0 implicit. The parameters are converted back, with their errors and
+        covariance propagated to first order (d p = p d log(p)), and R2 is computed on Eta itself, as in
+        lm_curvefit."""
+        from lmfit import Parameters
+        params = Parameters()
+        lower, upper = self.fit_model.bounds
+        for name, value in zip(self.fit_model.param_names, p0):
+            # Parameters fitted to 0 (eta_inf, mostly) would start at log(0)
+            params.add(name, np.log(max(value, 1e-6)), vary=True,
+                       min=np.log(lower) if lower > 0 else -np.inf, max=np.log(upper))
+        fit = self.minimize_nl(params, GP, np.log(Eta), log_fit=True)
+        values = np.exp([fit.params[par].value for par in fit.params])
+        param_errs = [None if fit.params[par].stderr is None else float(value * fit.params[par].stderr)
+                      for par, value in zip(fit.params, values)]
+        self.last_covar = None if fit.covar is None else fit.covar * np.outer(values, values)
+        SSres = np.sum((Eta - self.fit_model.func(GP, *values)) ** 2)
+        R2 = 1 - SSres / SStot
+        return [float(value) for value in values], param_errs, R2
+
+    def minimize_nl(self, params, GP, Eta, log_fit=False):
+        """Runs minimize on the nonlinear residual, giving lmfit the analytic Jacobian if ANALYTIC_JAC is set.
+        Finite differences are used instead if the Jacobian is singular at the initial values, or if the analytic
+        fit raises, does not converge or cannot estimate the errors. With log_fit, Eta is log(Eta) and params are
+        the logarithms of the parameters."""
+        from lmfit import minimize
+        model = self.fit_model
+        if log_fit:
+            residual, residual_jac = model.log_residual, model.log_residual_jac
+        else:
+            residual, residual_jac = model.residual, model.residual_jac
+        # A column of zeros (e.g. Carreau-Yasuda at n=1, where the model is flat) stalls lmder at the start.
+        if self.settings.ANALYTIC_JAC and np.all(np.any(residual_jac(params, GP, Eta) != 0, axis=0)):
+            try:
+                fit = minimize(residual, params, args=(GP, Eta), Dfun=residual_jac)
+                self.nfev += fit.nfev
+                self.stats.solver_run(fit)
+                if fit.success and fit.errorbars:
+                    return fit
+            except (FloatingPointError, OverflowError, ValueError, np.linalg.LinAlgError) as error:
+                self.stats.exception(error)
+            if self.settings.DEBUG:
+                print(f'Debug: analytic Jacobian fit failed on {self.filename}, using finite differences')
+        fit = minimize(residual, params, args=(GP, Eta))
+        self.nfev += fit.nfev
+        self.stats.solver_run(fit)
+        return fit
+
+    def residual_jac(self, params, x, dataset):
+        """Jacobian of residual, which is minus the Jacobian of the model."""
+        return self.fit_model.residual_jac(params, x, dataset)
 
     def residual(self, params, x, dataset):
-        if self.model == 'Carreau':
-            mod = self.fit_Carreau(x, params['eta_0'], params['eta_inf'], params['GP_b'], params['n'])
-        elif self.model == 'Cross':
-            mod = self.fit_Cross(x, params['eta_0'], params['eta_inf'], params['GP_b'], params['n'])
-        elif self.model == 'Carreau-Yasuda':
-            mod = self.fit_CarreauYasuda(x, params['eta_0'], params['eta_inf'], params['lbda'], params['a'],
-                                         params['n'])
-        resid = dataset - mod
-        return resid
+        return self.fit_model.residual(params, x, dataset)
 
     def residual_lin(self, params, x, dataset):
         if type(x) == list:
@@ -329,6 +434,72 @@ class Fitter:
 
         return self.int, self.int_err, self.l_R2
 
+    @staticmethod
+    def lin_window_scan(Eta):
+        """Evaluates every (first_point, last_point) window of the automatic linear search in closed form.
+        With the slope fixed at 0 the least squares fit of a window is its mean, so the intercept, its standard
+        error and the residual sum of squares come from cumulative sums of Eta and Eta**2 in O(1) per window.
+        Returns the arrays first, last, int, int_err and R2, in the same order automatic_lin_fitting_lm tries them."""
+        Eta = np.asarray(Eta, dtype=float)
+        length = len(Eta)
+        shift = np.mean(Eta)  # Centering avoids catastrophic cancellation in SS = S2 - S1**2/N
+        centered = Eta - shift
+        S1 = np.concatenate(([0.], np.cumsum(centered)))
+        S2 = np.concatenate(([0.], np.cumsum(centered ** 2)))
+
+        first, last = np.meshgrid(np.arange(0, length // 3), np.arange(0, length // 2), indexing='ij')
+        valid = last >= first + 3
+        first, last = first[valid], last[valid]  # Row-major, so ordered by first point, then by last point
+
+        N = last - first + 1
+        sum1 = S1[last + 1] - S1[first]
+        sum2 = S2[last + 1] - S2[first]
+        SSres = np.maximum(sum2 - sum1 ** 2 / N, 0)
+        intercept = shift + sum1 / N
+        int_err = np.sqrt(SSres / (N * (N - 1)))
+        # The fitted line is the mean itself, so SSres equals SStot and R2 = 1 - SSres/SStot is always 0.
+        R2 = np.zeros(len(first))
+        return first, last, intercept, int_err, R2
+
+    def automatic_lin_fitting_cumsum(self, save=True):
+        """Same search as automatic_lin_fitting_lm, but every window is scored from prefix sums (see
+        lin_window_scan) instead of running one minimize per window. 'by_error' sorts by the error of the
+        intercept, 'by_error_length' and 'by_R2' use the same keys as automatic_lin_fitting_lm."""
+        first, last, intercept, int_err, R2 = self.lin_window_scan(self.Eta)
+        self.stats.windows['linear'] += len(first)
+        if len(first) == 0:
+            self.manip.logger(self.filename, 'Generic', 'Not enough points for the linear fit')
+            raise ValueError(f'!!!! Not enough points in {self.filename} for the automatic linear fit.')
+
+        with np.errstate(divide='ignore', invalid='ignore'):
+            if self.settings.LIN_SORTING_METHOD == 'by_error':
+                key = np.log(int_err)
+            elif self.settings.LIN_SORTING_METHOD == 'by_error_length':
+                key = np.log(intercept) / (last - first)
+            elif self.settings.LIN_SORTING_METHOD == 'by_R2':
+                key = R2
+            else:
+                raise ValueError(f'Could not understand the sorting method {self.settings.LIN_SORTING_METHOD}')
+        best = np.argmin(np.where(np.isnan(key), np.inf, key))  # argmin keeps the first minimum, like a stable sort
+
+        self.l_first_point = int(first[best])
+        self.l_last_point = int(last[best])
+        self.int = intercept[best]
+        self.int_err = int_err[best]
+        self.l_R2 = R2[best]
+        self.lin_done = True
+
+        if self.settings.DEBUG:
+            print('Debug: windows tried: ', len(first))
+            print('Debug: a: ', self.int)
+            print('Debug: aerr: ', self.int_err)
+
+        if save:
+            self.manip.record_fit('linear', self.int, self.int_err, silent=False,
+                                  extra=f"{self.l_first_point};{self.l_last_point};")
+
+        return self.int, self.int_err, self.l_R2
+
     def automatic_lin_fitting(self, save=True):
         """Goes through all the files, fits them and selects the best fit according to two algorithms.
         First, it selects two points, a beginning and an end point, the first starting at point 0
@@ -342,6 +513,7 @@ class Fitter:
         2. sorting = 'by_error_length': divides the error by how many points were used in the fit.
             May result in a higher overall error, but gives a better representation of the curve.
         """
+        from scipy.optimize import curve_fit
 
         length = len(self.GP)
         fittings = []
@@ -388,7 +560,30 @@ class Fitter:
     # todo: calculate R2 for all fittings and add it in the end to the class
     # todo: add options to sort by R2.
 
+    def nl_sort_key(self, fitting):
+        """Sorting key of a (first_point, params, param_errs, R2, covar) fitting under NL_SORTING_METHOD. Fits
+        whose errors could not be estimated are sorted last."""
+        first_point, params, param_errs, R2, covar = fitting
+        if self.settings.NL_SORTING_METHOD == 'eta_0':
+            key = param_errs[0]
+        elif self.settings.NL_SORTING_METHOD == 'overall':
+            key = None if None in param_errs else sum(param_errs)  # sums the errors
+        elif self.settings.NL_SORTING_METHOD == 'R2':
+            key = R2
+        else:
+            raise ValueError(f'Could not understand the sorting method {self.settings.NL_SORTING_METHOD}')
+        if key is None or np.isnan(key):
+            return np.inf
+        return key
+
     def automatic_nl_fitting_lm(self, save=True):
+        if self.settings.NL_SCAN_MODE == 'coarse_to_fine':
+            return self.automatic_nl_fitting_warm(save)
+        elif self.settings.NL_SCAN_MODE == 'batch':
+            return self.automatic_nl_fitting_batch(save)
+        elif self.settings.NL_SCAN_MODE != 'full':
+            raise ValueError(f'Could not understand the scan mode {self.settings.NL_SCAN_MODE}')
+
         fittings = []
         try:
             max_range = len(self.GP) // self.max_fp
@@ -399,56 +594,191 @@ class Fitter:
             GP_arr = np.array(self.GP[first_point:])
             Eta_arr = np.array(self.Eta[first_point:])
             nonlinear_has_error = ''
+            self.stats.windows['nonlinear'] += 1
             try:
                 params, param_errs, R2 = self.lm_curvefit(GP_arr, Eta_arr, do_lin=False)
-            except FloatingPointError:  # todo: check if these exceptions work
+                covar = self.last_covar
+            except FloatingPointError as error:  # todo: check if these exceptions work
                 print('!!!! Overflow detected on one of the parameters. Could not determine all parameters')
                 nonlinear_has_error = ';param_overflow_during_fitting'
                 self.manip.logger(self.filename, 'Overflow')
-            except RuntimeError:
+                self.stats.exception(error)
+                continue  # As in automatic_nl_fitting_warm, a window that failed is not a candidate
+            except RuntimeError as error:
                 print('!!!! Overflow detected on one of the parameters. Could not determine all parameters')
                 nonlinear_has_error = ';param_overflow_during_fitting'
                 self.manip.logger(self.filename, 'Overflow')
-            except OverflowError:
+                self.stats.exception(error)
+                continue
+            except OverflowError as error:
                 print('!!!! Overflow detected on one of the parameters.')
                 self.manip.logger(self.filename, 'Overflow')
+                self.stats.exception(error)
+                continue
 
-            fittings.append((first_point, params, param_errs, R2))
+            fittings.append((first_point, params, param_errs, R2, covar))
 
-        if self.settings.NL_SORTING_METHOD == 'eta_0':
-            fittings.sort(key=lambda x: x[2][0])
-        elif self.settings.NL_SORTING_METHOD == 'overall':
-            # fittings.sort(key=lambda x: x[2][0] + x[2][1] + x[2][2] + x[2][3])
-            fittings.sort(key=lambda x: sum(x[2]))  # sums the errors
-        elif self.settings.NL_SORTING_METHOD == 'R2':
-            fittings.sort(key=lambda x: x[3])
-        else:
-            raise ValueError(f'Could not understand the sorting method {self.settings.NL_SORTING_METHOD}')
+        if len(fittings) == 0:
+            raise ValueError(f'!!!! Could not fit {self.model} to any window of {self.filename}')
+        fittings.sort(key=self.nl_sort_key)
 
         self.nl_first_point = fittings[0][0]
         self.params = fittings[0][1]
         self.param_errs = fittings[0][2]
         self.nl_R2 = fittings[0][3]
+        self.covar = fittings[0][4]
+        self.nl_error = nonlinear_has_error
 
-        if save:  # todo: check here to return a good destination file
+        if save:
+            self.record_nl_fit(nonlinear_has_error)
+
+        self.nl_done = True
+        return self.nl_first_point, self.params, self.param_errs, self.nl_R2
+
+    def automatic_nl_fitting_batch(self, save=True):
+        """Scans the same first points as automatic_nl_fitting_lm, but fits all of their windows at once with
+        BatchFit.batch_fit, padded to a common length. Windows that did not converge, or whose errors could not
+        be estimated, are left out. The best one under NL_SORTING_METHOD is then fitted again with lm_curvefit,
+        starting from the batch parameters, so that its errors and covariance, and LOG_FIT, are those of lmfit."""
+        import BatchFit
+        try:
+            max_range = len(self.GP) // self.max_fp
+        except ZeroDivisionError:
+            max_range = 1
+
+        GP, Eta, mask = BatchFit.pad_curves([(self.GP[first_point:], self.Eta[first_point:])
+                                             for first_point in range(max_range)])
+        self.stats.windows['nonlinear'] += max_range
+        params, param_errs, R2, success = BatchFit.batch_fit(GP, Eta, self.model, mask, p0=self.initial_params)
+        fittings = [(first_point, list(params[first_point]), list(param_errs[first_point]), R2[first_point], None)
+                    for first_point in np.flatnonzero(success)]
+        if len(fittings) == 0:
+            raise ValueError(f'!!!! Could not fit {self.model} to any window of {self.filename}')
+        first_point, p0 = min(fittings, key=self.nl_sort_key)[:2]
+
+        if self.settings.DEBUG:
+            print(f'Debug: {len(fittings)} of {max_range} first points converged in batch')
+
+        nonlinear_has_error = ''
+        try:
+            self.params, self.param_errs, self.nl_R2 = self.lm_curvefit(self.GP[first_point:], self.Eta[first_point:],
+                                                                        do_lin=False, p0=p0)
+        except (FloatingPointError, RuntimeError, OverflowError) as error:
+            print('!!!! Overflow detected on one of the parameters. Could not determine all parameters')
+            nonlinear_has_error = ';param_overflow_during_fitting'
+            self.manip.logger(self.filename, 'Overflow')
+            self.stats.exception(error)
+            raise ValueError(f'!!!! Could not fit {self.model} to the best window of {self.filename}') from error
+        self.nl_first_point = int(first_point)
+        self.covar = self.last_covar
+        self.nl_error = nonlinear_has_error
+
+        if save:
+            self.record_nl_fit(nonlinear_has_error)
+
+        self.nl_done = True
+        return self.nl_first_point, self.params, self.param_errs, self.nl_R2
+
+    def automatic_nl_fitting_warm(self, save=True, step=None, candidates=3):
+        """Scans the same first points as automatic_nl_fitting_lm, but in two passes. The coarse pass fits every
+        step-th first point, seeding each fit with the parameters of the previous one. The fine pass then fits
+        the first points around the best candidates under NL_SORTING_METHOD, walking outwards from each
+        candidate and seeding every fit with its converged neighbour. step defaults to sqrt(max_range)."""
+        try:
+            max_range = len(self.GP) // self.max_fp
+        except ZeroDivisionError:
+            max_range = 1
+        if step is None:
+            step = max(1, int(np.sqrt(max_range)))
+
+        fittings = {}  # first_point: (first_point, params, param_errs, R2, covar)
+        nonlinear_has_error = ''
+
+        def try_fit(first_point, p0):
+            nonlocal nonlinear_has_error
+            self.stats.windows['nonlinear'] += 1
             try:
-                self.manip.record_fit(
-                    self.filename, self.params[0],
-                    self.param_errs[0], silent=False,
-                    extra=f"{fittings[0][0]};{fittings[0][1]};nonlinear_auto_{self.settings.NL_FITTING_METHOD};"
-                          f"{nonlinear_has_error}", fdest_name=self.settings.NL_FITTING_METHOD + '.csv'
-                )
-            except UnboundLocalError:
-                print('Unable to write to file because the subroutine did not return the fitting parameters')
-                print(traceback.format_exc())
-                self.manip.record_fit(self.filename, 0, 0, extra=f'nonlinear_auto_{self.settings.NL_FITTING_METHOD};'
-                                                                 f'unable_to_find_viscosity',
-                                      fdest_name=self.settings.NL_FITTING_METHOD + '.csv')
-                self.manip.logger(self.filename, 'No Viscosity')
+                params, param_errs, R2 = self.lm_curvefit(self.GP[first_point:], self.Eta[first_point:],
+                                                          do_lin=False, p0=p0)
+            except (FloatingPointError, RuntimeError) as error:
+                print('!!!! Overflow detected on one of the parameters. Could not determine all parameters')
+                nonlinear_has_error = ';param_overflow_during_fitting'
+                self.manip.logger(self.filename, 'Overflow')
+                self.stats.exception(error)
+                return p0
+            except OverflowError as error:
+                print('!!!! Overflow detected on one of the parameters.')
+                self.manip.logger(self.filename, 'Overflow')
+                self.stats.exception(error)
+                return p0
+            fittings[first_point] = (first_point, params, param_errs, R2, self.last_covar)
+            return params
+
+        p0 = None
+        for first_point in range(0, max_range, step):
+            p0 = try_fit(first_point, p0)
+
+        best = sorted(fittings.values(), key=self.nl_sort_key)[:candidates]
+        for first_point, params, _, _, _ in best:
+            for direction in (-1, 1):
+                p0 = params
+                for neighbour in range(first_point + direction, first_point + direction * step, direction):
+                    if not 0 <= neighbour < max_range:
+                        break
+                    if neighbour in fittings:
+                        p0 = fittings[neighbour][1]
+                        continue
+                    p0 = try_fit(neighbour, p0)
+
+        if len(fittings) == 0:
+            raise ValueError(f'!!!! Could not fit {self.model} to any window of {self.filename}')
+        fittings = sorted(fittings.values(), key=self.nl_sort_key)
+
+        if self.settings.DEBUG:
+            print(f'Debug: {len(fittings)} of {max_range} first points fitted, {self.nfev} function evaluations')
+
+        self.nl_first_point = fittings[0][0]
+        self.params = fittings[0][1]
+        self.param_errs = fittings[0][2]
+        self.nl_R2 = fittings[0][3]
+        self.covar = fittings[0][4]
+        self.nl_error = nonlinear_has_error
+
+        if save:
+            self.record_nl_fit(nonlinear_has_error)
 
         self.nl_done = True
         return self.nl_first_point, self.params, self.param_errs, self.nl_R2
 
+    def record_nl_fit(self, nonlinear_has_error=''):
+        """Records the selected nonlinear fit in <NL_FITTING_METHOD>.csv"""
+        try:  # todo: check here to return a good destination file
+            self.manip.record_fit(
+                self.filename, self.params[0],
+                self.param_errs[0], silent=False,
+                extra=f"{self.nl_first_point};{self.params};nonlinear_auto_{self.settings.NL_FITTING_METHOD};"
+                      f"{nonlinear_has_error}", fdest_name=self.settings.NL_FITTING_METHOD + '.csv'
+            )
+        except (AttributeError, TypeError):
+            print('Unable to write to file because the subroutine did not return the fitting parameters')
+            print(traceback.format_exc())
+            self.manip.record_fit(self.filename, 0, 0, extra=f'nonlinear_auto_{self.settings.NL_FITTING_METHOD};'
+                                                             f'unable_to_find_viscosity',
+                                  fdest_name=self.settings.NL_FITTING_METHOD + '.csv')
+            self.manip.logger(self.filename, 'No Viscosity')
+
+    def curve_fit_nl(self, func, jac, GP, Eta, **kwargs):
+        """curve_fit with the analytic Jacobian jac if ANALYTIC_JAC is set, falling back to finite differences
+        if that fit fails."""
+        from scipy.optimize import curve_fit
+        if self.settings.ANALYTIC_JAC:
+            try:
+                return curve_fit(func, GP, Eta, jac=jac, **kwargs)
+            except (RuntimeError, FloatingPointError, OverflowError, ValueError, np.linalg.LinAlgError):
+                if self.settings.DEBUG:
+                    print(f'Debug: analytic Jacobian fit failed on {self.filename}, using finite differences')
+        return curve_fit(func, GP, Eta, **kwargs)
+
     def automatic_nl_fitting(self, save=True):
         fittings = []
         try:
@@ -461,15 +791,9 @@ class Fitter:
             Eta_arr = np.array(self.Eta[first_point:])
             nonlinear_has_error = ''
             try:
-                if self.settings.NL_FITTING_METHOD == 'Carreau':
-                    popt, pcov = curve_fit(self.fit_Carreau, GP_arr, Eta_arr, bounds=(0, np.inf))
-                elif self.settings.NL_FITTING_METHOD == 'Cross':
-                    popt, pcov = curve_fit(self.fit_Cross, GP_arr, Eta_arr, bounds=(0, np.inf))
-                elif self.settings.NL_FITTING_METHOD == 'Carreau-Yasuda':
-                    popt, pcov = curve_fit(self.fit_CarreauYasuda, GP_arr, Eta_arr)
-                else:
-                    raise ValueError(f'Model not present: {self.settings.NL_FITTING_METHOD}')
-
+                popt, pcov = self.curve_fit_nl(self.fit_model.func, self.fit_model.jac, GP_arr, Eta_arr,
+                                               p0=self.initial_params,
+                                               bounds=self.fit_model.bounds)
             except FloatingPointError:
                 print('!!!! Overflow detected on one of the parameters. Could not determine all parameters')
                 nonlinear_has_error = ';param_overflow_during_fitting'
@@ -483,7 +807,7 @@ class Fitter:
                 self.manip.logger(self.filename, 'Overflow')
 
             perr = np.sqrt(np.diag(pcov))
-            fittings.append((first_point, popt, perr))
+            fittings.append((first_point, popt, perr, pcov))
 
             if self.settings.DEBUG:
                 fitting_params_str = ' '.join([str(round(i, 2)) + '+/-' +
@@ -502,6 +826,7 @@ class Fitter:
         self.nl_first_point = fittings[0][0]
         self.params = fittings[0][1]
         self.param_errs = fittings[0][2]
+        self.covar = fittings[0][3]
 
         if save:  # todo: check here to return a good destination file
             try:
@@ -525,30 +850,28 @@ class Fitter:
     # TODO: check if the bounds are correct
     # TODO: increment this function to be able to accept multiple fittings
     def manual_fit(self, first, last, fit_types, save=True):
-        GP_arr = np.array(self.GP[first:last + 1])
-        Eta_arr = np.array(self.Eta[first:last + 1])
+        from scipy.optimize import curve_fit
+        end = None if last == -1 else last + 1  # last=-1 is the last point, not an empty slice
+        GP_arr = np.array(self.GP[first:end])
+        Eta_arr = np.array(self.Eta[first:end])
         fittings = []
+        if isinstance(fit_types, str):  # A single fit, as fit() asks for
+            fit_types = [fit_types]
 
         for type in fit_types:
-            if 'Linear' in type:
+            if type == 'Linear':
                 popt, pcov = curve_fit(self.fit_lin, GP_arr, Eta_arr, p0=(30, 0),
                                        bounds=(0, [self.VISC_LIMIT, 0.0001]))
-            elif 'Carreau' in type:
-                popt, pcov = curve_fit(self.fit_Carreau, GP_arr, Eta_arr, p0=(30, 0),
-                                       bounds=(0, np.inf))
-            elif 'Cross' in type:
-                popt, pcov = curve_fit(self.fit_Carreau, GP_arr, Eta_arr, p0=(30, 0),
-                                       bounds=(0, np.inf))
-            elif 'Carreau-Yasuda' in type:
-                popt, pcov = curve_fit(self.fit_CarreauYasuda, GP_arr, Eta_arr, p0=(30, 0),
-                                       bounds=(0, np.inf))
             else:
-                raise NameError(f'Could not understand the list fit_types {fit_types}')
+                model = Models.get_model(type)
+                popt, pcov = self.curve_fit_nl(model.func, model.jac, GP_arr, Eta_arr,
+                                               p0=model.initial_guess(self.features), bounds=model.bounds)
 
             perr = np.sqrt(np.diag(pcov))
 
             self.params = popt  # Will be continuously overwritten. todo: will this be a problem?
             self.param_errs = perr
+            self.covar = pcov
 
             if self.settings.DEBUG:
                 # 'a+/-aerr b+/-berr ...'
@@ -572,83 +895,44 @@ class Fitter:
     #                   )
     # at.patch.set_boxstyle("round,pad=0.,rounding_size=0.2")
     # ax.add_artist(at)
-    def plot_error_graphs(self): # todo: If it has both plots, make them side by side
-        from mpl_toolkits.axes_grid.anchored_artists import AnchoredText
-        TEXT_FILENAME_X = 0.1
-        TEXT_PARAMS_X = 0.3
-        TEXT_Y = 0.98
-        x = np.logspace(np.log10(self.GP[0]), np.log10(self.GP[-1]))
-
+    def plot_error_graphs(self):
+        """Plots the points with the fitted curves and their uncertainty, side by side if both fits were done.
+        If the plot is only saved, it is rendered without a display by PlotRenderer."""
+        with self.stats.stage('plot'):
+            self._plot_error_graphs()
+
+    def _plot_error_graphs(self):
+        import PlotRenderer
         if self.settings.DEBUG:
-            print('Debug: x', x)
             print('Debug: params', self.params)
             print('Debug: GP', self.GP, 'Eta', self.Eta)
 
-        if self.nl_done:
-            if self.model == 'Carreau':
-                y, yerr = self.carr_uncertainty(x, *self.params, *self.param_errs)
-            elif self.model == 'Cross':
-                y, yerr = self.cross_uncertainty(x, *self.params, *self.param_errs)
-            elif self.model == 'Carreau-Yasuda':
-                y, yerr = self.carryas_uncertainty(x, *self.params, *self.param_errs)
-        if self.lin_done:
-            y_l, yerr_l = np.ones(len(x)) * self.int, np.ones(len(x)) * self.int_err
-            # Creates a horizontal line with n points
-
-        if self.nl_done and self.lin_done:
-            fig, [axn, axl] = plt.subplots(ncols=2, nrows=1, figsize=(12, 4))
-        elif self.nl_done and not self.lin_done:
-            fig, axn = plt.subplots(ncols=1, nrows=1, figsize=(6, 4))
-        elif not self.nl_done and not self.lin_done:
-            fig, axl = plt.subplot(ncols=1, nrows=1, figsize=(6, 4))
-
-        if self.nl_done:
-            axn.set_xscale('log')
-            axn.set_yscale('log')
-            axn.plot(self.GP, self.Eta, linewidth=0, marker='o', markersize=5)
-            axn.errorbar(x, y, yerr=yerr)
-            axn.annotate(str(self.nl_first_point + 1), (self.GP[self.nl_first_point], self.Eta[self.nl_first_point]), color='red')
-            if self.nl_last_point == -1:
-                axn.annotate(str(len(self.GP)), (self.GP[self.nl_last_point], self.Eta[self.nl_last_point]),
-                             color='red')  # todo: check this function
-            else:
-                axn.annotate(str(self.nl_last_point), (self.GP[self.nl_last_point], self.Eta[self.nl_last_point]), color='red')
-            model_param_names = 'Model: ' + self.model + ' Params: ' + self.param_names
-            param_text = " ".join([str(round(par, 2)) + '+/-' + str(round(err, 2))
-                                   for par, err in zip(self.params, self.param_errs)])
-            total_text = f'{self.filename}\n{model_param_names}\n{param_text}\n$R^2$={round(self.nl_R2, 2)}'
-            anchored_text = AnchoredText(total_text, loc=3, frameon=True, prop={'fontsize':'small'})
-            axn.add_artist(anchored_text)
-
-        if self.lin_done:
-            axl.set_xscale('log')
-            axl.set_yscale('log')
-            axl.plot(self.GP, self.Eta, linewidth=0, marker='o', markersize=5)
-            axl.errorbar(x, y_l, yerr=yerr_l)
-            axl.annotate(str(self.l_first_point + 1), (self.GP[self.l_first_point], self.Eta[self.l_first_point]), color='red')
-            if self.l_last_point == -1:
-                axl.annotate(str(len(self.GP)), (self.GP[self.l_last_point], self.Eta[self.l_last_point]),
-                             color='red')  # todo: check this function
-            else:
-                axl.annotate(str(self.l_last_point), (self.GP[self.l_last_point], self.Eta[self.l_last_point]), color='red')
-            
-            model_param_names = 'Model: Linear. Params: Intercept'
-            param_text = f"int = {self.int}+/-{self.int_err}"
-            total_text = f'{self.filename}\n{model_param_names}\n{param_text}\n$R^2$={round(self.l_R2, 2)}'
-            anchored_text = AnchoredText(total_text, loc=3, frameon=True, prop={'fontsize':'small'})
-            axl.add_artist(anchored_text)
-
+        data = PlotRenderer.plot_data(self)
+        if not data['panels']:
+            return
+        if not self.settings.PLOT_GRAPHS:
+            if self.settings.SAVE_GRAPHS:
+                Fitter.renderer = Fitter.renderer or PlotRenderer.PlotRenderer()
+                Fitter.renderer.render(data)
+                print('Figure saved.')
+            return
+
+        plt = pyplot()
+        fig, axes = plt.subplots(ncols=len(data['panels']), nrows=1, figsize=(6 * len(data['panels']), 4),
+                                 squeeze=False)
+        for ax, panel in zip(axes[0], data['panels']):
+            PlotRenderer.draw_panel(ax, data['GP'], data['Eta'], panel)
         plt.tight_layout()
 
         if self.settings.SAVE_GRAPHS:
-            fig.savefig(self.filename[:-4] + '.png')
+            fig.savefig(data['path'])
             print('Figure saved.')
-        if not self.settings.INLINE_GRAPHS and self.settings.PLOT_GRAPHS:
+        if not self.settings.INLINE_GRAPHS:
             plt.draw()
             plt.pause(self.wait)
             #plt.clf()
             plt.close(fig)
-        elif self.settings.PLOT_GRAPHS:
+        else:
             plt.show()
         return
 
@@ -661,62 +945,15 @@ class FileManip:
     def ExtractData(fname, FC_segment=0):
         """Opens the file fname and extracts the data based on where it finds the word 'Eta' and 'GP', these being
         the Viscosity and the Shear Rate (gamma point). If the file has multiple segments, for example, when multiple
-        experiments were done in succession, FC_segment indicates which of those experiments was a Flow Curve."""
-        fhand = open(fname, 'r')
-        GP = []
-        Eta = []
-        column_eta = 0
-        column_gp = 0
-        # FC_segment = '3'
-
-        # while FC_segment == 0:
-        #    FC_segment = input("What is the segment that has the flow curves? (eg. [1], 2, 3) If you do not know, don't write anything. ")
-        #    if FC_segment == '':
-        #        print(fhand.read())
-        #    elif FC_segment.isnumeric():
-        #        break
-        #    else:
-        #        print('Not a valid number')
-
-        for line in fhand:
-            if line.startswith(';'):
-                column_names = line.rstrip().split(';')
-                # if settings['DEBUG']:
-                #     print('Debug: column names', column_names)
-                for i, column in enumerate(column_names):
-                    if 'Eta' in column and 'Eta*' not in column:
-                        column_eta = i
-                        #if settings['DEBUG']:
-                        #    print('Debug: Found Eta at', column_eta)
-                    if 'GP' in column:
-                        column_gp = i
-                        #if settings['DEBUG']:
-                        #    print('Debug: Found GP at', column_gp)
-            try:
-                GP.append(float(line.replace(',', '.').split(';')[column_gp]))
-                Eta.append(float(line.replace(',', '.').split(';')[column_eta]))
-            except:
-                pass
-
-            # if line.startswith(FC_segment + '|'):
-            #    line = line.rstrip()
-            #    num, gp, tau, eta, *rest = line.replace(',','.').split(';')
-            #    GP.append(float(gp))
-            #    Eta.append(float(eta))
-            #    #print(line)
-
-        fhand.close()
-        if len(GP) == 0:
-            # print('!!!!No Flow Curve data was found! Re-export the data on file', fname)
-            raise ValueError
-        # return pd.Series(GP), pd.Series(Eta)
-        # if settings['DEBUG']:
-        #     print('Debug: Extracted Data: GP:', GP, 'Eta:', Eta)
-        return GP, Eta
+        experiments were done in succession, FC_segment indicates which of those experiments was a Flow Curve.
+        With FC_segment=0, all flow curve segments are returned one after the other.
+        The file is parsed by ExportReader.read_flow_curve, which returns two float arrays."""
+        return ExportReader.read_flow_curve(fname, None if FC_segment in (0, '0', None) else FC_segment)
 
     @staticmethod
     def ExtractData_pd(fname):
         """Uses pandas do extract the data if it was exported using the data extraction tool"""
+        import pandas as pd
         pd_temp = pd.read_csv(fname, delimiter=';', encoding='latin1', decimal=',')
         pd_temp = pd_temp[pd_temp > 0].dropna()
 
@@ -743,7 +980,11 @@ class FileManip:
 
         with open(fdest_name, 'a', encoding='utf-8') as fdest:
             #fdest.write(name + ';' + str(eta0) + ';' + str(eta0_err) + ';' + extra + '\n')
-            fdest.write(f"{name};{eta0};{eta0_err};{extra}\n")
+            fdest.write(FileManip.fit_line(name, eta0, eta0_err, extra))
+
+    @staticmethod
+    def fit_line(name, eta0, eta0_err, extra=''):
+        return f"{name};{eta0};{eta0_err};{extra}\n"
 
     @staticmethod
     def select_files():
@@ -775,21 +1016,74 @@ class FileManip:
     @staticmethod
     def logger(file, type, extra=''):
         with open('log', 'a') as log:
-            if type == 'Overflow':
-                log.write(f'Parameter overflow while trying to fit file {file}: {extra}\n')
-            if type == 'No Viscosity':
-                log.write(f'Unable to find viscosity for file {file}\n')
-            if type == 'Failed to open':
-                log.write(f'Failed to open file {file}. Re-export the data.')
-            else:  # type == 'Generic'
-                log.write(f'Error while processing {file}: {extra}\n')
+            log.write(FileManip.log_text(file, type, extra))
+
+    @staticmethod
+    def log_text(file, type, extra=''):
+        text = ''
+        if type == 'Overflow':
+            text += f'Parameter overflow while trying to fit file {file}: {extra}\n'
+        if type == 'No Viscosity':
+            text += f'Unable to find viscosity for file {file}\n'
+        if type == 'Failed to open':
+            text += f'Failed to open file {file}. Re-export the data.'
+        else:  # type == 'Generic'
+            text += f'Error while processing {file}: {extra}\n'
+        return text
+
+
+class BufferedFileManip(FileManip):
+    """Keeps the calls to record_fit and logger in memory instead of writing them, so that a Fitter running in
+    another process does not write to the results files or the log. flush replays them, in order, in the
+    process that owns the files."""
+    def __init__(self):
+        self.records = []
+
+    def record_fit(self, *args, **kwargs):
+        self.records.append(('record_fit', args, kwargs))
+
+    def logger(self, *args, **kwargs):
+        self.records.append(('logger', args, kwargs))
+
+    @staticmethod
+    def flush(records, manip=FileManip):
+        for method, args, kwargs in records:
+            getattr(manip, method)(*args, **kwargs)
+
 
+class BatchFileManip(FileManip):
+    """record_fit and logger for a batch: the lines are kept in memory, by file, and each file (results.csv,
+    linear.csv, <model>.csv, log) is opened once per flush to append all of its lines, instead of once per line.
+    What record_fit prints is still printed when it is called."""
+    def __init__(self):
+        self.lines = {}
 
-def test():
+    def record_fit(self, name, eta0, eta0_err, silent=False, extra='', fdest_name='results.csv'):
+        if not silent:
+            print(f"{name}: Intercept={eta0} +- {eta0_err}. Extra={extra}")
+        self.lines.setdefault(fdest_name, []).append(self.fit_line(name, eta0, eta0_err, extra))
+
+    def logger(self, file, type, extra=''):
+        self.lines.setdefault('log', []).append(self.log_text(file, type, extra))
+
+    def flush(self):
+        for fname, lines in self.lines.items():
+            with open(fname, 'a', encoding='utf-8') as fdest:
+                fdest.writelines(lines)
+        self.lines = {}
+
+
+def test(filename=None):
+    """Fits filename, or a synthetic Carreau-Yasuda curve (see Benchmark.synthetic_curve), with Carreau-Yasuda"""
     settings = Settings.Settings()
     settings.NL_FITTING_METHOD = 'Carreau-Yasuda'
-    filename = 'CF_Sac50-3--0.csv'
-    fit = Fitter(filename, settings, do_fit=False)
+    data = None
+    if filename is None:
+        import Benchmark
+        GP, Eta, params = Benchmark.synthetic_curve(np.random.default_rng(0), 'Carreau-Yasuda')
+        filename, data = 'synthetic.csv', (GP, Eta)
+        print('Synthetic curve with', *params)
+    fit = Fitter(filename, settings, do_fit=False, data=data)
     fit.automatic_nl_fitting_lm(save=True)
     print(fit.model, fit.nl_R2, *fit.params)
 
@@ -804,7 +1098,11 @@ def main():
     if do_change == 'y':
         settings.edit_settings()
 
-    if settings.TREAT_ALL:
+    import BatchRunner
+    store = BatchRunner.open_store(settings)
+    if settings.TREAT_ALL and store is not None:
+        files = store.names(kind='CF')
+    elif settings.TREAT_ALL:
         files = glob.glob(f'*.{settings.EXT}')
         if len(files) == 0:
             print(f'No files with the extension {settings.EXT} found.'
@@ -818,66 +1116,46 @@ def main():
         print('No files selected. Quitting.')
         sys.exit()
 
-    for file in files:
-        try:
-            fit = Fitter(file, settings, do_fit=True)
-        except ValueError:  # todo: debug and check what would be needed here.
-            print(f'Skipping {file}: Value Error')
-            continue
-        except KeyError:
-            print(f'Skipping {file} Key Error')
+    renderer = None
+    if settings.SAVE_GRAPHS and not settings.PLOT_GRAPHS:  # Saved while the next files are fitted
+        import PlotRenderer
+        renderer = PlotRenderer.RenderPool(int(settings.PLOT_WORKERS))
+    report = None
+    if settings.REPORT:
+        import Report
+        report = Report.Report(settings.REPORT, int(settings.PLOT_WORKERS))
+    skipped = []
+    for file, fit, error in BatchRunner.run_batch(files, settings, int(settings.WORKERS), skipped=skipped):
+        if error is not None:  # todo: debug and check what would be needed here.
+            print(f'Skipping {file}: {error}')
             continue
-            #print(traceback.format_exc())
 
-        if settings.PLOT_GRAPHS or settings.SAVE_GRAPHS:
+        if report is not None:
+            report.add(fit)
+        if renderer is not None:
+            renderer.submit(fit)
+        elif settings.PLOT_GRAPHS or settings.SAVE_GRAPHS:
             try:
                 fit.plot_error_graphs()
             except OverflowError:  # todo: write which parameter has overflown
                 print('!!!! Overflow detected on one of the parameters. Could not plot the data')
-                nonlinear_has_error = ';param_overflow_during_fitting'
                 # todo: log this
             except UnboundLocalError:
                 print('Not able to write to file because the subroutine did not return the fitting parameters')
                 # todo: log this
 
-
-            #fit.plot_error_graphs(file[:-4] + '_lin_' + file[-4:], fit.params, fit.first_point, fit.last_point,
-            #                      model=fit.settings.NL_FITTING_METHOD, param_names=[''])
-
-                # # except:
-                # #     print('Error found while plotting the linear fit')
-                # #     print(traceback.format_exc())
-                # #     lin_has_error = 'error_during_fitting'
-                # record(file, a, aerr,
-                #        extra='linear automatic;FP=' + str(lin_points[0]) + 'LP=' + str(lin_points[1]) +
-                #              lin_has_error, fdest_name='linear.csv')
-
-
-            #         if settings['PLOT_GRAPHS']:
-            #             plot_error_graphs(file[:-4] + '_carr_' + file[-4:], GP, Eta,
-            #                               params=np.concatenate((popt, perr)),
-            #                               first_point=nl_first, model=settings['NL_FITTING_METHOD'],
-            #                               param_names=Param_names_errs[settings['NL_FITTING_METHOD']])
-            #     except OverflowError:  # todo: write which parameter has overflown
-            #         print('!!!! Overflow detected on one of the parameters. Could not plot the data')
-            #         nonlinear_has_error = ';param_overflow_during_fitting'
-            #     try:
-            #         record(file, popt[0], perr[0], extra='nonlinear_auto_' + settings['NL_FITTING_METHOD'] +
-            #                                              nonlinear_has_error,
-            #                fdest_name=settings['NL_FITTING_METHOD'] + '.csv')
-            #     except UnboundLocalError:
-            #         print('Not able to write to file because the subroutine did not return the fitting parameters')
-            #         record(file, 0, 0, extra='nonlinear_auto_' + settings['NL_FITTING_METHOD'] + ';' +
-            #                                  'unable_to_find_viscosity',
-            #                fdest_name=settings['NL_FITTING_METHOD'] + '.csv')
-            #         with open('log', 'a') as log:
-        #     #             log.write('Unable to find viscosity for file ' + file + '\n')
-        # except:
-        #     print('!!!!We have encountered an error while processing file', file)
-        #     print(traceback.format_exc())
-        #     with open('log', 'a') as log:
-        #         log.write('Error while processing ' + file + '\n')
-        #         log.write(traceback.format_exc())
+    if renderer is not None:
+        for path, error in renderer.close():
+            print(f'Could not save {path}: {error}')
+    if skipped:
+        print(f'{len(files) - len(skipped)} files fitted, {len(skipped)} skipped as unchanged or already done')
+    if report is not None:
+        for file, fit, error in BatchRunner.load_fits(skipped, settings, int(settings.WORKERS)):
+            if fit is not None:  # The report shows the whole batch, including the files fitted before
+                report.add(fit)
+        for file, error in report.close():
+            print(f'Could not add {file} to the report: {error}')
+        print(f'Report: {settings.REPORT}, {report.n_pages} pages, {len(report.sheets)} contact sheets')
 
 if __name__ == '__main__':
     fit = test()
@@ -8,10 +8,25 @@ class Settings:
                                'NL_FITTING_METHOD', 'NL_SORTING_METHOD',
                                'PLOT_GRAPHS', 'SAVE_GRAPHS', 'AUTO_LIN', 'AUTO_NL', 'DO_LIN',
                                'DO_NL', 'TREAT_ALL', 'EXT', 'PREV_EXTRACTED', 'WAIT', 'FIXED_FP_NL',
-                               'MAX_FP_NL']
+                               'MAX_FP_NL', 'NL_SCAN_MODE', 'ANALYTIC_JAC', 'LOG_FIT', 'DATA_GUESS', 'WORKERS',
+                               'CACHE_DIR', 'CACHE_MAX_MB', 'SPLIT_SEGMENTS', 'CURVE_STORE',
+                               'RESULTS_TABLE', 'RESULTS_DB', 'MANIFEST', 'PRUNE_STALE',
+                               'JOURNAL', 'PLOT_WORKERS', 'REPORT', 'STATS']
+        # Settings added after the settings file format was created. Older settings files do not have them,
+        # so these defaults are used for whatever was not loaded.
+        self.optional_defaults = {'NL_SCAN_MODE': 'full', 'ANALYTIC_JAC': True, 'LOG_FIT': False,
+                                  'DATA_GUESS': True, 'WORKERS': 1, 'CACHE_DIR': '', 'CACHE_MAX_MB': 100,
+                                  'SPLIT_SEGMENTS': False, 'CURVE_STORE': 'curves',
+                                  'RESULTS_TABLE': '', 'RESULTS_DB': '', 'MANIFEST': '',
+                                  'PRUNE_STALE': False, 'JOURNAL': '', 'PLOT_WORKERS': 1,
+                                  'REPORT': '', 'STATS': ''}
+        self.valid_options_nl_scan = ['full', 'coarse_to_fine', 'batch']
         self.valid_options_lin_sorting = ['by_error', 'by_error_length', 'by_R2']
         self.valid_options_nl_sorting = ['eta_0', 'overall', 'R2']
-        self.models = ['Carreau', 'Cross', 'Carreau-Yasuda']
+        self.models = ['Carreau', 'Cross', 'Carreau-Yasuda', 'PowerLaw']
+        # Settings that are numbers: their type and smallest valid value
+        self.numeric_settings = {'WAIT': (float, 0), 'MAX_FP_NL': (int, 1), 'WORKERS': (int, 0),
+                                 'CACHE_MAX_MB': (float, 0), 'PLOT_WORKERS': (int, 0)}
         if debug:
             self.DEBUG = True
         else:
@@ -19,12 +34,15 @@ class Settings:
 
         try:
             self.load_settings()
+            for param, default in self.optional_defaults.items():
+                if not hasattr(self, param):
+                    setattr(self, param, default)
         except FileNotFoundError:
             print('Settings file not found. Loading defaults.')
             self.DEBUG = False
             self.INLINE_GRAPHS = False
             self.LIN_SORTING_METHOD = 'by_error_length'  # by_error, by_error_length, by_R2
-            self.NL_FITTING_METHOD = 'Carreau'  # Carreau, Cross, Carreau-Yasuda
+            self.NL_FITTING_METHOD = 'Carreau'  # Carreau, Cross, Carreau-Yasuda, PowerLaw
             self.NL_SORTING_METHOD = 'overall'  # eta_0, overall, R2
             self.PLOT_GRAPHS = False
             self.SAVE_GRAPHS = False
@@ -38,6 +56,8 @@ class Settings:
             self.WAIT = '0.5'
             self.FIXED_FP_NL = True
             self.MAX_FP_NL = 2
+            for param, default in self.optional_defaults.items():
+                setattr(self, param, default)
             print('Creating a new settings file with the defaults')
             self.save_settings()
 
@@ -52,7 +72,7 @@ class Settings:
                 '\n# Plot graphs after fitting, with error propagation? Slows down the process greatly.\n')
             settings_file.write('PLOT_GRAPHS=' + str(self.PLOT_GRAPHS))
 
-            settings_file.write('\n# Save graphs after fitting? Useless if PLOT_GRAPHS is set to False\n')
+            settings_file.write('\n# Save graphs after fitting? If PLOT_GRAPHS is False, they are saved without being shown\n')
             settings_file.write('SAVE_GRAPHS=' + str(self.SAVE_GRAPHS))
 
             settings_file.write('\n# When plotting, time it waits until the next plot is shown,'
@@ -88,7 +108,7 @@ class Settings:
             settings_file.write('\n# Perform non-linear fitting?\n')
             settings_file.write('DO_NL=' + str(self.DO_NL))
 
-            settings_file.write("\n# Fitting method. 'Carreau', 'Cross', 'Carreau-Yasuda'\n")
+            settings_file.write("\n# Fitting method. 'Carreau', 'Cross', 'Carreau-Yasuda', 'PowerLaw'\n")
             settings_file.write('NL_FITTING_METHOD=' + str(self.NL_FITTING_METHOD))
 
             settings_file.write("\n# Can be 'overall', minimizing the error of all parameters,  'eta_0', " +
@@ -106,6 +126,79 @@ class Settings:
                                 'recommended. 2 would be up to half the curve, etc.\n')
             settings_file.write('MAX_FP_NL=' + str(self.MAX_FP_NL))
 
+            settings_file.write("\n# How the first points are scanned. 'full' fits every first point from the default guesses. "
+                                "'coarse_to_fine' fits a coarse grid of first points, then refines around the best "
+                                "ones, seeding each fit with the parameters of its neighbour. 'batch' fits every first "
+                                "point at once with BatchFit, then refits the best one with lmfit.\n")
+            settings_file.write('NL_SCAN_MODE=' + str(self.NL_SCAN_MODE))
+
+            settings_file.write('\n# Use the exact derivatives of the models during fitting? If False, or if a fit fails with '
+                                'them, finite differences are used.\n')
+            settings_file.write('ANALYTIC_JAC=' + str(self.ANALYTIC_JAC))
+
+            settings_file.write('\n# Fit log(Eta) with the logarithms of the parameters? Better suited to curves spanning '
+                                'several decades. The results are converted back to the parameters themselves.\n')
+            settings_file.write('LOG_FIT=' + str(self.LOG_FIT))
+
+            settings_file.write('\n# Start the fits from values estimated from each curve (plateaus, transition and slope)? '
+                                'If False, the same fixed values are used for every curve.\n')
+            settings_file.write('DATA_GUESS=' + str(self.DATA_GUESS))
+
+            settings_file.write('\n\n#### Batch ####')
+
+            settings_file.write('\n# Number of processes fitting files in parallel. 0 uses all the cores.\n')
+            settings_file.write('WORKERS=' + str(self.WORKERS))
+
+            settings_file.write('\n# Folder where fit results are cached, so that unchanged files are not fitted again. '
+                                'Leave empty to disable the cache.\n')
+            settings_file.write('CACHE_DIR=' + str(self.CACHE_DIR))
+
+            settings_file.write('\n# Maximum size of the cache folder, in MB. The least recently used results are removed '
+                                'first.\n')
+            settings_file.write('CACHE_MAX_MB=' + str(self.CACHE_MAX_MB))
+
+            settings_file.write('\n# Fit each flow curve segment of a file on its own? If False, all the flow curve '
+                                'segments of a file are fitted together as one curve.\n')
+            settings_file.write('SPLIT_SEGMENTS=' + str(self.SPLIT_SEGMENTS))
+
+            settings_file.write('\n# Folder of the curve store written by DataExtraction. With PREV_EXTRACTED, the flow curves '
+                                'in it are fitted instead of CSV files. Leave empty to use CSV files.\n')
+            settings_file.write('CURVE_STORE=' + str(self.CURVE_STORE))
+
+            settings_file.write('\n# File where the batch writes one row per fit (model, window, parameters and errors, R2, '
+                                'function evaluations and status), e.g. fits.csv. Leave empty to not write it; '
+                                'BatchCLI writes fits.csv unless told otherwise.\n')
+            settings_file.write('RESULTS_TABLE=' + str(self.RESULTS_TABLE))
+
+            settings_file.write('\n# SQLite database where every batch is recorded as a run, with all its fits, to be queried '
+                                'with python ResultsDB.py. Leave empty to not write it.\n')
+            settings_file.write('RESULTS_DB=' + str(self.RESULTS_DB))
+
+            settings_file.write('\n# File listing the files already fitted, with their size, date, hash and settings. If set, '
+                                'only new or changed files are fitted. Leave empty to fit every file every time.\n')
+            settings_file.write('MANIFEST=' + str(self.MANIFEST))
+
+            settings_file.write('\n# Remove the plots and the results table and database rows of files in the manifest that '
+                                'no longer exist?\n')
+            settings_file.write('PRUNE_STALE=' + str(self.PRUNE_STALE))
+
+            settings_file.write('\n# File where the batch records the files it has done. A batch that was interrupted resumes '
+                                'from where it stopped. Leave empty to always start from the beginning.\n')
+            settings_file.write('JOURNAL=' + str(self.JOURNAL))
+
+            settings_file.write('\n# Number of processes saving the graphs of the batch, when they are not shown, while the '
+                                'next files are fitted. 1 saves them in the main process. 0 uses all the cores.\n')
+            settings_file.write('PLOT_WORKERS=' + str(self.PLOT_WORKERS))
+
+            settings_file.write('\n# PDF where the batch draws all its fits, several per page, with contact sheets of '
+                                'thumbnails next to it, rendered by the PLOT_WORKERS. Leave empty to not write it.\n')
+            settings_file.write('REPORT=' + str(self.REPORT))
+
+            settings_file.write('\n# File where the batch writes the time spent in each stage, the windows tried, the solver '
+                                'runs and the exceptions of every fit, as JSON lines, or their totals as Prometheus '
+                                'metrics if it ends in .prom. Leave empty to not write it.\n')
+            settings_file.write('STATS=' + str(self.STATS))
+
             settings_file.write('\n\n##### Debug #####\n')
             settings_file.write('# Show debug messages\n')
             settings_file.write('DEBUG=' + str(self.DEBUG))
@@ -166,6 +259,19 @@ class Settings:
                 print(': Options = time in seconds')
             elif param == 'MAX_FP_NL':
                 print(': Options = 1/n. n=1: whole curve. n=2: half')
+            elif param in ('WORKERS', 'PLOT_WORKERS'):
+                print(': Options = number of processes. 0: all cores')
+            elif param == 'CACHE_DIR':
+                print(': Options = folder name. Empty: no cache')
+            elif param == 'CACHE_MAX_MB':
+                print(': Options = size in MB')
+            elif param == 'CURVE_STORE':
+                print(': Options = folder name. Empty: CSV files')
+            elif param in ('RESULTS_TABLE', 'RESULTS_DB', 'MANIFEST', 'JOURNAL', 'REPORT', 'STATS'):
+                print(': Options = file name. Empty: not written')
+            elif param == 'NL_SCAN_MODE':
+                print(': Options= ', end='')
+                print(*self.valid_options_nl_scan, sep=' | ')
             else:
                 print('\n')
             valid_numbers.append(str(counter))
@@ -179,6 +285,28 @@ class Settings:
 
         return valid_numbers, number_setting_corr
 
+    def set_setting(self, param, value):
+        """Sets param to value as load_settings would, 'True' and 'False' becoming booleans, and the settings in
+        numeric_settings being converted to numbers.
+        Raises ValueError if param is not a setting or value is not one of its options."""
+        if param not in self.valid_settings:
+            raise ValueError(f'{param} is not a valid setting')
+        if param in self.numeric_settings:
+            kind, minimum = self.numeric_settings[param]
+            try:
+                value = kind(str(value).strip())  # Through str, so that neither True nor 2.5 pass as an int
+            except ValueError:
+                raise ValueError(f'{param} must be a number ({kind.__name__}), not {value!r}') from None
+            if value < minimum:
+                raise ValueError(f'{param} must be at least {minimum}, not {value}')
+        elif isinstance(value, str) and value.lower() in ('true', 'false'):
+            value = value.lower() == 'true'
+        options = {'NL_FITTING_METHOD': self.models, 'LIN_SORTING_METHOD': self.valid_options_lin_sorting,
+                   'NL_SORTING_METHOD': self.valid_options_nl_sorting, 'NL_SCAN_MODE': self.valid_options_nl_scan}
+        if param in options and value not in options[param]:
+            raise ValueError(f'{value} is not a valid {param}. Options: {", ".join(options[param])}')
+        setattr(self, param, value)
+
     def edit_settings(self):
         """Edits the current settings"""
         while True:
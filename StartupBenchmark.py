@@ -0,0 +1,57 @@
+import argparse
+import json
+import subprocess
+import sys
+import time
+
+# Modules whose import is timed. Worker processes import BatchRunner, and BatchCLI is run for every batch.
+MODULES = ['Settings', 'Models', 'RheoFCClass', 'BatchRunner', 'BatchCLI']
+# Dependencies that must only be imported by the code that uses them, see RheoFCClass
+HEAVY = ['matplotlib', 'scipy.optimize', 'lmfit', 'pandas', 'uncertainties', 'PyQt5']
+
+MEASURE = '''import sys, time, json
+start = time.perf_counter()
+import {module}
+seconds = time.perf_counter() - start
+print(json.dumps({{'seconds': seconds, 'heavy': [name for name in {heavy!r} if name in sys.modules]}}))'''
+
+
+def measure(module, repeat=5):
+    """Fastest time, in s, of importing module in a new interpreter and of the whole interpreter run, out of
+    repeat runs, and the heavy dependencies it imported"""
+    import_times = []
+    process_times = []
+    heavy = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        output = subprocess.run([sys.executable, '-c', MEASURE.format(module=module, heavy=HEAVY)],
+                                capture_output=True, text=True, check=True).stdout
+        process_times.append(time.perf_counter() - start)
+        result = json.loads(output.strip().split('\n')[-1])
+        import_times.append(result['seconds'])
+        heavy = result['heavy']
+    return {'import': min(import_times), 'process': min(process_times), 'heavy': heavy}
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Times the startup of the modules the batch runs, each in a new '
+                                                 'interpreter, and checks they do not import heavy dependencies.')
+    parser.add_argument('modules', nargs='*', default=MODULES, help=f'modules to time. Default: {MODULES}')
+    parser.add_argument('--repeat', type=int, default=5, help='runs of each module, the fastest is kept')
+    parser.add_argument('--json', help='file the results are appended to, one line per run, to track them')
+    args = parser.parse_args(argv)
+
+    results = {module: measure(module, args.repeat) for module in args.modules}
+    print(f'{"module":<14}{"import (s)":>12}{"process (s)":>13}  heavy dependencies')
+    for module, result in results.items():
+        print(f'{module:<14}{result["import"]:>12.3f}{result["process"]:>13.3f}  {", ".join(result["heavy"])}')
+    if args.json:
+        with open(args.json, 'a', encoding='utf-8') as history:
+            history.write(json.dumps({'date': time.strftime('%Y-%m-%d %H:%M:%S'), 'python': sys.version.split()[0],
+                                      'results': results}) + '\n')
+    # Exit status 1 if a module imported a heavy dependency at startup
+    return int(any(result['heavy'] for result in results.values()))
+
+
+if __name__ == '__main__':
+    sys.exit(main())